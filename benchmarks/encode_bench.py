@@ -0,0 +1,229 @@
+"""Encoder benchmark on synthetic media generated with ffmpeg's lavfi test sources.
+
+    python benchmarks/encode_bench.py
+    python benchmarks/encode_bench.py --scenarios h264_aac_short,hevc_aac --json baseline.json
+    python benchmarks/encode_bench.py --compare baseline.json
+
+Each scenario runs plugins.encoder.encode_video end to end in its own process, without Telegram,
+using a stub message and progress object and a fake stream table. Disk reads come from rusage block
+input, so files already in the page cache count as zero.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+VIDEO_SRC = "testsrc2=size={size}:rate={rate}"
+AUDIO_SRC = "sine=frequency={freq}:sample_rate=48000"
+
+# name -> (container, duration seconds, video codec args, audio tracks as codec args, subtitle tracks)
+SCENARIOS = {
+    "h264_aac_short": ("mp4", 10, "-c:v libx264 -preset ultrafast", ["-c:a aac"], 0),
+    "h264_aac_long": ("mp4", 300, "-c:v libx264 -preset ultrafast", ["-c:a aac"], 0),
+    "hevc_aac": ("mp4", 30, "-c:v libx265 -preset ultrafast -tag:v hvc1", ["-c:a aac"], 0),
+    "mpeg4_mp3": ("avi", 30, "-c:v mpeg4 -q:v 5", ["-c:a libmp3lame"], 0),
+    "multi_audio_mkv": ("mkv", 60, "-c:v libx264 -preset ultrafast", ["-c:a ac3", "-c:a aac", "-c:a libopus"], 0),
+    "subtitle_heavy_mkv": ("mkv", 60, "-c:v libx264 -preset ultrafast", ["-c:a aac"], 6),
+}
+
+
+def _write_srt(path, duration, track):
+    with open(path, "w", encoding="utf-8") as f:
+        for n, start in enumerate(range(0, duration, 2), start=1):
+            end = min(start + 2, duration)
+            f.write(f"{n}\n00:{start // 60:02d}:{start % 60:02d},000 --> 00:{end // 60:02d}:{end % 60:02d},000\n"
+                    f"Track {track} cue {n}\n\n")
+
+
+def make_fixture(name, directory, size, rate):
+    """Render a scenario's source file with lavfi and return its path"""
+    container, duration, video_args, audio_tracks, subtitles = SCENARIOS[name]
+    path = os.path.join(directory, f"{name}.{container}")
+    if os.path.exists(path):
+        return path
+
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+           "-f", "lavfi", "-i", VIDEO_SRC.format(size=size, rate=rate)]
+    for i, _ in enumerate(audio_tracks):
+        cmd += ["-f", "lavfi", "-i", AUDIO_SRC.format(freq=440 + 110 * i)]
+    for i in range(subtitles):
+        srt = os.path.join(directory, f"{name}_{i}.srt")
+        _write_srt(srt, duration, i)
+        cmd += ["-i", srt]
+
+    cmd += ["-map", "0:v"]
+    for i, _ in enumerate(audio_tracks):
+        cmd += ["-map", f"{i + 1}:a"]
+    for i in range(subtitles):
+        cmd += ["-map", f"{len(audio_tracks) + 1 + i}:s"]
+    cmd += video_args.split()
+    for i, codec_args in enumerate(audio_tracks):
+        codec, value = codec_args.split()
+        cmd += [f"{codec}:{i}", value]
+    if subtitles:
+        cmd += ["-c:s", "srt"]
+    cmd += ["-t", str(duration), path]
+    subprocess.run(cmd, check=True)
+    return path
+
+
+def _tree_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class StubUser:
+    id = 0
+    username = None
+
+
+class StubChat:
+    id = 0
+
+
+class StubMessage:
+    """Just enough of a pyrogram Message for encode_video and insert_video"""
+    from_user = StubUser()
+    chat = StubChat()
+
+
+def run_scenario(name, fixture, workdir, results):
+    """Child process: encode one fixture with the real encoder and report resource usage"""
+    os.chdir(workdir)
+    os.environ.update({"PERSIST_JOBS": "false", "SUPABASE_URL": "http://localhost", "SUPABASE_KEY": "bench",
+                       "STORAGE_ROOTS": workdir})
+    from benchmarks.fake_supabase import install
+    install()
+
+    from plugins.video import que
+    from plugins.encoder import encode_video
+    from web.tiering import SilentProgress
+
+    file_id = f"bench_{name}"
+    source = os.path.join(workdir, os.path.basename(fixture))
+    shutil.copy2(fixture, source)
+    os.sync()
+
+    async def run():
+        encoder = asyncio.create_task(encode_video())
+        await que.put({
+            "file_id": file_id,
+            "file_name": os.path.basename(fixture),
+            "file_path": source,
+            "chat_id": 0,
+            "user_id": 0,
+            "bot": None,
+            "progress": SilentProgress(),
+            "msg": StubMessage(),
+            "queued_at": time.time(),
+        })
+        await que.join()
+        encoder.cancel()
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    asyncio.run(run())
+    wall = time.perf_counter() - started
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+
+    hls_dir = os.path.join(workdir, "downloads", file_id)
+    duration = SCENARIOS[name][1]
+    results[name] = {
+        "ok": os.path.exists(os.path.join(hls_dir, "master.m3u8")),
+        "wall_seconds": round(wall, 3),
+        "speed_x": round(duration / wall, 2) if wall else 0,
+        # ru_maxrss is KiB on Linux; children reports the largest single ffmpeg
+        "peak_rss_mb": round(max(children.ru_maxrss, own.ru_maxrss) / 1024, 1),
+        "read_mb": round((children.ru_inblock - before.ru_inblock + own.ru_inblock) * 512 / (1024 * 1024), 2),
+        "cpu_seconds": round(children.ru_utime + children.ru_stime - before.ru_utime - before.ru_stime, 2),
+        "input_mb": round(os.path.getsize(fixture) / (1024 * 1024), 2),
+        "output_mb": round(_tree_size(hls_dir) / (1024 * 1024), 2),
+        "files": sum(len(files) for _, _, files in os.walk(hls_dir)),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print a comparison and return the scenarios that regressed by more than threshold"""
+    regressions = []
+    print(f"{'scenario':<22}{'wall s':>10}{'speed x':>10}{'rss MB':>10}{'read MB':>10}{'out MB':>10}  vs baseline")
+    for name, r in results.items():
+        base = (baseline or {}).get(name)
+        note = ""
+        if not r["ok"]:
+            note = "FAILED"
+            regressions.append(name)
+        elif base:
+            change = (r["wall_seconds"] - base["wall_seconds"]) / base["wall_seconds"] if base["wall_seconds"] else 0
+            size_change = (r["output_mb"] - base["output_mb"]) / base["output_mb"] if base["output_mb"] else 0
+            note = f"wall {change * 100:+.1f}%, output {size_change * 100:+.1f}%"
+            if change > threshold:
+                note += " REGRESSION"
+                regressions.append(name)
+        print(f"{name:<22}{r['wall_seconds']:>10}{r['speed_x']:>10}{r['peak_rss_mb']:>10}"
+              f"{r['read_mb']:>10}{r['output_mb']:>10}  {note}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenario names")
+    parser.add_argument("--size", default="1280x720", help="fixture frame size")
+    parser.add_argument("--rate", default="30", help="fixture frame rate")
+    parser.add_argument("--fixtures", default=os.path.join(tempfile.gettempdir(), "stream-encode-fixtures"),
+                        help="fixture cache directory, reused between runs")
+    parser.add_argument("--json", help="write results to this file, e.g. as a baseline")
+    parser.add_argument("--compare", help="baseline results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="wall time regression that fails the run")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    fixture_dir = os.path.join(args.fixtures, f"{args.size}_{args.rate}")
+    os.makedirs(fixture_dir, exist_ok=True)
+    results = multiprocessing.Manager().dict()
+    for name in names:
+        try:
+            fixture = make_fixture(name, fixture_dir, args.size, args.rate)
+        except subprocess.CalledProcessError as e:
+            print(f"Skipping {name}: fixture generation failed ({e})")
+            continue
+        workdir = tempfile.mkdtemp(prefix=f"stream-encode-{name}-")
+        try:
+            process = multiprocessing.Process(target=run_scenario, args=(name, fixture, workdir, results))
+            process.start()
+            process.join()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = dict(results)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
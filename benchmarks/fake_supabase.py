@@ -0,0 +1,133 @@
+"""In-process stand-in for the Supabase client, enough of the query builder for the code in database/ and web/.
+
+install() must run before anything imports database.spbase.
+"""
+import sys
+import types
+import uuid
+from datetime import datetime, timezone
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class _Query:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.action = "select"
+        self.payload = None
+        self.filters = []
+        self.max_rows = None
+        self.columns = None
+        self.order_by = None
+
+    def select(self, columns="*", **kwargs):
+        self.action = "select"
+        self.columns = None if columns == "*" else [c.strip() for c in columns.split(",")]
+        return self
+
+    def insert(self, data, **kwargs):
+        self.action = "insert"
+        self.payload = data if isinstance(data, list) else [data]
+        return self
+
+    def upsert(self, data, **kwargs):
+        self.action = "upsert"
+        self.payload = data if isinstance(data, list) else [data]
+        return self
+
+    def delete(self, **kwargs):
+        self.action = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: str(row.get(column)) == str(value))
+        return self
+
+    def in_(self, column, values):
+        wanted = {str(v) for v in values}
+        self.filters.append(lambda row: str(row.get(column)) in wanted)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and str(row.get(column)) > str(value))
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and str(row.get(column)) >= str(value))
+        return self
+
+    def order(self, column, desc=False, **kwargs):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, count):
+        self.max_rows = count
+        return self
+
+    def _matches(self, row):
+        return all(f(row) for f in self.filters)
+
+    def execute(self):
+        rows = self.db.tables.setdefault(self.table, [])
+        if self.action == "insert" or self.action == "upsert":
+            now = datetime.now(timezone.utc).isoformat()
+            inserted = []
+            for item in self.payload:
+                row = {"id": str(uuid.uuid4()), "created_at": now, **item}
+                rows.append(row)
+                inserted.append(dict(row))
+            return _Result(inserted)
+        if self.action == "delete":
+            deleted = [row for row in rows if self._matches(row)]
+            self.db.tables[self.table] = [row for row in rows if not self._matches(row)]
+            return _Result(deleted)
+
+        found = [row for row in rows if self._matches(row)]
+        if self.order_by:
+            column, desc = self.order_by
+            found.sort(key=lambda row: str(row.get(column, "")), reverse=desc)
+        if self.max_rows is not None:
+            found = found[:self.max_rows]
+        if self.columns:
+            found = [{c: row.get(c) for c in self.columns} for row in found]
+        else:
+            found = [dict(row) for row in found]
+        return _Result(found)
+
+
+class _Rpc:
+    def __init__(self, db, name, params):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        self.db.rpc_calls.append((self.name, self.params))
+        return _Result(None)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables = {}
+        self.rpc_calls = []
+
+    def table(self, name):
+        return _Query(self, name)
+
+    from_ = table
+
+    def rpc(self, name, params=None):
+        return _Rpc(self, name, params or {})
+
+
+def install():
+    """Replace database.spbase with a module exposing a FakeSupabase client and return the client"""
+    client = FakeSupabase()
+    module = types.ModuleType("database.spbase")
+    module.supabase = client
+    sys.modules["database.spbase"] = module
+    return client
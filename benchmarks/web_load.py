@@ -0,0 +1,296 @@
+"""Load test for the web tier against a local fake of the stream table and a synthetic downloads/ tree.
+
+    python benchmarks/web_load.py --viewers 100 --duration 60
+    python benchmarks/web_load.py --json baseline.json
+    python benchmarks/web_load.py --compare baseline.json
+
+The server runs in a child process built from web.initial.create_app, so client load does not skew
+its event-loop lag. Viewers open the player page, then fetch master, media playlists and segments
+at playback pace.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+BENCH_AUTH = (os.getenv("ADMIN_USERNAME", "admin"), os.getenv("ADMIN_PASSWORD", "password"))
+
+
+def build_fixture(root, videos, segments, segment_size, segment_seconds):
+    """Write a synthetic downloads/ tree and return the stream rows that point at it"""
+    rows = []
+    payload = os.urandom(min(segment_size, 1024 * 1024))
+    for i in range(videos):
+        file_id = f"bench{i:05d}"
+        hls_dir = os.path.join(root, "downloads", file_id)
+        for kind in ("video", "audio"):
+            os.makedirs(os.path.join(hls_dir, kind), exist_ok=True)
+            lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{segment_seconds}",
+                     "#EXT-X-MEDIA-SEQUENCE:0"]
+            size = segment_size if kind == "video" else max(1, segment_size // 8)
+            for n in range(segments):
+                with open(os.path.join(hls_dir, kind, f"segment{n}.ts"), "wb") as f:
+                    remaining = size
+                    while remaining > 0:
+                        f.write(payload[:remaining])
+                        remaining -= len(payload)
+                lines += [f"#EXTINF:{segment_seconds:.6f},", f"segment{n}.ts"]
+            lines.append("#EXT-X-ENDLIST")
+            with open(os.path.join(hls_dir, kind, "playlist.m3u8"), "w") as f:
+                f.write("\n".join(lines) + "\n")
+        with open(os.path.join(hls_dir, "master.m3u8"), "w") as f:
+            f.write('#EXTM3U\n#EXT-X-VERSION:3\n'
+                    '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="Audio 0",DEFAULT=YES,URI="audio/playlist.m3u8"\n'
+                    '#EXT-X-STREAM-INF:BANDWIDTH=5000000,AUDIO="audio"\nvideo/playlist.m3u8\n')
+        rows.append({"user": 1, "video": file_id, "token": str(uuid.uuid4()), "title": f"Bench video {i}",
+                     "original_ext": ".mp4"})
+    return rows
+
+
+def run_server(root, port, rows, ready):
+    """Child process: fake Supabase, benchmark-friendly limits, the real app, plus a loop-lag probe"""
+    os.chdir(root)
+    os.environ.update({
+        "HLS_PER_IP_CONCURRENCY": "0", "HLS_PER_IP_BYTES_PER_SEC": "0",
+        "HLS_PER_VIDEO_CONCURRENCY": "0", "HLS_PER_VIDEO_BYTES_PER_SEC": "0",
+        "SUPABASE_URL": "http://localhost", "SUPABASE_KEY": "bench", "STORAGE_ROOTS": root,
+    })
+    from benchmarks.fake_supabase import install
+    install().tables["stream"] = rows
+
+    from aiohttp import web
+    from web.initial import create_app
+    from web.protected_page import public
+
+    lag_samples = []
+
+    async def probe_lag(app):
+        async def probe():
+            interval = 0.01
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(interval)
+                lag_samples.append(max(0.0, time.perf_counter() - start - interval))
+
+        app["lag_probe"] = asyncio.create_task(probe())
+
+    @public
+    async def lag_handler(request):
+        samples = list(lag_samples)
+        lag_samples.clear()
+        return web.json_response(samples)
+
+    app = create_app("all")
+    app.on_startup.append(probe_lag)
+    app.router.add_get("/__bench/lag", lag_handler)
+    ready.set()
+    web.run_app(app, host="127.0.0.1", port=port, print=None, handle_signals=True)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.bytes = 0
+
+    def add(self, kind, seconds, size, ok):
+        self.latencies.setdefault(kind, []).append(seconds)
+        self.bytes += size
+        if not ok:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def fetch(session, recorder, kind, url, **kwargs):
+    start = time.perf_counter()
+    try:
+        async with session.get(url, **kwargs) as response:
+            body = await response.read()
+            ok = response.status < 400
+    except Exception:
+        body, ok = b"", False
+    recorder.add(kind, time.perf_counter() - start, len(body), ok)
+    return body if ok else None
+
+
+async def viewer(session, base, rows, recorder, deadline, segment_seconds, speed):
+    """One HLS viewer: player page, master, both media playlists, then segments at playback pace"""
+    while time.monotonic() < deadline:
+        row = random.choice(rows)
+        page = await fetch(session, recorder, "player", f"{base}/video/{row['token']}")
+        match = re.search(rb'<source src="([^"]+)"', page or b"")
+        if not match:
+            await asyncio.sleep(1)
+            continue
+        master_url = base + match.group(1).decode()
+        prefix = master_url.rsplit("/", 1)[0]
+        if await fetch(session, recorder, "master", master_url) is None:
+            continue
+        video_playlist = await fetch(session, recorder, "playlist", f"{prefix}/video/playlist.m3u8")
+        audio_playlist = await fetch(session, recorder, "playlist", f"{prefix}/audio/playlist.m3u8")
+        if video_playlist is None:
+            continue
+        video_segments = re.findall(rb"^(segment\d+\.ts)$", video_playlist, re.M)
+        audio_segments = re.findall(rb"^(segment\d+\.ts)$", audio_playlist or b"", re.M)
+        for n, segment in enumerate(video_segments):
+            if time.monotonic() >= deadline:
+                return
+            started = time.monotonic()
+            fetches = [fetch(session, recorder, "segment", f"{prefix}/video/{segment.decode()}")]
+            if n < len(audio_segments):
+                fetches.append(fetch(session, recorder, "segment", f"{prefix}/audio/{audio_segments[n].decode()}"))
+            await asyncio.gather(*fetches)
+            await asyncio.sleep(max(0.0, segment_seconds / speed - (time.monotonic() - started)))
+
+
+async def index_poller(session, base, recorder, deadline, interval):
+    from aiohttp import BasicAuth
+
+    auth = BasicAuth(*BENCH_AUTH)
+    while time.monotonic() < deadline:
+        await fetch(session, recorder, "index", f"{base}/videos", auth=auth)
+        await asyncio.sleep(interval)
+
+
+async def run_load(args, base, rows):
+    import aiohttp
+
+    recorder = Recorder()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for _ in range(100):
+            try:
+                async with session.get(f"{base}/__bench/lag") as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        tasks = []
+        for i in range(args.viewers):
+            # Stagger joins over the first segment so viewers do not march in lockstep
+            await asyncio.sleep(args.segment_seconds / args.speed / max(1, args.viewers))
+            tasks.append(asyncio.create_task(
+                viewer(session, base, rows, recorder, deadline, args.segment_seconds, args.speed)))
+        if args.index_interval > 0:
+            tasks.append(asyncio.create_task(index_poller(session, base, recorder, deadline, args.index_interval)))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+
+        async with session.get(f"{base}/__bench/lag") as response:
+            lag = await response.json()
+
+    requests = sum(len(v) for v in recorder.latencies.values())
+    report = {
+        "viewers": args.viewers,
+        "duration": round(elapsed, 2),
+        "requests": requests,
+        "requests_per_sec": round(requests / elapsed, 2),
+        "mb_per_sec": round(recorder.bytes / elapsed / (1024 * 1024), 2),
+        "errors": recorder.errors,
+        "latency_ms": {
+            kind: {
+                "count": len(values),
+                "p50": round(percentile(values, 50) * 1000, 2),
+                "p95": round(percentile(values, 95) * 1000, 2),
+                "p99": round(percentile(values, 99) * 1000, 2),
+            }
+            for kind, values in sorted(recorder.latencies.items())
+        },
+        "loop_lag_ms": {
+            "p50": round(percentile(lag, 50) * 1000, 2),
+            "p99": round(percentile(lag, 99) * 1000, 2),
+            "max": round(max(lag, default=0) * 1000, 2),
+            "mean": round(statistics.fmean(lag) * 1000, 2) if lag else 0.0,
+        },
+    }
+    return report
+
+
+def print_report(report, baseline=None):
+    def delta(current, previous):
+        if not previous:
+            return ""
+        return f" ({(current - previous) / previous * 100:+.1f}%)"
+
+    base = baseline or {}
+    print(f"viewers={report['viewers']} duration={report['duration']}s requests={report['requests']}")
+    print(f"throughput: {report['requests_per_sec']} req/s"
+          f"{delta(report['requests_per_sec'], base.get('requests_per_sec'))}, "
+          f"{report['mb_per_sec']} MB/s{delta(report['mb_per_sec'], base.get('mb_per_sec'))}")
+    print(f"{'route':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, stats in report["latency_ms"].items():
+        previous = base.get("latency_ms", {}).get(kind, {})
+        print(f"{kind:<10}{stats['count']:>8}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}"
+              f"{delta(stats['p99'], previous.get('p99'))}")
+    lag = report["loop_lag_ms"]
+    print(f"event-loop lag: p50={lag['p50']}ms p99={lag['p99']}ms max={lag['max']}ms"
+          f"{delta(lag['p99'], base.get('loop_lag_ms', {}).get('p99'))}")
+    if report["errors"]:
+        print(f"errors: {report['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--viewers", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--videos", type=int, default=20)
+    parser.add_argument("--segments", type=int, default=60, help="segments per rendition")
+    parser.add_argument("--segment-size", type=int, default=512 * 1024, help="bytes per video segment")
+    parser.add_argument("--segment-seconds", type=float, default=5)
+    parser.add_argument("--speed", type=float, default=1.0, help="playback pace multiplier, >1 fetches faster")
+    parser.add_argument("--index-interval", type=float, default=5, help="seconds between /videos loads, 0 to skip")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--json", help="write the report to this file, e.g. as a baseline")
+    parser.add_argument("--compare", help="baseline report to compare against")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="stream-bench-")
+    try:
+        rows = build_fixture(root, args.videos, args.segments, args.segment_size, args.segment_seconds)
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=run_server, args=(root, args.port, rows, ready), daemon=True)
+        server.start()
+        ready.wait(30)
+        try:
+            report = asyncio.run(run_load(args, f"http://127.0.0.1:{args.port}", rows))
+        finally:
+            server.terminate()
+            server.join(10)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+from database.spbase import supabase
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# In-memory copy of banned_users, checked on every /upload before anything touches the network:
+#
+#   create table banned_users (
+#       username text primary key,
+#       created_at timestamptz not null default now()
+#   );
+#
+# username holds what the admin banned: a Telegram user id or an @username.
+
+BAN_REFRESH_SECONDS = float(os.getenv("BAN_REFRESH_SECONDS", "60"))
+# Full reload that also drops lifted bans, which the created_at cursor cannot see
+BAN_FULL_REFRESH_SECONDS = float(os.getenv("BAN_FULL_REFRESH_SECONDS", "3600"))
+PAGE_SIZE = 1000
+
+banned = set()
+_cursor = ""
+_full_loaded_at = 0.0
+# Bans added by the admin while load_bans runs, which its snapshot may predate
+_reloading = False
+_added_during_reload = set()
+
+
+def _key(value) -> str:
+    return str(value).strip().lstrip("@").lower()
+
+
+def is_banned(user) -> bool:
+    """Telegram user by id or username, a set lookup"""
+    if user is None:
+        return False
+    if _key(user.id) in banned:
+        return True
+    username = getattr(user, "username", None)
+    return bool(username) and _key(username) in banned
+
+
+def add_ban(username):
+    key = _key(username)
+    banned.add(key)
+    if _reloading:
+        _added_during_reload.add(key)
+
+
+def _fetch(since=""):
+    rows = []
+    offset = 0
+    while True:
+        query = supabase.table("banned_users").select("username,created_at")
+        if since:
+            # gte so a ban sharing the cursor's timestamp is not skipped, the set makes repeats harmless
+            query = query.gte("created_at", since)
+        page = query.order("created_at").range(offset, offset + PAGE_SIZE - 1).execute().data or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        offset += PAGE_SIZE
+
+
+def load_bans():
+    global _cursor, _full_loaded_at, _reloading
+    _added_during_reload.clear()
+    _reloading = True
+    try:
+        rows = _fetch()
+        current = {_key(row["username"]) for row in rows if row.get("username")}
+        # In place and without emptying the set first, /upload reads it while this runs in an executor
+        banned.intersection_update(current)
+        banned.update(current)
+        banned.update(_added_during_reload)
+    finally:
+        _reloading = False
+        _added_during_reload.clear()
+    _cursor = max((row.get("created_at") or "" for row in rows), default="")
+    _full_loaded_at = time.time()
+    return len(banned)
+
+
+def refresh_bans():
+    """Pull bans added since the last load"""
+    global _cursor
+    rows = _fetch(_cursor)
+    banned.update(_key(row["username"]) for row in rows if row.get("username"))
+    _cursor = max([_cursor] + [row.get("created_at") or "" for row in rows])
+    return len(rows)
+
+
+async def run_ban_refresh():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if time.time() - _full_loaded_at > BAN_FULL_REFRESH_SECONDS:
+                count = await loop.run_in_executor(None, load_bans)
+                logger.info(f"Loaded {count} banned users")
+            else:
+                await loop.run_in_executor(None, refresh_bans)
+        except Exception as e:
+            logger.error(f"Ban list refresh failed, keeping the last copy: {str(e)}")
+        await asyncio.sleep(BAN_REFRESH_SECONDS)
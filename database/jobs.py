@@ -0,0 +1,6 @@
+from database.spbase import supabase
+
+
+def insert_job(job: dict):
+    response = supabase.table("jobs").insert(job).execute()
+    return response
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from database.spbase import supabase
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Local read replica of the stream table. Reads are served from it once it has synced,
+# writes go to Supabase first and are applied here straight after.
+#
+# Deletes reach the replica through a tombstone table kept by a trigger in Supabase:
+#
+#   create table stream_tombstones (
+#       token uuid primary key,
+#       video text,
+#       deleted_at timestamptz not null default now()
+#   );
+#
+#   create function stream_tombstone() returns trigger language plpgsql as $$
+#   begin
+#       insert into stream_tombstones (token, video) values (old.token, old.video)
+#       on conflict (token) do update set deleted_at = now();
+#       return old;
+#   end;
+#   $$;
+#
+#   create trigger stream_tombstone after delete on stream for each row execute function stream_tombstone();
+
+REPLICA_PATH = os.getenv("REPLICA_PATH", os.path.join(os.getcwd(), "stream_replica.db"))
+REPLICA_SYNC_SECONDS = float(os.getenv("REPLICA_SYNC_SECONDS", "30"))
+# Periodic full copy that also picks up edited rows, which the created_at cursor cannot see
+REPLICA_FULL_SYNC_SECONDS = float(os.getenv("REPLICA_FULL_SYNC_SECONDS", "21600"))
+PAGE_SIZE = 1000
+
+_lock = threading.Lock()
+_connection = None
+
+
+def _connect():
+    global _connection
+    if _connection is None:
+        # Shared by executor threads under _lock. WAL lets serve.py workers read while the bot process syncs.
+        _connection = sqlite3.connect(REPLICA_PATH, check_same_thread=False, timeout=10)
+        _connection.row_factory = sqlite3.Row
+        _connection.execute("pragma journal_mode=wal")
+        _connection.executescript("""
+            create table if not exists stream (
+                token text primary key,
+                video text,
+                user text,
+                created_at text,
+                data text not null
+            );
+            create index if not exists stream_video on stream (video);
+            create index if not exists stream_user on stream (user);
+            create index if not exists stream_created_at on stream (created_at);
+            create table if not exists meta (key text primary key, value text);
+        """)
+    return _connection
+
+
+def _get_meta(db, key):
+    row = db.execute("select value from meta where key = ?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
+def _set_meta(db, key, value):
+    db.execute("insert or replace into meta (key, value) values (?, ?)", (key, str(value)))
+
+
+def _upsert(db, rows):
+    db.executemany(
+        "insert or replace into stream (token, video, user, created_at, data) values (?, ?, ?, ?, ?)",
+        [(str(row["token"]), row.get("video"), str(row.get("user")), row.get("created_at"), json.dumps(row))
+         for row in rows if row.get("token")]
+    )
+
+
+def ready() -> bool:
+    """True once a full sync has completed, before that reads fall back to Supabase"""
+    try:
+        with _lock:
+            return _get_meta(_connect(), "full_synced_at") is not None
+    except sqlite3.Error as e:
+        logger.warning(f"Stream replica unavailable: {str(e)}")
+        return False
+
+
+def _query(sql, params=()):
+    with _lock:
+        return [json.loads(row["data"]) for row in _connect().execute(sql, params)]
+
+
+def get_by_token(token: str):
+    rows = _query("select data from stream where token = ? limit 1", (str(token),))
+    return rows[0] if rows else None
+
+
+def get_by_video(file_id: str):
+    rows = _query("select data from stream where video = ? limit 1", (file_id,))
+    return rows[0] if rows else None
+
+
+def existing_videos(file_ids):
+    placeholders = ",".join("?" * len(file_ids))
+    with _lock:
+        return {row["video"] for row in
+                _connect().execute(f"select video from stream where video in ({placeholders})", list(file_ids))}
+
+
+def rows_for_videos(file_ids):
+    placeholders = ",".join("?" * len(file_ids))
+    return _query(f"select data from stream where video in ({placeholders})", list(file_ids))
+
+
+def all_rows():
+    return _query("select data from stream order by created_at")
+
+
+def apply_rows(rows):
+    """Write-through after a successful Supabase insert"""
+    with _lock:
+        db = _connect()
+        with db:
+            _upsert(db, rows)
+
+
+def apply_deletes(rows):
+    """Write-through after a successful Supabase delete"""
+    with _lock:
+        db = _connect()
+        with db:
+            db.executemany("delete from stream where token = ?", [(str(row["token"]),) for row in rows if row.get("token")])
+
+
+def _fetch_pages(build):
+    rows = []
+    offset = 0
+    while True:
+        page = build().range(offset, offset + PAGE_SIZE - 1).execute().data or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        offset += PAGE_SIZE
+
+
+def full_sync():
+    """Replace the replica with a fresh copy of the table"""
+    started = time.time()
+    rows = _fetch_pages(lambda: supabase.table("stream").select("*").order("created_at"))
+    with _lock:
+        db = _connect()
+        with db:
+            db.execute("delete from stream")
+            _upsert(db, rows)
+            _set_meta(db, "created_at", max((row.get("created_at") or "" for row in rows), default=""))
+            _set_meta(db, "full_synced_at", started)
+            # Tombstones older than the copy are already reflected in it. The margin absorbs clock skew.
+            _set_meta(db, "deleted_at", time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(started - 60)))
+    logger.info(f"Stream replica full sync: {len(rows)} rows in {time.time() - started:.2f}s")
+
+
+def incremental_sync():
+    """Pull rows created and tombstones written since the last sync"""
+    with _lock:
+        db = _connect()
+        created_cursor = _get_meta(db, "created_at") or ""
+        deleted_cursor = _get_meta(db, "deleted_at") or ""
+
+    def new_rows():
+        query = supabase.table("stream").select("*")
+        if created_cursor:
+            # gte rather than gt, so rows sharing the cursor's timestamp across a page boundary are not skipped
+            query = query.gte("created_at", created_cursor)
+        return query.order("created_at")
+
+    rows = _fetch_pages(new_rows)
+    tombstones = []
+    try:
+        tombstones = _fetch_pages(lambda: supabase.table("stream_tombstones").select("token,deleted_at")
+                                  .gt("deleted_at", deleted_cursor or "epoch").order("deleted_at"))
+    except Exception as e:
+        logger.warning(f"Stream tombstones unavailable, deletes sync on the next full sync: {str(e)}")
+
+    with _lock:
+        db = _connect()
+        with db:
+            _upsert(db, rows)
+            if rows:
+                _set_meta(db, "created_at", max(row.get("created_at") or "" for row in rows))
+            if tombstones:
+                db.executemany("delete from stream where token = ?", [(str(t["token"]),) for t in tombstones])
+                _set_meta(db, "deleted_at", max(t["deleted_at"] for t in tombstones))
+    return len(rows), len(tombstones)
+
+
+async def run_replica_sync():
+    """Keep the replica current. Runs in the bot process, playback workers only read the file."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            with _lock:
+                last_full = float(_get_meta(_connect(), "full_synced_at") or 0)
+            if time.time() - last_full > REPLICA_FULL_SYNC_SECONDS:
+                await loop.run_in_executor(None, full_sync)
+            else:
+                await loop.run_in_executor(None, incremental_sync)
+        except Exception as e:
+            logger.error(f"Stream replica sync failed, serving the last synced copy: {str(e)}")
+        await asyncio.sleep(REPLICA_SYNC_SECONDS)
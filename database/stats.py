@@ -0,0 +1,47 @@
+from database.spbase import supabase
+
+# Counters are flushed as increments so several serving processes can write the same row.
+# The table and function live in Supabase:
+#
+#   create table video_stats (
+#       video text not null,
+#       day date not null,
+#       views bigint not null default 0,
+#       bytes bigint not null default 0,
+#       primary key (video, day)
+#   );
+#
+#   create function increment_video_stats(rows jsonb) returns void language sql as $$
+#       insert into video_stats (video, day, views, bytes)
+#       select r->>'video', (r->>'day')::date, (r->>'views')::bigint, (r->>'bytes')::bigint
+#       from jsonb_array_elements(rows) r
+#       on conflict (video, day) do update
+#       set views = video_stats.views + excluded.views, bytes = video_stats.bytes + excluded.bytes;
+#   $$;
+#
+# Totals are summed in Postgres, so a page load reads one row per video instead of one per video and day:
+#
+#   create view video_stats_totals as
+#       select video, sum(views)::bigint as views, sum(bytes)::bigint as bytes
+#       from video_stats group by video;
+
+PAGE_SIZE = 1000
+
+
+def increment_video_stats(rows):
+    response = supabase.rpc("increment_video_stats", {"rows": rows}).execute()
+    return response
+
+
+def fetch_video_stats():
+    """All-time views and bytes per video, paged so the max-rows limit cannot truncate it"""
+    rows = []
+    offset = 0
+    while True:
+        response = supabase.table("video_stats_totals").select("video,views,bytes").order("video") \
+            .range(offset, offset + PAGE_SIZE - 1).execute()
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        offset += PAGE_SIZE
@@ -1,29 +1,104 @@
+import logging
 import uuid
+from database import replica
 from database.spbase import supabase
 from typing import Optional, List, Dict, Any
 
+logger = logging.getLogger(__name__)
 
-def insert_video( msg, file_id, file_name, unique_id):
+
+# original_ext needs this column, deployments without it keep inserting rows without the extension:
+#
+#   alter table stream add column if not exists original_ext text;
+
+_has_original_ext = True
+
+
+def insert_video( msg, file_id, file_name, unique_id, original_ext=None):
      # Generate a unique token
+    global _has_original_ext
 
     data = {
         "user": msg.from_user.id,
         "video": file_id,
         "token": unique_id,
-        "title": file_name
+        "title": file_name,
     }
+    if _has_original_ext:
+        # Extension of originals/<file_id><ext>, so deletion does not have to probe for it
+        data["original_ext"] = original_ext
 
-    response = supabase.from_("stream").insert(data).execute()
+    try:
+        response = supabase.from_("stream").insert(data).execute()
+    except Exception as e:
+        if "original_ext" not in str(e) or "original_ext" not in data:
+            raise
+        logger.warning("stream.original_ext is missing, run the migration in database/video.py. "
+                       "Inserting without it.")
+        _has_original_ext = False
+        data.pop("original_ext")
+        response = supabase.from_("stream").insert(data).execute()
+    replica.apply_rows(response.data or [])
     return response
 
 
+def delete_videos(column: str, values: List[str]) -> List[Dict[str, Any]]:
+    """Delete every stream row whose column matches one of values in one round trip, returning the deleted rows"""
+    response = supabase.table("stream").delete().in_(column, values).execute()
+    replica.apply_deletes(response.data or [])
+    return response.data or []
+
+
+def delete_user_videos(user) -> List[Dict[str, Any]]:
+    response = supabase.table("stream").delete().eq("user", user).execute()
+    replica.apply_deletes(response.data or [])
+    return response.data or []
+
+
 def video_exists(file_id: str):
+    if replica.ready():
+        row = replica.get_by_video(file_id)
+        return row["video"] if row else None
     response = supabase.table("stream").select("video").eq("video", file_id).limit(1).execute()
     if response.data:
         return response.data[0]["video"]
     return None
 
 
+def existing_videos(file_ids: List[str]) -> set:
+    """Which of file_ids are already in the stream table, in one query"""
+    if not file_ids:
+        return set()
+    if replica.ready():
+        return replica.existing_videos(file_ids)
+    response = supabase.table("stream").select("video").in_("video", file_ids).execute()
+    return {row["video"] for row in response.data or []}
+
+
+def fetch_stream_row(token) -> Optional[Dict[str, Any]]:
+    """Stream row for a playback token, from the local replica when it has synced"""
+    if replica.ready():
+        return replica.get_by_token(str(token))
+    response = supabase.table("stream").select("*").eq("token", str(token)).limit(1).execute()
+    return response.data[0] if response.data else None
+
+
+def fetch_all_videos() -> List[Dict[str, Any]]:
+    if replica.ready():
+        return replica.all_rows()
+    response = supabase.table("stream").select("*").execute()
+    return response.data or []
+
+
+def fetch_videos_by_id(file_ids: List[str]) -> List[Dict[str, Any]]:
+    if not file_ids:
+        return []
+    if replica.ready():
+        return replica.rows_for_videos(file_ids)
+    response = supabase.table("stream").select("*").in_("video", file_ids).execute()
+    return response.data or []
+
+
 async def fetch_video(id: uuid.UUID) -> Optional[List[Dict[str, Any]]]:
     try:
         response = await supabase.table("stream").select("*") .eq("token", id).limit(1) .execute()
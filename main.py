@@ -1,15 +1,23 @@
 import asyncio
 import logging
 import os
+import time
 
 from pyrogram import Client, idle, filters
 from plugins.encoder import encode_video
 from web.initial import start_web_server
+from web.tiering import run_tier_manager
+from web.reconcile import reconcile, startup_seconds
+from database.replica import run_replica_sync
+from database.bans import run_ban_refresh
+from web.logpipe import install_queue_logging, stop_queue_logging
 from dotenv import load_dotenv
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+install_queue_logging()
 logger = logging.getLogger(__name__)
+process_started = time.time()
 
 api_id = 1474940
 api_hash = "779e8d2b32ef76d0b7a11fb5f132a6b6"
@@ -27,16 +35,35 @@ app = Client(
 async def main():
     encoding_task = None
     web_server_task = None
+    tier_task = None
+    reconcile_task = None
+    replica_task = None
+    ban_task = None
 
     try:
         logger.info("Starting the bot...")
         await app.start()
-        logger.info("Bot started successfully.")
+        startup_seconds.set(time.time() - process_started, phase="bot")
+        logger.info(f"Bot started successfully in {time.time() - process_started:.2f}s.")
 
         logger.info("Starting video encoding task...")
 
+        logger.info("Starting the stream table replica sync...")
+        replica_task = asyncio.create_task(run_replica_sync())
+
+        logger.info("Loading the ban list...")
+        ban_task = asyncio.create_task(run_ban_refresh())
+
         logger.info("Starting the web server...")
         web_server_task = asyncio.create_task(start_web_server())
+        web_server_task.add_done_callback(
+            lambda task: startup_seconds.set(time.time() - process_started, phase="web"))
+
+        logger.info("Starting the HLS tier manager...")
+        tier_task = asyncio.create_task(run_tier_manager())
+
+        # Diff the disk against the stream table in the background, readiness does not wait for it
+        reconcile_task = asyncio.create_task(reconcile(process_started))
 
         logger.info("AioHttp Started. Entering idle mode...")
         await idle()
@@ -65,6 +92,22 @@ async def main():
             except (asyncio.CancelledError, asyncio.TimeoutError):
                 logger.info("Web server task cancelled or timed out.")
 
+        if reconcile_task is not None:
+            reconcile_task.cancel()
+        if replica_task is not None:
+            replica_task.cancel()
+        if ban_task is not None:
+            ban_task.cancel()
+
+        # Cancel tier manager task if it was started
+        if tier_task is not None:
+            tier_task.cancel()
+            try:
+                await asyncio.wait_for(tier_task, timeout=5.0)
+                logger.info("Tier manager stopped.")
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                logger.info("Tier manager cancelled or timed out.")
+
         try:
             await app.stop()
             logger.info("Bot stopped successfully.")
@@ -80,3 +123,5 @@ if __name__ == "__main__":
         loop.run_until_complete(main())
     except KeyboardInterrupt:
         logger.info("Received KeyboardInterrupt, stopping gracefully...")
+    finally:
+        stop_queue_logging()
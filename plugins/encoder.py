@@ -7,293 +7,535 @@ import time
 import shlex
 import json
 import subprocess
+from collections import deque
 from database.video import insert_video
-from plugins.video import que
+from plugins.video import que, pending_tasks, drop_banned_job, report_done
+from database.bans import is_banned
+from web.tiering import rebuild_finished
+from web.storage import root_of, place, downloads_dir, scratch_dir, originals_dir as storage_originals_dir
+from web.metrics import registry, queue_wait_seconds, stage_seconds, ffmpeg_speed, jobs_total
+from web.jobs import start_job, children_cpu_seconds, wait_child
+from web.protected_page import sign_download_path
+from plugins.governor import governor, run_governor
+from web.logpipe import job_log, FfmpegLog
+from web.subtitles import SUBTITLES_LAZY, TEXT_SUBTITLE_CODECS, convert_track, write_playlist
 from pyrogram.errors import MessageNotModified
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-async def encode_video():
-    while True:
-        video_data = await que.get()
-        file_path = video_data["file_path"]
-        chat_id = video_data["chat_id"]
-        file_name = video_data["file_name"]
-        bot = video_data["bot"]
-        file_id = video_data["file_id"]
-        progress_message = video_data['progress']
-        msg = video_data['msg']
-        unique_id = str(uuid.uuid4())
-        file_path = os.path.abspath(file_path)
-        hls_dir = f"downloads/{file_id}"
-        video_subdir = f"{hls_dir}/video"
-        audio_subdir = f"{hls_dir}/audio"
-        subtitle_subdir = f"{hls_dir}/subtitles"
-        os.makedirs(video_subdir, exist_ok=True)
-        os.makedirs(audio_subdir, exist_ok=True)
-        os.makedirs(subtitle_subdir, exist_ok=True)
-
-        # Define directory for original files
-        originals_dir = os.path.join(os.getcwd(), "originals")
-        os.makedirs(originals_dir, exist_ok=True)
-
-        if not progress_message:
-            logger.warning("No progress message provided, skipping task")
-            await progress_message.edit_text("❌ **Error:** No progress message provided!")
-            que.task_done()
-            continue
+def _tree_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+# Registered here, in the process that owns the queue. serve.py workers have no queue to report.
+queue_depth = registry.gauge("stream_encode_queue_depth", "Jobs waiting in the encode queue", callback=que.qsize)
+
+# CRF for transcodes, capped by the ladder below and by the source bitrate
+ENCODE_CRF = int(os.getenv("ENCODE_CRF", "23"))
+# (max frame height, maxrate in kbit/s at up to 30 fps)
+BITRATE_LADDER = [(480, 1500), (720, 3000), (1080, 6000), (1440, 10000), (100000, 16000)]
+AUDIO_KBPS_PER_CHANNEL = int(os.getenv("AUDIO_KBPS_PER_CHANNEL", "64"))
+HLS_SEGMENT_SECONDS = 5
+# One media file per rendition addressed with EXT-X-BYTERANGE, instead of a file per segment
+HLS_SINGLE_FILE = os.getenv("HLS_SINGLE_FILE", "true").lower() == "true"
+# ffmpeg stderr lines kept per process, and how many of them a failure reports
+FFMPEG_STDERR_TAIL = int(os.getenv("FFMPEG_STDERR_TAIL", "200"))
+FFMPEG_ERROR_LINES = int(os.getenv("FFMPEG_ERROR_LINES", "15"))
+
+
+def hls_output_args(subdir):
+    """Muxer arguments writing one rendition into subdir"""
+    if HLS_SINGLE_FILE:
+        segments = f'-hls_flags single_file -hls_segment_filename {shlex.quote(f"{subdir}/stream.ts")}'
+    else:
+        segments = f'-hls_segment_filename {shlex.quote(f"{subdir}/segment%d.ts")}'
+    return [
+        f'-hls_time {HLS_SEGMENT_SECONDS} -hls_list_size 0 -f hls',
+        segments,
+        f'{shlex.quote(f"{subdir}/playlist.m3u8")}'
+    ]
+
+
+def _probe_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _frame_rate(stream):
+    try:
+        num, den = stream.get('avg_frame_rate', '0/0').split('/')
+        return float(num) / float(den) if float(den) else 0
+    except (ValueError, ZeroDivisionError):
+        return 0
+
+
+def video_rate_control(stream, format_bit_rate=0):
+    """CRF with a maxrate/bufsize cap from resolution and frame rate, never above the source bitrate"""
+    height = _probe_int(stream.get('height'))
+    fps = _frame_rate(stream)
+    maxrate = next(kbps for max_height, kbps in BITRATE_LADDER if height <= max_height)
+    if fps > 30:
+        maxrate = int(maxrate * 1.5)
+    # Stream bit_rate is often missing in MKV, the container total is an upper bound then
+    source_kbps = (_probe_int(stream.get('bit_rate')) or format_bit_rate) // 1000
+    if source_kbps:
+        maxrate = min(maxrate, source_kbps)
+    args = f'-crf {ENCODE_CRF} -maxrate {maxrate}k -bufsize {maxrate * 2}k'
+    if fps:
+        # Keyframes on segment boundaries so every segment starts cleanly
+        args += f' -force_key_frames {shlex.quote(f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})")}'
+    return args
+
+
+def audio_encode_args(i, sample_rate, channels, source_bit_rate=0):
+    """AAC settings for one transcoded track, bitrate scaled with channel count and capped at the source"""
+    channels = min(_probe_int(channels) or 2, 6)
+    kbps = AUDIO_KBPS_PER_CHANNEL * channels
+    if source_bit_rate:
+        kbps = max(32, min(kbps, source_bit_rate // 1000))
+    rate = _probe_int(sample_rate)
+    rate = rate if rate in (44100, 48000) else 48000
+    return f'-c:a:{i} aac -profile:a:{i} aac_low -ar:a:{i} {rate} -ac:a:{i} {channels} -b:a:{i} {kbps}k'
+
+
+def measure_segments(directory):
+    """Segment count and sizes of one rendition, for the job record and the master BANDWIDTH. The peak bitrate
+    is each segment's size over its own #EXTINF duration, copied video cuts on source keyframes, not every
+    HLS_SEGMENT_SECONDS."""
+    sizes = []
+    rates = []
+    byterange = None
+    duration = None
+    with open(os.path.join(directory, 'playlist.m3u8'), 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                try:
+                    duration = float(line.split(':', 1)[1].split(',', 1)[0])
+                except ValueError:
+                    duration = None
+            elif line.startswith('#EXT-X-BYTERANGE:'):
+                byterange = int(line.split(':', 1)[1].split('@', 1)[0])
+            elif line and not line.startswith('#'):
+                size = byterange if byterange is not None else os.path.getsize(os.path.join(directory, line))
+                sizes.append(size)
+                rates.append(size * 8 / (duration if duration and duration > 0 else HLS_SEGMENT_SECONDS))
+                byterange = None
+                duration = None
+    if not sizes:
+        return {"segments": 0, "bytes": 0, "avg_bytes": 0, "max_bytes": 0, "peak_bps": 0}
+    return {
+        "segments": len(sizes),
+        "bytes": sum(sizes),
+        "avg_bytes": sum(sizes) // len(sizes),
+        "max_bytes": max(sizes),
+        "peak_bps": int(max(rates)),
+    }
 
-        if not os.path.exists(file_path):
-            logger.error(f"File missing before encoding: {file_path}")
-            await progress_message.edit_text("❌ **Error:** Input file missing!")
-            que.task_done()
-            continue
 
-        logger.info(f"Processing file: {file_path}")
-        base_message = "📥 **Download Complete**\n⏳ **Progress:** [██████████] 100%**\n\n🚀 Encoding Started..."
-        await progress_message.edit_text(base_message)
-        start_time = time.time()
+def record_stage(job, stage, start, cpu=None, bytes=None, metric_stage=None):
+    """Close a stage on the job timeline and in the stage duration metric. cpu is the stage's own child CPU."""
+    end = time.time()
+    job.add_span(stage, start, end, bytes=bytes, cpu=cpu)
+    if metric_stage:
+        stage_seconds.observe(end - start, stage=metric_stage)
+
+
+async def encode_video():
+    governor_task = asyncio.create_task(run_governor())
+    try:
+        await _encode_loop()
+    finally:
+        governor_task.cancel()
 
+
+async def _encode_loop():
+    while True:
+        video_data = await que.get()
+        if video_data in pending_tasks:
+            pending_tasks.remove(video_data)
+        job = video_data.get('job')
         try:
-            ffmpeg_check = subprocess.run("ffmpeg -version", shell=True, capture_output=True, text=True)
-            if ffmpeg_check.returncode != 0:
-                raise RuntimeError(f"FFmpeg not found: {ffmpeg_check.stderr}")
-
-            probe_cmd = f'ffprobe -v error -show_entries stream=index,codec_type,codec_name,sample_rate,channels -of json {shlex.quote(file_path)}'
-            probe_process = subprocess.run(probe_cmd, shell=True, capture_output=True, text=True)
-            if probe_process.returncode != 0:
-                raise RuntimeError(f"FFprobe failed: {probe_process.stderr}")
-            probe_data = json.loads(probe_process.stdout)
-            streams = probe_data['streams']
-            video_codec = next((s['codec_name'] for s in streams if s['codec_type'] == 'video'), None)
-            audio_streams = [(s['index'], s['codec_name'], s.get('sample_rate', 'N/A'), s.get('channels', 'N/A'))
-                             for s in streams if s['codec_type'] == 'audio']
-            subtitle_streams = [(s['index'], s['codec_name']) for s in streams if s['codec_type'] == 'subtitle']
-            logger.info(f"Video codec: {video_codec}")
-            for idx, codec, sample_rate, channels in audio_streams:
-                logger.info(f"Audio stream {idx}: codec={codec}, sample_rate={sample_rate}, channels={channels}")
-            logger.info(f"Detected {len(audio_streams)} audio streams and {len(subtitle_streams)} subtitle streams")
-
-            # Determine encoding settings
-            video_copy = video_codec in ['h264']
-            audio_copies = [codec in ['aac'] for _, codec, _, _ in audio_streams]
-            video_cmd_parts = [f'ffmpeg -hide_banner -y -i {shlex.quote(file_path)}']
-
-            # Video mapping (output to video_subdir)
-            video_cmd_parts.append('-map 0:v')
-            if video_copy:
-                video_cmd_parts.append('-c:v copy')
-            else:
-                video_cmd_parts.append('-c:v libx264 -preset veryfast')
-            video_cmd_parts.extend([
-                f'-hls_time 5 -hls_list_size 0 -f hls',
-                f'-hls_segment_filename {shlex.quote(f"{video_subdir}/segment%d.ts")}',
-                f'{shlex.quote(f"{video_subdir}/playlist.m3u8")}'
-            ])
-
-            # Audio mapping (output to audio_subdir)
-            audio_cmd_parts = [f'ffmpeg -hide_banner -y -i {shlex.quote(file_path)}']
-            for i, (idx, codec, sample_rate, channels) in enumerate(audio_streams):
-                audio_cmd_parts.append(f'-map 0:a:{i}')
-                if codec in ['aac']:
-                    audio_cmd_parts.append(f'-c:a:{i} copy')
+            file_path = video_data["file_path"]
+            chat_id = video_data["chat_id"]
+            file_name = video_data["file_name"]
+            bot = video_data["bot"]
+            file_id = video_data["file_id"]
+            progress_message = video_data['progress']
+            msg = video_data['msg']
+            # Rebuilds re-encode an evicted video from originals/, it already has a DB row
+            rebuild = video_data.get('rebuild', False)
+            # Banned while waiting in the queue, possibly already cancelled by the ban handler
+            if video_data.get('cancelled') or (msg is not None and is_banned(msg.from_user)):
+                await drop_banned_job(video_data)
+                continue
+            job = video_data.get('job') or start_job(file_id, file_name, video_data.get('user_id'),
+                                                     kind="rebuild" if rebuild else "upload")
+            log = job_log(logger, job)
+            if video_data.get('queued_at'):
+                queue_wait_seconds.observe(time.time() - video_data['queued_at'])
+                job.add_span("queue_wait", video_data['queued_at'], time.time())
+            # Serving comes first: hold the job while the box is overloaded
+            wait_start = time.time()
+            if await governor.wait_for_capacity() > 1:
+                job.add_span("governor_wait", wait_start, time.time())
+            unique_id = str(uuid.uuid4())
+            file_path = os.path.abspath(file_path)
+            # Encode on the storage root the download landed on, into its scratch area, so that publishing
+            # the HLS tree and storing the original are renames on one filesystem
+            root = root_of(file_path) or place(file_id, os.path.getsize(file_path) if os.path.exists(file_path) else 0)
+            final_dir = os.path.join(downloads_dir(root), file_id)
+            hls_dir = os.path.join(scratch_dir(root), file_id)
+            shutil.rmtree(hls_dir, ignore_errors=True)
+            video_subdir = f"{hls_dir}/video"
+            audio_subdir = f"{hls_dir}/audio"
+            subtitle_subdir = f"{hls_dir}/subtitles"
+            os.makedirs(video_subdir, exist_ok=True)
+            os.makedirs(audio_subdir, exist_ok=True)
+            os.makedirs(subtitle_subdir, exist_ok=True)
+
+            # Define directory for original files
+            originals_dir = storage_originals_dir(root)
+            os.makedirs(originals_dir, exist_ok=True)
+
+            if not progress_message:
+                log.warning("No progress message provided, skipping task")
+                await progress_message.edit_text("❌ **Error:** No progress message provided!")
+                continue
+
+            if not os.path.exists(file_path):
+                log.error(f"File missing before encoding: {file_path}")
+                await progress_message.edit_text("❌ **Error:** Input file missing!")
+                await report_done(progress_message, False, "input file missing")
+                job.finish("failed", "Input file missing")
+                continue
+
+            log.info(f"Processing file: {file_path}")
+            base_message = "📥 **Download Complete**\n⏳ **Progress:** [██████████] 100%**\n\n🚀 Encoding Started..."
+            await progress_message.edit_text(base_message)
+            start_time = time.time()
+
+            try:
+                ffmpeg_check = subprocess.run("ffmpeg -version", shell=True, capture_output=True, text=True)
+                if ffmpeg_check.returncode != 0:
+                    raise RuntimeError(f"FFmpeg not found: {ffmpeg_check.stderr}")
+
+                stage_start, cpu_start = time.time(), children_cpu_seconds()
+                probe_cmd = (
+                    'ffprobe -v error -show_entries '
+                    'stream=index,codec_type,codec_name,sample_rate,channels,width,height,avg_frame_rate,bit_rate'
+                    f':format=bit_rate,duration -of json {shlex.quote(file_path)}'
+                )
+                probe_process = subprocess.run(probe_cmd, shell=True, capture_output=True, text=True)
+                if probe_process.returncode != 0:
+                    raise RuntimeError(f"FFprobe failed: {probe_process.stderr}")
+                probe_data = json.loads(probe_process.stdout)
+                streams = probe_data['streams']
+                video_stream = next((s for s in streams if s['codec_type'] == 'video'), {})
+                video_codec = video_stream.get('codec_name')
+                format_bit_rate = _probe_int(probe_data.get('format', {}).get('bit_rate'))
+                try:
+                    media_duration = float(probe_data.get('format', {}).get('duration', 0))
+                except (TypeError, ValueError):
+                    media_duration = 0
+                audio_bit_rates = [_probe_int(s.get('bit_rate')) for s in streams if s['codec_type'] == 'audio']
+                audio_streams = [(s['index'], s['codec_name'], s.get('sample_rate', 'N/A'), s.get('channels', 'N/A'))
+                                 for s in streams if s['codec_type'] == 'audio']
+                subtitle_streams = [(s['index'], s['codec_name']) for s in streams if s['codec_type'] == 'subtitle']
+                log.info(f"Video codec: {video_codec}")
+                for idx, codec, sample_rate, channels in audio_streams:
+                    log.info(f"Audio stream {idx}: codec={codec}, sample_rate={sample_rate}, channels={channels}")
+                log.info(f"Detected {len(audio_streams)} audio streams and {len(subtitle_streams)} subtitle streams")
+                record_stage(job, "probe", stage_start, children_cpu_seconds() - cpu_start, metric_stage="probe")
+
+                # Determine encoding settings
+                video_copy = video_codec in ['h264']
+                audio_copies = [codec in ['aac'] for _, codec, _, _ in audio_streams]
+                video_cmd_parts = [f'ffmpeg -hide_banner -y -i {shlex.quote(file_path)}']
+
+                # Video mapping (output to video_subdir)
+                video_cmd_parts.append('-map 0:v')
+                video_cmd_parts.append(f'-threads {governor.threads()}')
+                if video_copy:
+                    video_cmd_parts.append('-c:v copy')
                 else:
-                    audio_cmd_parts.append(f'-c:a:{i} aac -profile:a:{i} aac_low -ar:a:{i} 44100 -ac:a:{i} 2')
-            audio_cmd_parts.extend([
-                '-vn',  # No video in audio stream
-                f'-hls_time 5 -hls_list_size 0 -f hls',
-                f'-hls_segment_filename {shlex.quote(f"{audio_subdir}/segment%d.ts")}',
-                f'{shlex.quote(f"{audio_subdir}/playlist.m3u8")}'
-            ])
-
-            # Run FFmpeg commands
-            video_cmd = ' '.join(video_cmd_parts)
-            audio_cmd = ' '.join(audio_cmd_parts)
-            logger.info(f"Running FFmpeg video command: {video_cmd}")
-            logger.info(f"Running FFmpeg audio command: {audio_cmd}")
-
-            # Video process
-            video_process = subprocess.Popen(
-                video_cmd,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
-                universal_newlines=True
-            )
-
-            # Audio process (only if audio streams exist)
-            audio_process = None
-            if audio_streams:
-                audio_process = subprocess.Popen(
-                    audio_cmd,
+                    rate_args = video_rate_control(video_stream, format_bit_rate)
+                    log.info(f"Video rate control: {rate_args}")
+                    video_cmd_parts.append(f'-c:v libx264 -preset veryfast {rate_args}')
+                video_cmd_parts.extend(hls_output_args(video_subdir))
+
+                # Audio mapping (output to audio_subdir)
+                audio_cmd_parts = [f'ffmpeg -hide_banner -y -i {shlex.quote(file_path)}']
+                for i, (idx, codec, sample_rate, channels) in enumerate(audio_streams):
+                    audio_cmd_parts.append(f'-map 0:a:{i}')
+                    if codec in ['aac']:
+                        audio_cmd_parts.append(f'-c:a:{i} copy')
+                    else:
+                        audio_cmd_parts.append(audio_encode_args(i, sample_rate, channels, audio_bit_rates[i]))
+                audio_cmd_parts.append('-vn')  # No video in audio stream
+                audio_cmd_parts.extend(hls_output_args(audio_subdir))
+
+                # Run FFmpeg commands
+                video_cmd = ' '.join(video_cmd_parts)
+                audio_cmd = ' '.join(audio_cmd_parts)
+                log.info(f"Running FFmpeg video command: {video_cmd}")
+                log.info(f"Running FFmpeg audio command: {audio_cmd}")
+
+                # Video process
+                stage_start = time.time()
+                video_process = subprocess.Popen(
+                    governor.command(video_cmd),
                     shell=True,
-                    stdout=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
                     stderr=subprocess.PIPE,
                     text=True,
                     bufsize=1,
                     universal_newlines=True
                 )
 
-            async def process_ffmpeg_output(process, stream_type="video"):
-                duration = None
-                last_update = 0
-                stderr_output = []
-                last_progress = -1
-
-                while process.poll() is None:
-                    line = process.stderr.readline().strip()
-                    if line:
-                        stderr_output.append(line)
-                        if "Duration" in line and not duration:
-                            parts = line.split("Duration: ")[1].split(",")[0]
-                            h, m, s = map(float, parts.split(":"))
-                            duration = h * 3600 + m * 60 + s
-                            logger.info(f"Detected {stream_type} duration: {duration} seconds")
-                        current_time = time.time()
-                        if "time=" in line and duration:
-                            time_str = line.split("time=")[1].split(" ")[0]
-                            h, m, s = map(float, time_str.split(":"))
-                            processed_time = h * 3600 + m * 60 + s
-                            progress = min(100, int((processed_time / duration) * 100))
-                            if current_time - last_update >= 3 and progress != last_progress:
-                                bar = "█" * (progress // 10) + "-" * (10 - progress // 10)
-                                try:
-                                    await progress_message.edit_text(
-                                        f"{base_message}\n⏳ **{stream_type.capitalize()} Progress:** [{bar}] {progress}%")
-                                    last_update = current_time
-                                    last_progress = progress
-                                except MessageNotModified:
-                                    pass
-                        elif current_time - start_time > 1 and current_time - last_update >= 3:
-                            elapsed = current_time - start_time
-                            progress = min(100, int((elapsed / 10) * 100))
-                            if progress != last_progress:
-                                bar = "█" * (progress // 10) + "-" * (10 - progress // 10)
+                # Audio process (only if audio streams exist)
+                audio_process = None
+                if audio_streams:
+                    audio_process = subprocess.Popen(
+                        governor.command(audio_cmd),
+                        shell=True,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE,
+                        text=True,
+                        bufsize=1,
+                        universal_newlines=True
+                    )
+
+                async def process_ffmpeg_output(process, stream_type="video"):
+                    span_start = time.time()
+                    duration = None
+                    last_update = 0
+                    # Only the tail is kept, a long encode prints a progress line every half second
+                    stderr_tail = deque(maxlen=FFMPEG_STDERR_TAIL)
+                    full_log = FfmpegLog(job, stream_type)
+                    last_progress = -1
+                    speed = None
+
+                    try:
+                        while True:
+                            # readline blocks until ffmpeg prints, so it runs off the event loop
+                            line = await loop.run_in_executor(None, process.stderr.readline)
+                            if not line:
+                                break
+                            line = line.strip()
+                            if not line:
+                                continue
+                            stderr_tail.append(line)
+                            full_log.write(line)
+                            if "Duration" in line and not duration:
+                                parts = line.split("Duration: ")[1].split(",")[0]
+                                h, m, s = map(float, parts.split(":"))
+                                duration = h * 3600 + m * 60 + s
+                                log.info(f"Detected {stream_type} duration: {duration} seconds")
+                            if "speed=" in line:
+                                speed_str = line.split("speed=")[1].split("x")[0].strip()
                                 try:
-                                    await progress_message.edit_text(
-                                        f"{base_message}\n⏳ **{stream_type.capitalize()} Progress:** [{bar}] {progress}%")
-                                    last_update = current_time
-                                    last_progress = progress
-                                except MessageNotModified:
+                                    speed = float(speed_str)
+                                except ValueError:
                                     pass
-                    await asyncio.sleep(0.1)
-
-                stderr_remaining = process.stderr.read()
-                if stderr_remaining:
-                    stderr_output.append(stderr_remaining.strip())
-                stdout_output = process.stdout.read().strip()
-
-                return_code = process.wait()
-                if return_code != 0:
-                    error_msg = "\n".join(stderr_output) if stderr_output else f"Unknown FFmpeg {stream_type} error"
-                    raise RuntimeError(f"{stream_type.capitalize()} processing failed: {error_msg}")
-
-                if last_progress != 100:
-                    await progress_message.edit_text(
-                        f"{base_message}\n⏳ **{stream_type.capitalize()} Progress:** [██████████] 100%")
-                return stdout_output, "\n".join(stderr_output)
-
-            # Run FFmpeg processes and monitor output
-            video_task = asyncio.create_task(process_ffmpeg_output(video_process, "video"))
-            audio_task = asyncio.create_task(process_ffmpeg_output(audio_process, "audio")) if audio_process else None
-
-            video_stdout, video_stderr = await video_task
-            logger.info(f"FFmpeg video stdout: {video_stdout}")
-            logger.info(f"FFmpeg video stderr: {video_stderr}")
-
-            if audio_task:
-                audio_stdout, audio_stderr = await audio_task
-                logger.info(f"FFmpeg audio stdout: {audio_stdout}")
-                logger.info(f"FFmpeg audio stderr: {audio_stderr}")
-
-            # Extract and convert subtitles
-            for idx, (sub_idx, sub_codec) in enumerate(subtitle_streams):
-                sub_cmd = (
-                    f'ffmpeg -hide_banner -y -i {shlex.quote(file_path)} '
-                    f'-map 0:s:{idx} -c:s webvtt '
-                    f'{shlex.quote(f"{subtitle_subdir}/sub_{idx}.vtt")}'
-                )
-                logger.info(f"Extracting subtitle {idx}: {sub_cmd}")
-                sub_process = subprocess.run(
-                    sub_cmd,
-                    shell=True,
-                    capture_output=True,
-                    text=True
-                )
-                if sub_process.returncode != 0:
-                    logger.warning(f"Subtitle {idx} extraction failed: {sub_process.stderr}")
-
-            # Generate master playlist
-            master_file = f"{hls_dir}/master.m3u8"
-            with open(master_file, 'w') as f:
-                f.write('#EXTM3U\n#EXT-X-VERSION:3\n')
+                            current_time = time.time()
+                            if "time=" in line and duration:
+                                time_str = line.split("time=")[1].split(" ")[0]
+                                h, m, s = map(float, time_str.split(":"))
+                                processed_time = h * 3600 + m * 60 + s
+                                progress = min(100, int((processed_time / duration) * 100))
+                                if current_time - last_update >= 3 and progress != last_progress:
+                                    bar = "█" * (progress // 10) + "-" * (10 - progress // 10)
+                                    try:
+                                        await progress_message.edit_text(
+                                            f"{base_message}\n⏳ **{stream_type.capitalize()} Progress:** [{bar}] {progress}%")
+                                        last_update = current_time
+                                        last_progress = progress
+                                    except MessageNotModified:
+                                        pass
+                            elif current_time - start_time > 1 and current_time - last_update >= 3:
+                                elapsed = current_time - start_time
+                                progress = min(100, int((elapsed / 10) * 100))
+                                if progress != last_progress:
+                                    bar = "█" * (progress // 10) + "-" * (10 - progress // 10)
+                                    try:
+                                        await progress_message.edit_text(
+                                            f"{base_message}\n⏳ **{stream_type.capitalize()} Progress:** [{bar}] {progress}%")
+                                        last_update = current_time
+                                        last_progress = progress
+                                    except MessageNotModified:
+                                        pass
+                        return_code, cpu = await loop.run_in_executor(None, wait_child, process)
+                    finally:
+                        await loop.run_in_executor(None, full_log.close)
+
+                    output_bytes = await loop.run_in_executor(None, _tree_size, f"{hls_dir}/{stream_type}")
+                    record_stage(job, f"ffmpeg_{stream_type}", span_start, cpu, bytes=output_bytes)
+                    if speed is not None:
+                        ffmpeg_speed.observe(speed, stream=stream_type)
+                    if return_code != 0:
+                        error_lines = list(stderr_tail)[-FFMPEG_ERROR_LINES:]
+                        log.error(f"FFmpeg {stream_type} exited with {return_code}, last output:\n" + "\n".join(error_lines))
+                        error_msg = "\n".join(error_lines[-5:]) or f"Unknown FFmpeg {stream_type} error"
+                        raise RuntimeError(f"{stream_type.capitalize()} processing failed: {error_msg}")
+
+                    if last_progress != 100:
+                        await progress_message.edit_text(
+                            f"{base_message}\n⏳ **{stream_type.capitalize()} Progress:** [██████████] 100%")
+                    log.info(f"FFmpeg {stream_type} finished" + (f" at {speed}x" if speed is not None else ""))
+
+                # Run FFmpeg processes and monitor output
+                loop = asyncio.get_running_loop()
+                video_task = asyncio.create_task(process_ffmpeg_output(video_process, "video"))
+                audio_task = asyncio.create_task(process_ffmpeg_output(audio_process, "audio")) if audio_process else None
+
+                await video_task
+                if audio_task:
+                    await audio_task
+                stage_seconds.observe(time.time() - stage_start, stage="encode")
+
+                renditions = {"video": measure_segments(video_subdir)}
                 if audio_streams:
-                    f.write(
-                        '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="Audio 0",DEFAULT=YES,URI="audio/playlist.m3u8"\n')
-                for idx in range(len(subtitle_streams)):
-                    if os.path.exists(f"{subtitle_subdir}/sub_{idx}.vtt"):
+                    renditions["audio"] = measure_segments(audio_subdir)
+                job.details["renditions"] = renditions
+                job.details["source_bytes"] = os.path.getsize(file_path)
+                job.details["video_transcoded"] = not video_copy
+                for rendition, sizes in renditions.items():
+                    log.info(f"{rendition.capitalize()} segments for {file_id}: {sizes}")
+
+                # Segmented WebVTT renditions: subtitles/<n>/playlist.m3u8 with time-aligned segments.
+                # In lazy mode only the playlist is written and serve_hls converts the track on first request.
+                stage_start = time.time()
+                subtitle_tracks = []
+                for idx, (sub_idx, sub_codec) in enumerate(subtitle_streams):
+                    if sub_codec not in TEXT_SUBTITLE_CODECS:
+                        log.warning(f"Skipping subtitle {idx}: {sub_codec} cannot be converted to WebVTT")
+                        continue
+                    track_subdir = f"{subtitle_subdir}/{idx}"
+                    write_playlist(track_subdir, media_duration)
+                    if SUBTITLES_LAZY:
+                        subtitle_tracks.append(idx)
+                        continue
+                    sub_start, sub_cpu_start = time.time(), children_cpu_seconds()
+                    try:
+                        sub_bytes = convert_track(file_path, idx, track_subdir, media_duration)
+                        subtitle_tracks.append(idx)
+                    except RuntimeError as e:
+                        log.warning(str(e))
+                        shutil.rmtree(track_subdir, ignore_errors=True)
+                        sub_bytes = 0
+                    record_stage(job, f"subtitle_{idx}", sub_start, children_cpu_seconds() - sub_cpu_start, bytes=sub_bytes)
+                if subtitle_streams:
+                    stage_seconds.observe(time.time() - stage_start, stage="subtitle")
+
+                # Generate master playlist
+                master_file = f"{hls_dir}/master.m3u8"
+                with open(master_file, 'w') as f:
+                    # EXT-X-BYTERANGE needs version 4
+                    f.write(f'#EXTM3U\n#EXT-X-VERSION:{4 if HLS_SINGLE_FILE else 3}\n')
+                    if audio_streams:
                         f.write(
-                            f'#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="Subtitle {idx}",DEFAULT={"YES" if idx == 0 else "NO"},URI="subtitles/sub_{idx}.vtt"\n')
-                f.write('#EXT-X-STREAM-INF:BANDWIDTH=5000000,AUDIO="audio",SUBTITLES="subs"\n')
-                f.write('video/playlist.m3u8\n')
-
-            with open(master_file, 'r') as f:
-                logger.info(f"Master playlist content:\n{f.read()}")
-
-            logger.info("Processing completed successfully")
-
-            file_size = os.path.getsize(file_path)
-            logger.info(f"Inserting video data into database: {file_id}, {file_name}, {unique_id}")
-            insert_video(msg, file_id, file_name, unique_id)
+                            '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="Audio 0",DEFAULT=YES,URI="audio/playlist.m3u8"\n')
+                    for idx in subtitle_tracks:
+                        f.write(
+                            f'#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="Subtitle {idx}",DEFAULT={"YES" if idx == subtitle_tracks[0] else "NO"},URI="subtitles/{idx}/playlist.m3u8"\n')
+                    # Peak from the measured segments rather than a guess, so players pick renditions sensibly
+                    bandwidth = sum(sizes["peak_bps"] for sizes in renditions.values()) or 5000000
+                    f.write(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},AUDIO="audio",SUBTITLES="subs"\n')
+                    f.write('video/playlist.m3u8\n')
+
+                # Publish: an evicted or half-built tree may still be in the way
+                if os.path.exists(final_dir):
+                    shutil.rmtree(final_dir, ignore_errors=True)
+                os.rename(hls_dir, final_dir)
+                hls_dir = final_dir
+                log.info("Processing completed successfully")
+
+                file_size = os.path.getsize(file_path)
+                if rebuild:
+                    log.info(f"Rebuilt HLS output for {file_id} from {file_path}")
+                    jobs_total.inc(result="rebuilt")
+                    job.finish()
+                    continue
+
+                original_extension = os.path.splitext(file_path)[1]  # Get the file extension (e.g., .mp4)
+                log.info(f"Inserting video data into database: {file_id}, {file_name}, {unique_id}")
+                stage_start = time.time()
+                insert_video(msg, file_id, file_name, unique_id, original_extension)
+                record_stage(job, "db_insert", stage_start, metric_stage="db_insert")
+
+                # Rename and move the original file
+                new_file_name = f"{file_id}{original_extension}"
+                new_file_path = os.path.join(originals_dir, new_file_name)
+
+                stage_start = time.time()
+                try:
+                    shutil.move(file_path, new_file_path)
+                    log.info(f"Renamed and moved original file from {file_path} to {new_file_path}")
+                except Exception as e:
+                    log.error(f"Failed to rename/move original file {file_path} to {new_file_path}: {str(e)}")
+                    # Optionally, you could copy instead of move and delete the original if move fails
+                    shutil.copy2(file_path, new_file_path)
+                    os.remove(file_path)
+                    log.info(f"Copied and deleted original file as fallback: {new_file_path}")
+                record_stage(job, "move_original", stage_start, bytes=file_size)
+
+                await progress_message.edit_text(
+                    f"{base_message}\n"
+                    f"⏳ **Progress:** [██████████] 100%\n"
+                    "✨ **Processing Complete! 🎬**\n\n"
+                    f"**📌 Filename:** `{file_name}`\n"
+                    f"**💾 Size:** `{round(file_size / (1024 * 1024), 2)} MB`\n"
+                    f"**🔗 Stream Now:** [Watch Here](https://media.mehub.in/video/{unique_id})\n"
+                    f"**⬇️ Download:** [MP4](https://media.mehub.in{sign_download_path(unique_id)})\n\n"
+                    f"**🎙️ Audio Tracks:** {len(audio_streams)}\n"
+                    f"**📝 Subtitles:** {len(subtitle_streams)}\n"
+                    "🚀 **Enjoy your video!** 🎉"
+                )
+                await report_done(progress_message, True, f"[Watch Here](https://media.mehub.in/video/{unique_id})")
 
-            # Rename and move the original file
-            original_extension = os.path.splitext(file_path)[1]  # Get the file extension (e.g., .mp4)
-            new_file_name = f"{file_id}{original_extension}"
-            new_file_path = os.path.join(originals_dir, new_file_name)
+                log.info(f"Original file renamed and stored as: {new_file_path}")
+                log.info(f"HLS files retained in: {hls_dir}")
+                jobs_total.inc(result="success")
+                job.finish()
 
-            try:
-                shutil.move(file_path, new_file_path)
-                logger.info(f"Renamed and moved original file from {file_path} to {new_file_path}")
             except Exception as e:
-                logger.error(f"Failed to rename/move original file {file_path} to {new_file_path}: {str(e)}")
-                # Optionally, you could copy instead of move and delete the original if move fails
-                shutil.copy2(file_path, new_file_path)
-                os.remove(file_path)
-                logger.info(f"Copied and deleted original file as fallback: {new_file_path}")
-
-            await progress_message.edit_text(
-                f"{base_message}\n"
-                f"⏳ **Progress:** [██████████] 100%\n"
-                "✨ **Processing Complete! 🎬**\n\n"
-                f"**📌 Filename:** `{file_name}`\n"
-                f"**💾 Size:** `{round(file_size / (1024 * 1024), 2)} MB`\n"
-                f"**🔗 Stream Now:** [Watch Here](https://media.mehub.in/video/{unique_id})\n\n"
-                f"**🎙️ Audio Tracks:** {len(audio_streams)}\n"
-                f"**📝 Subtitles:** {len(subtitle_streams)}\n"
-                "🚀 **Enjoy your video!** 🎉"
-            )
-
-            logger.info(f"Original file renamed and stored as: {new_file_path}")
-            logger.info(f"HLS files retained in: {hls_dir}")
-
+                log.error(f"Error during processing: {str(e)}")
+                jobs_total.inc(result="failed")
+                job.finish("failed", str(e)[-500:])
+                if 'video_task' in locals():
+                    video_task.cancel()
+                if 'audio_task' in locals() and audio_task:
+                    audio_task.cancel()
+                await progress_message.edit_text(
+                    f"{base_message}\n"
+                    f"❌ **Processing Failed!**\n\n"
+                    f"⚠️ Error: `{str(e)}`\n"
+                    "🔄 Retrying might help or check file format."
+                )
+                await report_done(progress_message, False, f"`{str(e)[:100]}`")
+                if os.path.exists(hls_dir):
+                    log.info(f"Cleaning up failed HLS dir: {hls_dir}")
+                    shutil.rmtree(hls_dir, ignore_errors=True)
         except Exception as e:
-            logger.error(f"Error during processing: {str(e)}")
-            if 'video_task' in locals():
-                video_task.cancel()
-            if 'audio_task' in locals() and audio_task:
-                audio_task.cancel()
-            await progress_message.edit_text(
-                f"{base_message}\n"
-                f"❌ **Processing Failed!**\n\n"
-                f"⚠️ Error: `{str(e)}`\n"
-                "🔄 Retrying might help or check file format."
-            )
-            if os.path.exists(hls_dir):
-                logger.info(f"Cleaning up failed HLS dir: {hls_dir}")
-                shutil.rmtree(hls_dir, ignore_errors=True)
-
-        que.task_done()
\ No newline at end of file
+            # Setup before the encode, or the failure report itself. This is the only encoder task, keep it alive.
+            logger.error(f"Encoder failed on {video_data.get('file_id')}: {str(e)}")
+            jobs_total.inc(result="failed")
+            if job is not None and job.finished_at is None:
+                job.finish("failed", str(e)[-500:])
+            try:
+                await report_done(video_data.get('progress'), False, f"`{str(e)[:100]}`")
+            except Exception:
+                pass
+        finally:
+            # Every exit, so a failed rebuild does not keep /video answering "Preparing"
+            if video_data.get('rebuild'):
+                rebuild_finished(video_data['file_id'])
+            que.task_done()
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+import psutil
+from dotenv import load_dotenv
+
+from web.metrics import registry, http_latency
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Cores kept free of ffmpeg for HLS serving and the stats websocket. The first N cores are left alone.
+SERVING_RESERVED_CORES = int(os.getenv("SERVING_RESERVED_CORES", "1"))
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", "10"))
+# "idle" only gets disk time nobody else wants, "best-effort" runs at the lowest best-effort priority
+FFMPEG_IONICE = os.getenv("FFMPEG_IONICE", "best-effort")
+# Load average per core, not counting our own ffmpeg, above which ffmpeg is squeezed onto fewer cores
+# and above which new jobs wait
+GOVERNOR_BUSY_LOAD = float(os.getenv("GOVERNOR_BUSY_LOAD", "0.8"))
+GOVERNOR_PAUSE_LOAD = float(os.getenv("GOVERNOR_PAUSE_LOAD", "1.5"))
+# Below this load per core with no slow requests the reserve is lent to ffmpeg too
+GOVERNOR_IDLE_LOAD = float(os.getenv("GOVERNOR_IDLE_LOAD", "0.2"))
+# Mean HTTP handler latency since the last check that counts as serving being hurt. Only requests served by
+# this process are seen: with PLAYBACK_WORKERS > 0 playback is served by serve.py workers, whose latency is
+# recorded in their own processes, and the governor goes by load average alone.
+GOVERNOR_MAX_LATENCY_MS = float(os.getenv("GOVERNOR_MAX_LATENCY_MS", "200"))
+GOVERNOR_INTERVAL = float(os.getenv("GOVERNOR_INTERVAL", "5"))
+# A job never waits longer than this, so a permanently loaded box still makes progress
+GOVERNOR_MAX_WAIT = float(os.getenv("GOVERNOR_MAX_WAIT", "1800"))
+
+# From coreutils and util-linux, each one is skipped where it is missing
+_NICE = shutil.which("nice")
+_IONICE = shutil.which("ionice")
+_TASKSET = shutil.which("taskset")
+
+LEVELS = ("idle", "normal", "busy", "paused")
+governor_level = registry.gauge("stream_governor_level",
+                                "Encode governor level: 0 idle, 1 normal, 2 busy, 3 paused")
+
+
+class Governor:
+    """Decides how much of the box ffmpeg may use, from load average and HTTP latency"""
+
+    def __init__(self):
+        self.cores = list(range(psutil.cpu_count(logical=True) or 1))
+        self.level = "normal"
+        self._latency_seen = (0, 0.0)
+        self._ffmpeg = {}
+
+    def _recent_latency_ms(self):
+        """Mean handler latency since the previous call, from the metrics histogram. Runs in an executor
+        while the event loop adds route keys, so it reads a snapshot."""
+        series = [list(values) for values in list(http_latency.values.values())]
+        count = sum(sum(values[:-1]) for values in series)
+        total = sum(values[-1] for values in series)
+        seen_count, seen_total = self._latency_seen
+        self._latency_seen = (count, total)
+        if count <= seen_count:
+            return 0.0
+        return (total - seen_total) / (count - seen_count) * 1000
+
+    def _ffmpeg_cores(self):
+        """Cores our own ffmpeg processes are busy on, so encoding does not count as load against itself"""
+        running = {}
+        used = 0.0
+        for child in psutil.Process().children(recursive=True):
+            try:
+                if child.name() != "ffmpeg":
+                    continue
+                # cpu_percent compares against the previous call on the same Process object
+                process = running[child.pid] = self._ffmpeg.get(child.pid, child)
+                used += process.cpu_percent(interval=None) / 100
+            except psutil.Error:
+                pass
+        self._ffmpeg = running
+        return used
+
+    def update(self):
+        load = (os.getloadavg()[0] if hasattr(os, "getloadavg") else psutil.cpu_percent() / 100 * len(self.cores))
+        per_core = max(0.0, load - self._ffmpeg_cores()) / len(self.cores)
+        latency = self._recent_latency_ms()
+        if per_core >= GOVERNOR_PAUSE_LOAD:
+            level = "paused"
+        elif per_core >= GOVERNOR_BUSY_LOAD or latency >= GOVERNOR_MAX_LATENCY_MS:
+            level = "busy"
+        elif per_core <= GOVERNOR_IDLE_LOAD and latency < GOVERNOR_MAX_LATENCY_MS / 4:
+            level = "idle"
+        else:
+            level = "normal"
+        if level != self.level:
+            logger.info(f"Encode governor {self.level} -> {level} (load {per_core:.2f}/core, latency {latency:.0f}ms)")
+            self.level = level
+            self.apply_to_running()
+        governor_level.set(LEVELS.index(level))
+        return level
+
+    def allowed_cores(self):
+        if self.level == "idle" or len(self.cores) <= 1:
+            return self.cores
+        usable = self.cores[min(SERVING_RESERVED_CORES, len(self.cores) - 1):]
+        if self.level in ("busy", "paused"):
+            usable = usable[:max(1, len(usable) // 2)]
+        return usable
+
+    def threads(self):
+        """ffmpeg -threads for a job started now"""
+        return len(self.allowed_cores())
+
+    def apply_to_running(self):
+        """Narrow or widen the CPU affinity of ffmpeg processes that are already encoding"""
+        cores = self.allowed_cores()
+        for child in psutil.Process().children(recursive=True):
+            try:
+                if child.name() == "ffmpeg":
+                    child.cpu_affinity(cores)
+            except (psutil.Error, AttributeError):
+                pass
+
+    def command(self, cmd):
+        """cmd prefixed with nice, ionice and taskset, so the shell and ffmpeg start with the current limits.
+        Wrapper programs rather than a preexec_fn: Python code in the forked child of this threaded process
+        can deadlock on a lock another thread held at fork time."""
+        cores = self.allowed_cores()
+        nice = 0 if self.level == "idle" else FFMPEG_NICE
+        prefix = []
+        if nice and _NICE:
+            prefix.append(f"{_NICE} -n {nice}")
+        if _IONICE:
+            prefix.append(f"{_IONICE} -c 3" if FFMPEG_IONICE == "idle" else f"{_IONICE} -c 2 -n 7")
+        if _TASKSET and len(cores) < len(self.cores):
+            prefix.append(f"{_TASKSET} -c {','.join(str(core) for core in cores)}")
+        return " ".join(prefix + [cmd])
+
+    async def wait_for_capacity(self):
+        """Hold a new job while the box is overloaded. Returns the seconds waited.
+        Reads the level run_governor keeps current, update() has a single caller so its latency deltas hold."""
+        started = time.time()
+        while self.level == "paused":
+            if time.time() - started > GOVERNOR_MAX_WAIT:
+                logger.warning(f"Encode governor still paused after {GOVERNOR_MAX_WAIT}s, starting the job anyway")
+                break
+            await asyncio.sleep(GOVERNOR_INTERVAL)
+        return time.time() - started
+
+
+governor = Governor()
+
+
+async def run_governor():
+    """Re-evaluate the level periodically so running jobs are throttled and released as load changes"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, governor.update)
+        except Exception as e:
+            logger.error(f"Encode governor update failed: {str(e)}")
+        await asyncio.sleep(GOVERNOR_INTERVAL)
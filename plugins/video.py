@@ -1,17 +1,43 @@
 import asyncio
+import logging
+import os
+import time
 from pyrogram import Client, filters
 from pyrogram.types import Message
 import uuid
 
-from database.video import video_exists
+from database.video import video_exists, existing_videos
+from web.metrics import stage_seconds
+from web.jobs import start_job
+from web.storage import ingest_dir
+from database.bans import is_banned
+
+logger = logging.getLogger(__name__)
 
 que = asyncio.Queue()
+# Jobs in que that the encoder has not taken yet
 pending_tasks = []
 
+# Largest batch one /upload may ingest
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "50"))
+# How many downloaded files a batch may keep waiting for the encoder before it pauses downloading
+BATCH_PREFETCH = int(os.getenv("BATCH_PREFETCH", "2"))
+
 
 @Client.on_message(filters.command('upload'))
 async def upload(bot: Client, msg: Message):
+    # Before any lookup or download, a banned user costs one set lookup
+    if is_banned(msg.from_user):
+        return await msg.reply_text("❌ You are not allowed to upload videos.")
+
     replied_message = msg.reply_to_message
+    if len(msg.command) > 1 or (replied_message and replied_message.media_group_id):
+        return await upload_batch(bot, msg)
+
+    if not replied_message or not (replied_message.video or (
+            replied_message.document and (replied_message.document.mime_type or "").startswith("video/"))):
+        return await msg.reply_text("❌ Reply to a video with /upload.")
+
     file_id = None
     file_name = None
 
@@ -22,29 +48,25 @@ async def upload(bot: Client, msg: Message):
         file_id = replied_message.document.file_unique_id
         file_name = replied_message.document.file_name
 
-    exists = video_exists(file_id)
+    exists = await asyncio.get_running_loop().run_in_executor(None, video_exists, file_id)
 
     if exists is not None:
         await msg.reply_text('The file is already available in the database')
         return
 
-    if not replied_message or not (replied_message.video or (
-            replied_message.document and replied_message.document.mime_type.startswith("video/"))):
-        return await msg.reply_text("❌ The replied message does not contain a video.")
-
     queue_position = que.qsize() + 1
     progress_message = await msg.reply_text(f"📥 Queued at position #{queue_position}\nWaiting...")
 
     # Progress variables
     progress_data = {"current": 0, "total": 1}  # Default values
-    stop_progress = False
 
     async def progress_callback(current, total):
         progress_data["current"] = current
         progress_data["total"] = total
 
     async def update_progress():
-        while not stop_progress:
+        # Runs until cancelled once the download ends
+        while True:
             if progress_data["total"] > 1:  # Avoid division by zero
                 percent = (progress_data["current"] / progress_data["total"]) * 100
                 bar_length = 20
@@ -66,10 +88,20 @@ async def upload(bot: Client, msg: Message):
     # Start progress update loop
     progress_task = asyncio.create_task(update_progress())
 
-    file_path = await replied_message.download(progress=progress_callback)
-
-    stop_progress = True  # Stop updating progress once download completes
-    await progress_task  # Wait for the update loop to finish
+    job = start_job(file_id, file_name, msg.from_user.id)
+    download_start = time.time()
+    try:
+        with job.span("download") as span:
+            file_path = await replied_message.download(file_name=ingest_dir(file_id, media_size(replied_message)),
+                                                       progress=progress_callback)
+            span["bytes"] = progress_data["total"]
+    except Exception as e:
+        job.finish("failed", str(e))
+        raise
+    finally:
+        # Also when the download raises, or the update loop would edit the message forever
+        progress_task.cancel()
+    stage_seconds.observe(time.time() - download_start, stage="download")
 
     video_data = {
         "file_id": file_id,
@@ -79,7 +111,9 @@ async def upload(bot: Client, msg: Message):
         "user_id": msg.from_user.id,
         "bot": bot,
         "progress": progress_message,
-        "msg" : msg
+        "msg" : msg,
+        "queued_at": time.time(),
+        "job": job
     }
 
     await que.put(video_data)  # Save in queue
@@ -88,3 +122,223 @@ async def upload(bot: Client, msg: Message):
     await progress_message.edit_text(
         f"✅ Download Complete! 🎉\n📌 Your video is in the queue at position #{queue_position}.\n⚙️ Processing will start soon... Please wait! ⏳"
     )
+
+
+def media_info(message):
+    """(file_id, file_name) of a video or video document, or None"""
+    if message is None or message.empty:
+        return None
+    if message.video:
+        return message.video.file_unique_id, message.video.file_name or f"{message.video.file_unique_id}.mp4"
+    if message.document and (message.document.mime_type or "").startswith("video/"):
+        return message.document.file_unique_id, message.document.file_name or message.document.file_unique_id
+    return None
+
+
+def media_size(message):
+    media = message.video or message.document
+    return (media.file_size or 0) if media else 0
+
+
+async def collect_batch(bot: Client, msg: Message):
+    """Messages named by the command: the replied album, /upload <count> from the replied message,
+    or /upload <first_id>-<last_id> in this chat"""
+    replied_message = msg.reply_to_message
+    if len(msg.command) > 1:
+        arg = msg.command[1]
+        try:
+            if "-" in arg:
+                first, last = (int(part) for part in arg.split("-", 1))
+            else:
+                count = int(arg)
+        except ValueError:
+            raise ValueError("Give a count like /upload 12 or a range like /upload 120-131")
+        if "-" not in arg:
+            if not replied_message:
+                raise ValueError("Reply to the first message, or give a range like /upload 120-131")
+            if count < 1:
+                raise ValueError("The count must be at least 1")
+            first = replied_message.id
+            last = first + count - 1
+        if last < first:
+            first, last = last, first
+        if last - first + 1 > BATCH_MAX_FILES:
+            raise ValueError(f"At most {BATCH_MAX_FILES} messages per batch")
+        return await bot.get_messages(msg.chat.id, list(range(first, last + 1)))
+    return await bot.get_media_group(msg.chat.id, replied_message.id)
+
+
+class BatchProgress:
+    """One status message for a whole batch. Each file gets a line, and edits are throttled to one per few seconds."""
+
+    def __init__(self, message, names):
+        self.message = message
+        self.names = names
+        self.lines = ["⏳ waiting"] * len(names)
+        self.last_edit = 0
+        self.dirty = False
+        # Items downloaded and queued that the encoder has not picked up yet
+        self.waiting = set()
+
+    def item(self, index):
+        return BatchItemProgress(self, index)
+
+    def set(self, index, status):
+        self.lines[index] = status
+        self.dirty = True
+
+    def render(self):
+        done = sum(1 for line in self.lines if line.startswith(("✅", "❌")))
+        rows = [f"{i + 1}. `{name[:40]}` {line}" for i, (name, line) in enumerate(zip(self.names, self.lines))]
+        return f"📦 **Batch:** {done}/{len(self.names)} done\n\n" + "\n".join(rows)
+
+    async def flush(self, force=False):
+        now = time.time()
+        if not self.dirty or (not force and now - self.last_edit < 3):
+            return
+        self.dirty = False
+        self.last_edit = now
+        try:
+            await self.message.edit_text(self.render(), disable_web_page_preview=True)
+        except Exception:
+            pass
+
+
+class BatchItemProgress:
+    """Stands in for a per-file progress message, so encode_video reports into the batch message"""
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    async def edit_text(self, text, **kwargs):
+        # Progress only, the outcome arrives through done()
+        self.batch.waiting.discard(self.index)
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        self.batch.set(self.index, lines[-1] if lines else "")
+        await self.batch.flush()
+
+    async def done(self, ok, detail):
+        self.batch.waiting.discard(self.index)
+        self.batch.set(self.index, f"{'✅' if ok else '❌'} {detail}")
+        await self.batch.flush(force=True)
+
+
+async def report_done(progress, ok, detail):
+    """Tell a progress object how the job ended, for those that track outcomes such as batch items"""
+    done = getattr(progress, "done", None)
+    if done is not None:
+        await done(ok, detail)
+
+
+async def upload_batch(bot: Client, msg: Message):
+    """Ingest an album or a range of messages: one existence query, one status message,
+    and downloads that run ahead of the encoder so the next file is ready when the current one finishes"""
+    try:
+        messages = await collect_batch(bot, msg)
+    except ValueError as e:
+        return await msg.reply_text(f"❌ {str(e)}")
+    except Exception as e:
+        logger.error(f"Failed to collect batch for /upload: {str(e)}")
+        return await msg.reply_text("❌ Could not read the messages for this batch.")
+
+    items = []
+    seen = set()
+    for message in messages:
+        info = media_info(message)
+        if info and info[0] not in seen:
+            seen.add(info[0])
+            items.append((message, *info))
+    if not items:
+        return await msg.reply_text("❌ No videos found in those messages.")
+
+    existing = await asyncio.get_running_loop().run_in_executor(
+        None, existing_videos, [file_id for _, file_id, _ in items])
+    new_items = [item for item in items if item[1] not in existing]
+    if not new_items:
+        return await msg.reply_text("The files are already available in the database")
+
+    progress_message = await msg.reply_text(
+        f"📦 Batch of {len(new_items)} videos queued"
+        + (f", {len(existing)} already uploaded" if existing else "")
+    )
+    batch = BatchProgress(progress_message, [file_name for _, _, file_name in new_items])
+
+    for index, (message, file_id, file_name) in enumerate(new_items):
+        # Keep at most BATCH_PREFETCH of this batch's downloads waiting, so a long batch does not fill the disk.
+        # Counted per batch, other users' queued jobs must not stall it.
+        while len(batch.waiting) >= BATCH_PREFETCH:
+            await asyncio.sleep(1)
+        # A ban while the batch is running stops the remaining downloads
+        if is_banned(msg.from_user):
+            for rest in range(index, len(new_items)):
+                batch.set(rest, "❌ cancelled")
+            await batch.flush(force=True)
+            break
+
+        async def progress_callback(current, total, index=index):
+            if total:
+                batch.set(index, f"📥 {current / total * 100:.0f}%")
+                await batch.flush()
+
+        job = start_job(file_id, file_name, msg.from_user.id)
+        download_start = time.time()
+        try:
+            with job.span("download") as span:
+                file_path = await message.download(file_name=ingest_dir(file_id, media_size(message)),
+                                                   progress=progress_callback)
+                span["bytes"] = os.path.getsize(file_path)
+        except Exception as e:
+            logger.error(f"Batch download of {file_name} failed: {str(e)}")
+            job.finish("failed", str(e))
+            batch.set(index, "❌ download failed")
+            await batch.flush(force=True)
+            continue
+        stage_seconds.observe(time.time() - download_start, stage="download")
+
+        video_data = {
+            "file_id": file_id,
+            "file_name": file_name,
+            "file_path": file_path,
+            "chat_id": msg.chat.id,
+            "user_id": msg.from_user.id,
+            "bot": bot,
+            "progress": batch.item(index),
+            "msg": msg,
+            "queued_at": time.time(),
+            "job": job
+        }
+        batch.waiting.add(index)
+        await que.put(video_data)
+        pending_tasks.append(video_data)
+        batch.set(index, f"⚙️ queued #{que.qsize()}")
+        await batch.flush()
+
+
+async def cancel_banned_jobs() -> int:
+    """Cancel jobs of banned users that are waiting for the encoder: delete their downloads and tell them.
+    The items stay in the queue, the encoder's dequeue check skips them. Returns the number of jobs cancelled."""
+    cancelled = [item for item in list(pending_tasks)
+                 if item.get("msg") and not item.get("cancelled") and is_banned(item["msg"].from_user)]
+    for item in cancelled:
+        pending_tasks.remove(item)
+        await drop_banned_job(item)
+    return len(cancelled)
+
+
+async def drop_banned_job(item):
+    """Settle a banned user's job once, whether the ban handler or the encoder gets to it first"""
+    if item.get("cancelled"):
+        return
+    item["cancelled"] = True
+    if item.get("job"):
+        item["job"].finish("cancelled", "User banned")
+    try:
+        os.remove(item["file_path"])
+    except OSError:
+        pass
+    try:
+        await item["progress"].edit_text("❌ **Cancelled:** uploads from this account are blocked.")
+        await report_done(item["progress"], False, "cancelled")
+    except Exception:
+        pass
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Standalone playback server: runs /hls and /video in worker processes sharing the web port
+# through SO_REUSEPORT, so viewers never wait on the bot or the encoder. Start main.py with
+# PLAYBACK_WORKERS set to the same value so it only serves the control routes.
+workers = int(os.getenv("PLAYBACK_WORKERS", "0")) or os.cpu_count() or 1
+
+
+async def run_worker():
+    import web.tiering
+    from web.initial import start_web_server
+
+    web.tiering.worker_mode = True
+    runner = await start_web_server(routes="playback", reuse_port=True)
+    flush_task = asyncio.create_task(web.tiering.run_access_flusher())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    await stop.wait()
+
+    flush_task.cancel()
+    await runner.cleanup()
+
+
+def worker_main(index):
+    # Each worker writes its logs from its own listener thread
+    from web.logpipe import install_queue_logging
+    install_queue_logging()
+    logger.info(f"Playback worker {index} started (pid {os.getpid()})")
+    asyncio.run(run_worker())
+
+
+def main():
+    processes = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"Starting {workers} playback workers...")
+    while not stopping:
+        for index in range(workers):
+            process = processes.get(index)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                logger.warning(f"Playback worker {index} exited with code {process.exitcode}, restarting")
+            process = multiprocessing.Process(target=worker_main, args=(index,), daemon=True)
+            process.start()
+            processes[index] = process
+        time.sleep(1)
+
+    logger.info("Shutting down playback workers...")
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    for process in processes.values():
+        process.join(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+from database.stats import increment_video_stats, fetch_video_stats
+
+logger = logging.getLogger(__name__)
+
+ACCOUNTING_FLUSH_SECONDS = float(os.getenv("ACCOUNTING_FLUSH_SECONDS", "60"))
+
+# (file_id, UTC day number) -> [views, bytes], only what has not been flushed yet
+counters = {}
+
+
+def record_hls(file_name: str, size: int):
+    """Called from serve_hls per request. A fetch of master.m3u8 counts as one view."""
+    file_id, _, rest = file_name.partition("/")
+    key = (file_id, int(time.time() // 86400))
+    entry = counters.get(key)
+    if entry is None:
+        entry = counters[key] = [0, 0]
+    if rest == "master.m3u8":
+        entry[0] += 1
+    entry[1] += size
+
+
+def _merge(pending):
+    for key, (views, size) in pending.items():
+        entry = counters.setdefault(key, [0, 0])
+        entry[0] += views
+        entry[1] += size
+
+
+async def flush_counters():
+    global counters
+    if not counters:
+        return
+    pending, counters = counters, {}
+    rows = [
+        {
+            "video": file_id,
+            "day": datetime.fromtimestamp(day * 86400, timezone.utc).date().isoformat(),
+            "views": views,
+            "bytes": size,
+        }
+        for (file_id, day), (views, size) in pending.items()
+    ]
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, increment_video_stats, rows)
+    except Exception as e:
+        logger.error(f"Failed to flush {len(rows)} video stats rows, will retry: {str(e)}")
+        _merge(pending)
+
+
+async def start_accounting(app):
+    async def flush_loop():
+        while True:
+            await asyncio.sleep(ACCOUNTING_FLUSH_SECONDS)
+            await flush_counters()
+
+    app['accounting_flusher'] = asyncio.create_task(flush_loop())
+
+
+async def stop_accounting(app):
+    app['accounting_flusher'].cancel()
+    await flush_counters()
+
+
+async def video_totals():
+    """{file_id: {"views": n, "bytes": n}} over all days, including counts not flushed yet"""
+    rows = await asyncio.get_running_loop().run_in_executor(None, fetch_video_stats)
+    totals = {}
+    for row in rows:
+        entry = totals.setdefault(row["video"], {"views": 0, "bytes": 0})
+        entry["views"] += row.get("views") or 0
+        entry["bytes"] += row.get("bytes") or 0
+    for (file_id, _), (views, size) in counters.items():
+        entry = totals.setdefault(file_id, {"views": 0, "bytes": 0})
+        entry["views"] += views
+        entry["bytes"] += size
+    return totals
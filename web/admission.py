@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+import weakref
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Optional JSON file overriding the defaults below, re-read whenever it changes
+LIMITS_FILE = os.getenv("HLS_LIMITS_FILE", os.path.join(os.getcwd(), "hls_limits.json"))
+LIMITS_POLL_SECONDS = float(os.getenv("HLS_LIMITS_POLL_SECONDS", "10"))
+# Behind a proxy the peer address is the proxy, so take the client from the forwarding headers
+TRUST_FORWARDED = os.getenv("HLS_TRUST_FORWARDED", "false").lower() == "true"
+
+# 0 disables a limit. Byte rates are per second, bursts are the bucket size in bytes; a burst of 0 means one
+# second's worth of the rate.
+DEFAULT_LIMITS = {
+    "per_ip_concurrency": int(os.getenv("HLS_PER_IP_CONCURRENCY", "8")),
+    "per_ip_bytes_per_sec": int(os.getenv("HLS_PER_IP_BYTES_PER_SEC", str(4 * 1024 * 1024))),
+    "per_ip_burst_bytes": int(os.getenv("HLS_PER_IP_BURST_BYTES", str(32 * 1024 * 1024))),
+    "per_video_concurrency": int(os.getenv("HLS_PER_VIDEO_CONCURRENCY", "200")),
+    "per_video_bytes_per_sec": int(os.getenv("HLS_PER_VIDEO_BYTES_PER_SEC", "0")),
+    "per_video_burst_bytes": int(os.getenv("HLS_PER_VIDEO_BURST_BYTES", str(256 * 1024 * 1024))),
+}
+
+limits = dict(DEFAULT_LIMITS)
+_limits_mtime = None
+
+
+class TokenBucket:
+    """Byte bucket that may go into debt: a request is admitted while any tokens are left,
+    so segments bigger than the burst still pass, and the debt delays the next one."""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst):
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def retry_after(self, rate):
+        return 0 if self.tokens > 0 else math.ceil(-self.tokens / rate) or 1
+
+
+class _KeyState:
+    __slots__ = ("active", "bucket")
+
+    def __init__(self, burst):
+        self.active = 0
+        self.bucket = TokenBucket(burst)
+
+
+class Limiter:
+    def __init__(self, scope):
+        self.scope = scope
+        self.states = {}
+        self._last_prune = time.monotonic()
+
+    def _limit(self, name):
+        return limits.get(f"per_{self.scope}_{name}", 0)
+
+    def _burst(self):
+        # An empty bucket would reject everything
+        return self._limit("burst_bytes") or self._limit("bytes_per_sec")
+
+    def check(self, key, size, now):
+        """Return seconds to wait, or 0 if the request fits"""
+        concurrency = self._limit("concurrency")
+        rate = self._limit("bytes_per_sec")
+        burst = self._burst()
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = _KeyState(burst)
+        if concurrency and state.active >= concurrency:
+            return 1
+        if rate:
+            state.bucket.refill(rate, burst, now)
+            wait = state.bucket.retry_after(rate)
+            if wait:
+                return wait
+        return 0
+
+    def acquire(self, key, size):
+        state = self.states[key]
+        state.active += 1
+        if self._limit("bytes_per_sec"):
+            state.bucket.tokens -= size
+
+    def release(self, key):
+        state = self.states.get(key)
+        if state is not None:
+            state.active -= 1
+
+    def prune(self, now):
+        """Forget idle keys so a scan over many addresses cannot grow memory forever"""
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        burst = self._burst()
+        rate = self._limit("bytes_per_sec")
+        for key, state in list(self.states.items()):
+            if state.active:
+                continue
+            if rate:
+                state.bucket.refill(rate, burst, now)
+                if state.bucket.tokens < burst:
+                    continue
+            del self.states[key]
+
+
+ip_limiter = Limiter("ip")
+video_limiter = Limiter("video")
+
+
+def client_ip(request):
+    if TRUST_FORWARDED:
+        forwarded = request.headers.get("CF-Connecting-IP") or request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",", 1)[0].strip()
+    return request.remote or "unknown"
+
+
+class Permit:
+    """Held from admission until the response body has been sent"""
+
+    def __init__(self, ip, file_id):
+        self.ip = ip
+        self.file_id = file_id
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            ip_limiter.release(self.ip)
+            video_limiter.release(self.file_id)
+
+
+def admit(request, file_id, size):
+    """Return (permit, None) when the request may proceed, or (None, response) to reject it early"""
+    now = time.monotonic()
+    ip = client_ip(request)
+    ip_limiter.prune(now)
+    video_limiter.prune(now)
+
+    wait = ip_limiter.check(ip, size, now)
+    if wait:
+        return None, web.Response(text="Too many requests", status=429, headers={"Retry-After": str(wait)})
+    wait = video_limiter.check(file_id, size, now)
+    if wait:
+        return None, web.Response(text="Video is busy, retry shortly", status=503,
+                                  headers={"Retry-After": str(wait)})
+
+    ip_limiter.acquire(ip, size)
+    video_limiter.acquire(file_id, size)
+    permit = request['admission_permit'] = Permit(ip, file_id)
+    return permit, None
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """Outermost, so a permit is returned when the handler or a later middleware raises or is cancelled
+    and the response is never prepared"""
+    try:
+        return await handler(request)
+    except BaseException:
+        permit = request.get('admission_permit')
+        if permit is not None:
+            permit.release()
+        raise
+
+
+class AdmittedFileResponse(web.FileResponse):
+    """FileResponse that returns its admission permit once the file has been sent or the client left.
+    A response that is dropped without being prepared returns it when it is collected."""
+
+    def __init__(self, path, permit, **kwargs):
+        super().__init__(path, **kwargs)
+        self._permit = permit
+        weakref.finalize(self, permit.release)
+
+    async def prepare(self, request):
+        try:
+            return await super().prepare(request)
+        finally:
+            self._permit.release()
+
+
+def reload_limits():
+    """Re-read LIMITS_FILE if it changed. Returns True when new limits were applied."""
+    global _limits_mtime
+    try:
+        mtime = os.path.getmtime(LIMITS_FILE)
+    except OSError:
+        mtime = None
+    if mtime == _limits_mtime:
+        return False
+    _limits_mtime = mtime
+
+    new_limits = dict(DEFAULT_LIMITS)
+    if mtime is not None:
+        try:
+            with open(LIMITS_FILE, "r") as f:
+                new_limits.update({k: int(v) for k, v in json.load(f).items() if k in DEFAULT_LIMITS})
+        except Exception as e:
+            logger.error(f"Invalid HLS limits file {LIMITS_FILE}, keeping current limits: {str(e)}")
+            return False
+    limits.clear()
+    limits.update(new_limits)
+    logger.info(f"HLS admission limits: {limits}")
+    return True
+
+
+async def run_limits_watcher(app):
+    async def watch():
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, reload_limits)
+            except Exception as e:
+                logger.error(f"HLS limits reload failed: {str(e)}")
+            await asyncio.sleep(LIMITS_POLL_SECONDS)
+
+    app['limits_watcher'] = asyncio.create_task(watch())
+
+
+async def stop_limits_watcher(app):
+    app['limits_watcher'].cancel()
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import shlex
+import struct
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from web.home import fetch_video_details, _range_length
+from web.protected_page import public, check_auth, verify_download_signature
+from web.storage import find_original, mp4_path
+from plugins.governor import governor
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Remuxed faststart copies of originals that cannot be served as they are live in <root>/mp4/ of the
+# storage pool, next to the original, and are evicted by the tier manager
+MP4_RETRY_AFTER = int(os.getenv("MP4_RETRY_AFTER", "30"))
+MP4_EXTENSIONS = {".mp4", ".m4v"}
+# How long a failed remux is not retried, download managers retry a 503 aggressively
+MP4_FAILED_SECONDS = int(os.getenv("MP4_FAILED_SECONDS", "3600"))
+
+# file_ids being remuxed by this process
+preparing = set()
+# file_id -> time its remux failed in this process
+failed = {}
+# One remux at a time, on its own thread so it never holds the executor the DB calls use
+_prepare_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mp4")
+
+
+def is_faststart(path: str) -> bool:
+    """True when the moov atom comes before mdat, so players and download tools can start from the front"""
+    try:
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, kind = struct.unpack(">I4s", header)
+                if size == 0 or 1 < size < 8:
+                    return False
+                if kind == b"moov":
+                    return True
+                if kind == b"mdat":
+                    return False
+                if size == 1:
+                    size = struct.unpack(">Q", f.read(8))[0] - 8
+                f.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+def downloadable_file(file_id: str):
+    """Path of an MP4 that can be sent as is, or None if one has to be prepared first"""
+    copy = mp4_path(file_id)
+    if os.path.exists(copy):
+        # Keeps a copy in use from being evicted, the tier manager goes by modification time
+        os.utime(copy)
+        return copy
+    original = find_original(file_id)
+    if original and os.path.splitext(original)[1].lower() in MP4_EXTENSIONS and is_faststart(original):
+        return original
+    return None
+
+
+def prepare_mp4(file_id: str):
+    """Blocking: remux the original into a faststart MP4. Only stream copy, a serving process never transcodes;
+    audio that MP4 cannot carry is dropped rather than re-encoded."""
+    if downloadable_file(file_id):
+        return
+    original = find_original(file_id)
+    if not original:
+        raise FileNotFoundError(f"No original for {file_id}")
+    target = mp4_path(file_id)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Other serve.py workers may race on the same file, each writes its own temp file
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    base = f'ffmpeg -hide_banner -loglevel error -y -i {shlex.quote(original)} -map 0:v:0 -sn -c copy'
+    out = f'-movflags +faststart -f mp4 {shlex.quote(tmp_path)}'
+    for streams in ('-map 0:a?', '-an'):
+        cmd = f'{base} {streams} {out}'
+        logger.info(f"Preparing download for {file_id}: {cmd}")
+        # Same nice, affinity and I/O priority as encodes, so a remux does not compete with playback
+        process = subprocess.run(governor.command(cmd), shell=True, capture_output=True, text=True)
+        if process.returncode == 0:
+            os.replace(tmp_path, target)
+            return
+        logger.warning(f"MP4 remux of {file_id} with {streams} failed: {process.stderr[-500:]}")
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+    raise RuntimeError(f"Could not remux {file_id} into an MP4")
+
+
+def _prepared(future, file_id):
+    preparing.discard(file_id)
+    if future.exception() is not None:
+        failed[file_id] = time.time()
+        logger.error(f"Download preparation failed: {str(future.exception())}")
+    else:
+        failed.pop(file_id, None)
+
+
+def _attachment(title: str) -> str:
+    name = (title or "video").rsplit(".", 1)[0] + ".mp4"
+    fallback = "".join(c if c.isascii() and c.isprintable() and c not in '"\\' else "_" for c in name)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name)}"
+
+
+@public
+async def serve_download(request):
+    """/download/{token}: faststart MP4 of a video, for admins or with a signed ?expires=&sig= link.
+    FileResponse handles Range and If-Range with 206 responses and sends through sendfile."""
+    try:
+        token = request.match_info.get('token')
+        if not check_auth(request) and not verify_download_signature(
+                token, request.query.get('expires', ''), request.query.get('sig', '')):
+            return web.Response(text="Invalid or expired link", status=403)
+
+        video_details = await fetch_video_details(token)
+        if not video_details or not video_details.get("video"):
+            return web.Response(text="Invalid token or video not found", status=404)
+        file_id = video_details["video"]
+
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(None, downloadable_file, file_id)
+        if path is None:
+            if not await loop.run_in_executor(None, find_original, file_id):
+                return web.Response(text="Video files not found", status=404)
+            if time.time() - failed.get(file_id, 0) < MP4_FAILED_SECONDS:
+                return web.Response(text="This video cannot be downloaded as an MP4", status=415)
+            if file_id not in preparing:
+                preparing.add(file_id)
+                loop.run_in_executor(_prepare_executor, prepare_mp4, file_id).add_done_callback(
+                    lambda future: _prepared(future, file_id))
+            return web.Response(text="Preparing download, retry shortly", status=503,
+                                headers={'Retry-After': str(MP4_RETRY_AFTER)})
+
+        size = os.stat(path).st_size
+        request['response_bytes'] = _range_length(request, size)
+        return web.FileResponse(path, headers={
+            'Content-Type': 'video/mp4',
+            'Content-Disposition': _attachment(video_details.get('title')),
+            'Accept-Ranges': 'bytes',
+        })
+    except Exception as e:
+        logger.error(f"Error serving download: {str(e)}")
+        return web.Response(text=f"Error serving download: {str(e)}", status=500)
@@ -0,0 +1,98 @@
+import os
+import time
+from array import array
+
+# Series kept for the /server dashboard charts
+HISTORY_FIELDS = (
+    'cpu', 'ram', 'disk', 'load_avg',
+    'bandwidth_sent_rate_mb', 'bandwidth_recv_rate_mb',
+    'connections', 'queue_depth', 'ffmpeg_jobs', 'loop_lag_max_ms',
+)
+
+
+def _parse_tiers(spec):
+    """Parse "2:3600,60:604800" into [(2, 1800), (60, 10080)] as (step seconds, number of slots)"""
+    tiers = []
+    for part in spec.split(','):
+        step, span = part.split(':')
+        tiers.append((float(step), int(float(span) // float(step))))
+    return sorted(tiers)
+
+
+# 2 s for an hour and 1 min for a week by default, about 0.5 MB in total
+HISTORY_TIERS = _parse_tiers(os.getenv("STATS_HISTORY_TIERS", "2:3600,60:604800"))
+
+
+class RingBuffer:
+    """Fixed-memory time series at one resolution. Samples landing in the same step are averaged."""
+
+    def __init__(self, step, slots, fields=HISTORY_FIELDS):
+        self.step = step
+        self.slots = slots
+        self.fields = fields
+        self.timestamps = array('d', bytes(8 * slots))
+        self.values = {name: array('f', bytes(4 * slots)) for name in fields}
+        self.head = 0
+        self.count = 0
+        self._bucket = None
+        self._sums = dict.fromkeys(fields, 0.0)
+        self._samples = 0
+
+    def add(self, timestamp, sample):
+        bucket = int(timestamp // self.step)
+        if self._bucket is not None and bucket != self._bucket:
+            self._flush()
+        self._bucket = bucket
+        for name in self.fields:
+            self._sums[name] += float(sample.get(name) or 0)
+        self._samples += 1
+
+    def _flush(self):
+        if not self._samples:
+            return
+        self.timestamps[self.head] = self._bucket * self.step
+        for name in self.fields:
+            self.values[name][self.head] = self._sums[name] / self._samples
+            self._sums[name] = 0.0
+        self._samples = 0
+        self.head = (self.head + 1) % self.slots
+        self.count = min(self.count + 1, self.slots)
+
+    @property
+    def span(self):
+        return self.step * self.slots
+
+    def range(self, start, end):
+        """Return the stored points with start <= timestamp <= end, oldest first"""
+        first = (self.head - self.count) % self.slots
+        timestamps = []
+        series = {name: [] for name in self.fields}
+        for offset in range(self.count):
+            i = (first + offset) % self.slots
+            ts = self.timestamps[i]
+            if ts < start or ts > end:
+                continue
+            timestamps.append(ts)
+            for name in self.fields:
+                series[name].append(round(self.values[name][i], 3))
+        return {'step': self.step, 'timestamps': timestamps, 'series': series}
+
+
+class StatsHistory:
+    """One ring buffer per resolution, all fed from the same samples"""
+
+    def __init__(self, tiers=HISTORY_TIERS):
+        self.buffers = [RingBuffer(step, slots) for step, slots in tiers]
+
+    def add(self, timestamp, sample):
+        for buffer in self.buffers:
+            buffer.add(timestamp, sample)
+
+    def query(self, start, end):
+        """Use the finest resolution that still reaches back to start. One step of slack, so a range computed
+        from a slightly earlier now, such as the default hour, still gets the tier whose span is that hour."""
+        reach = time.time() - start
+        for buffer in self.buffers:
+            if buffer.span + buffer.step >= reach:
+                return buffer.range(start, end)
+        return self.buffers[-1].range(start, end)
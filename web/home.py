@@ -1,4 +1,7 @@
+import asyncio
+import html
 import os
+import time
 import uuid
 from aiohttp import web
 from typing import Optional, Dict, Any
@@ -6,48 +9,38 @@ import logging
 
 from dotenv import load_dotenv
 
-from database.spbase import supabase
+from database.video import fetch_stream_row
+from web.tiering import record_access, hls_ready, request_rebuild
+from web.metrics import record_cache
+from web.protected_page import public, sign_hls_path, verify_hls_signature, HLS_URL_BUCKET
+from web.templates import player_template, video_template, player_cache, CachedPage, PLAYER_CACHE_TTL
+from web.admission import admit, AdmittedFileResponse
+from web.accounting import record_hls
+from web.subtitles import lazy_segment_track, ensure_track
+from web.storage import hls_dir
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 load_dotenv()
-BASE_DIR = os.path.join(os.getcwd(), "downloads")
 logo_url = os.getenv("LOGO", "https://example.com/default-logo.png")
 
-if not os.path.exists(BASE_DIR):
-    os.makedirs(BASE_DIR)
+PLAYER_HEADERS = {'X-Frame-Options': 'ALLOWALL', 'Cache-Control': 'public, max-age=300'}
 
 
 async def hello(request):
     """Serve the basic HTML page"""
     try:
-        file_path = os.path.join(os.path.dirname(__file__), "video.html")
-        if not os.path.exists(file_path):
-            return web.Response(text="Video HTML template not found", status=404)
-
-        with open(file_path, "r", encoding="utf-8") as f:
-            html_content = f.read()
-        return web.Response(text=html_content, content_type="text/html")
+        return web.Response(text=video_template.source(), content_type="text/html")
     except Exception as e:
         logger.error(f"Error loading page: {str(e)}")
         return web.Response(text=f"Error loading page: {str(e)}", status=500)
 
 
 async def fetch_video(id: uuid.UUID) -> Optional[Dict[str, Any]]:
-    """Fetch video details from Supabase stream table by token"""
+    """Fetch video details by token, from the local replica of the stream table once it has synced.
+    In an executor: the replica read can wait on its lock during a resync, or fall back to Supabase."""
     try:
-        # For supabase-py v2.x.x with async support
-        response = supabase.table("stream") \
-            .select("*") \
-            .eq("token", str(id)) \
-            .limit(1)
-
-        # Execute the query synchronously since execute() might not be awaitable
-        result = response.execute()
-
-        if result.data and len(result.data) > 0:
-            return result.data[0]  # Return first item directly
-        return None
+        return await asyncio.get_running_loop().run_in_executor(None, fetch_stream_row, id)
     except Exception as e:
         logger.error(f"Error fetching video with token {id}: {str(e)}")
         raise
@@ -73,24 +66,101 @@ async def fetch_video_details(token: str) -> Optional[Dict[str, Any]]:
         return None
 
 
+def _range_length(request, size):
+    """Bytes a FileResponse will send for this request's Range header, or size for a full response"""
+    try:
+        byte_range = request.http_range
+    except ValueError:
+        return size
+    start, stop = byte_range.start, byte_range.stop
+    if start is None:
+        return size
+    if start < 0:
+        return min(size, -start)
+    stop = size if stop is None else min(size, stop)
+    return max(0, stop - start)
+
+
 async def serve_hls(request):
-    """Serve HLS .m3u8 and .ts files from the downloads folder"""
+    """Serve HLS .m3u8 and .ts files from the storage root holding the video. Single-file renditions are
+    read with Range requests, which FileResponse answers with 206 and sendfile."""
     try:
         file_name = request.match_info.get('file', 'output.m3u8')
-        file_path = os.path.join(BASE_DIR, file_name)
-
-        if not os.path.exists(file_path):
-            logger.warning(f"File not found: {file_name}")
+        parts = file_name.split('/')
+        if '..' in parts:
+            return web.Response(text="Invalid path", status=400)
+        file_id, _, relative_path = file_name.partition('/')
+        # Empty segments would make relative_path absolute, and os.path.join would drop the HLS root
+        if len(parts) < 2 or '' in parts or file_id.startswith('.') or os.path.isabs(relative_path):
+            return web.Response(text=f"File not found: {file_name}", status=404)
+        video_root = os.path.realpath(hls_dir(file_id))
+        file_path = os.path.realpath(os.path.join(video_root, relative_path))
+        if os.path.commonpath([file_path, video_root]) != video_root:
             return web.Response(text=f"File not found: {file_name}", status=404)
 
-        content_type = ('application/vnd.apple.mpegurl' if file_name.endswith('.m3u8')
-                        else 'video/mp2t')
-        return web.FileResponse(file_path, headers={'Content-Type': content_type})
+        try:
+            file_size = os.stat(file_path).st_size
+        except FileNotFoundError:
+            # Subtitle tracks encoded in lazy mode are converted on their first request
+            track = lazy_segment_track(file_name)
+            if track is None or not await asyncio.get_running_loop().run_in_executor(None, ensure_track, *track):
+                return web.Response(text=f"File not found: {file_name}", status=404)
+            try:
+                file_size = os.stat(file_path).st_size
+            except FileNotFoundError:
+                # A segment index past the end of the converted track
+                return web.Response(text=f"File not found: {file_name}", status=404)
+
+        send_size = _range_length(request, file_size)
+        permit, rejection = admit(request, file_id, send_size)
+        if rejection is not None:
+            return rejection
+
+        record_access(file_name)
+        record_hls(file_name, send_size)
+        request['response_bytes'] = send_size
+        if file_name.endswith('.m3u8'):
+            content_type = 'application/vnd.apple.mpegurl'
+        elif file_name.endswith('.vtt'):
+            content_type = 'text/vtt'
+        else:
+            content_type = 'video/mp2t'
+        return AdmittedFileResponse(file_path, permit,
+                                    headers={'Content-Type': content_type, 'Accept-Ranges': 'bytes'})
     except Exception as e:
         logger.error(f"Error serving HLS file: {str(e)}")
+        if request.get('admission_permit') is not None:
+            request['admission_permit'].release()
         return web.Response(text=f"Error serving HLS file: {str(e)}", status=500)
 
 
+@public
+async def serve_signed_hls(request):
+    """Public playback route, /s/{expires}/{signature}/{file_id}/... signed by serve_video_player"""
+    file_name = request.match_info.get('file', '')
+    if not verify_hls_signature(file_name.split('/', 1)[0], request.match_info['expires'],
+                                request.match_info['signature']):
+        return web.Response(text="Invalid or expired link", status=403)
+    return await serve_hls(request)
+
+
+def render_player_page(token, video_details, autoplay=False):
+    """Render the player for a stream row and put it in player_cache"""
+    video_title = video_details.get('title') or 'Video Player'
+    html_content = player_template.render(
+        title=html.escape(video_title),
+        hls_path=sign_hls_path(video_details['video']),
+        logo_url=html.escape(logo_url),
+        autoplay=str(autoplay).lower()
+    )
+    # Valid until the signed HLS path in it changes, and briefly, so deletions reach other processes
+    expires_at = min((int(time.time()) // HLS_URL_BUCKET + 1) * HLS_URL_BUCKET, time.time() + PLAYER_CACHE_TTL)
+    page = CachedPage(html_content, expires_at, PLAYER_HEADERS)
+    player_cache.put((token, autoplay), page)
+    return page
+
+
+@public
 async def serve_video_player(request):
     try:
         token = request.match_info.get('token')
@@ -98,6 +168,14 @@ async def serve_video_player(request):
             logger.warning("Token is required")
             return web.Response(text="Token is required", status=400)
 
+        should_autoplay = request.query.get('play', '').lower() == 'true'
+        # No readiness check on a hit, that is a stat per storage root on the event loop. An evicted tree
+        # shows up as 404s from serve_hls until the page expires and the slow path rebuilds it.
+        page = player_cache.get((token, should_autoplay))
+        record_cache("player_page", page is not None)
+        if page is not None:
+            return page.response(request)
+
         video_details = await fetch_video_details(token)
         if not video_details:
             logger.warning(f"Video not found for token: {token}")
@@ -108,311 +186,24 @@ async def serve_video_player(request):
             logger.warning(f"Video ID not found in details for token: {token}")
             return web.Response(text="Video ID not found in details", status=404)
 
-        should_autoplay = request.query.get('play', '').lower() == 'true'
-
-        hls_path = f"/hls/{video_id}/master.m3u8"
-        video_title = video_details.get('title', 'Video Player')
-
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>{video_title}</title>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <link href="https://vjs.zencdn.net/8.10.0/video-js.css" rel="stylesheet" />
-            <script src="https://vjs.zencdn.net/8.10.0/video.min.js"></script>
-            <style>
-                body {{ 
-                    margin: 0; 
-                    padding: 0; 
-                    background: #000; 
-                    overflow: hidden;
-                }}
-                .video-container {{
-                    position: relative;
-                }}
-                .video-js {{ 
-                    width: 100%; 
-                    height: 100%;
-                    border-radius: 0;
-                }}
-                .vjs-control-bar {{
-                    background: linear-gradient(to top, rgba(0,0,0,0.9), rgba(0,0,0,0.7));
-                    height: 3.5em;
-                    padding: 0 10px;
-                }}
-                .vjs-progress-control {{
-                    flex: 1;
-                    margin: 0 10px;
-                }}
-                .vjs-progress-holder {{
-                    height: 6px !important;
-                    background: rgba(255, 255, 255, 0.2) !important;
-                    border-radius: 3px;
-                    overflow: hidden;
-                    position: relative;
-                    transition: all 0.2s ease;
-                }}
-                .vjs-progress-holder:hover {{
-                    height: 8px !important;
-                }}
-                .vjs-load-progress {{
-                    background: rgba(255, 255, 255, 0.4) !important;
-                }}
-                .vjs-play-progress {{
-                    background: linear-gradient(90deg, #ff416c, #ff4b2b) !important;
-                    border-radius: 3px;
-                    position: relative;
-                }}
-                .vjs-play-progress:before {{
-                    content: '';
-                    position: absolute;
-                    right: -6px;
-                    top: 50%;
-                    transform: translateY(-50%);
-                    width: 12px;
-                    height: 12px;
-                    background: #fff;
-                    border-radius: 50%;
-                    box-shadow: 0 0 4px rgba(0,0,0,0.5);
-                    transition: all 0.2s ease;
-                }}
-                .vjs-progress-holder:hover .vjs-play-progress:before {{
-                    width: 14px;
-                    height: 14px;
-                }}
-                .vjs-volume-panel .vjs-volume-bar {{
-                    background: #fff;
-                }}
-                .vjs-button > .vjs-icon-placeholder:before {{
-                    color: #fff;
-                }}
-                .vjs-menu-button-popup .vjs-menu .vjs-menu-content {{
-                    background-color: rgba(0, 0, 0, 0.8);
-                    color: #fff;
-                }}
-                .vjs-menu-button-popup .vjs-menu .vjs-menu-item:hover {{
-                    background-color: #ff416c;
-                }}
-                .logo {{
-                    position: absolute;
-                    top: 1vw;
-                    right: 1vw;
-                    width: 5vw;
-                    max-width: 50px;
-                    min-width: 20px;
-                    opacity: 0.5;
-                    pointer-events: none;
-                    z-index: 1000;
-                    transition: opacity 0.3s ease;
-                }}
-                .logo:hover {{
-                    opacity: 0.8;
-                }}
-                @media (max-width: 600px) {{
-                    .logo {{
-                        top: 0.5vw;
-                        right: 0.5vw;
-                        width: 6vw;
-                    }}
-                }}
-                .vjs-error-display {{
-                    color: #ff4444;
-                    text-align: center;
-                }}
-                .video-title {{
-                    position: absolute;
-                    top: 10px;
-                    left: 10px;
-                    color: #fff;
-                    font-family: Arial, sans-serif;
-                    font-size: 16px;
-                    padding: 5px 10px;
-                    background: linear-gradient(to top, rgba(0,0,0,0.9), rgba(0,0,0,0.7));
-                    border-radius: 3px;
-                    opacity: 0;
-                    z-index: 1000;
-                    transition: opacity 0.3s ease;
-                }}
-                .vjs-control-bar:not(.vjs-hidden) ~ .video-title {{
-                    opacity: 1;
-                }}
-                .seek-info {{
-                    position: absolute;
-                    top: 50%;
-                    left: 50%;
-                    transform: translate(-50%, -50%);
-                    color: #fff;
-                    font-family: Arial, sans-serif;
-                    font-size: 24px;
-                    padding: 10px 20px;
-                    background: rgba(0, 0, 0, 0.8);
-                    border-radius: 5px;
-                    opacity: 0;
-                    z-index: 1000;
-                    pointer-events: none;
-                    transition: opacity 0.3s ease, transform 0.3s ease;
-                }}
-                .seek-info.show {{
-                    opacity: 1;
-                    transform: translate(-50%, -60%);
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="video-container">
-                <video id="video-player" class="video-js" controls preload="metadata">
-                    <source src="{hls_path}" type="application/x-mpegURL">
-                    Your browser does not support the video tag.
-                </video>
-                <img src="{logo_url}" class="logo" alt="Logo" onerror="this.style.display='none'">
-                <div class="video-title">{video_title}</div>
-                <div class="seek-info" id="seek-info"></div>
-            </div>
-            <script>
-                const player = videojs('video-player', {{
-                    fluid: true,
-                    responsive: true,
-                    autoplay: {str(should_autoplay).lower()},
-                    muted: {str(should_autoplay).lower()},
-                    html5: {{
-                        hls: {{
-                            enableLowInitialPlaylist: true
-                        }}
-                    }},
-                    controlBar: {{
-                        volumePanel: {{ inline: true }},
-                        fullscreenToggle: true,
-                        pictureInPictureToggle: true,
-                        currentTimeDisplay: true,
-                        timeDivider: true,
-                        durationDisplay: true,
-                        remainingTimeDisplay: false,
-                        progressControl: {{
-                            seekBar: true
-                        }},
-                        audioTrackButton: true,
-                        textTrackButton: true
-                    }}
-                }});
-
-                player.on('error', function() {{
-                    player.errorDisplay.open();
-                }});
-
-                player.ready(function() {{
-                    // Only attempt to play if autoplay is explicitly enabled
-                    if ({str(should_autoplay).lower()}) {{
-                        player.play().catch(function(err) {{
-                            console.log('Autoplay failed:', err);
-                        }});
-                    }}
-
-                    player.on('loadedmetadata', function() {{
-                        const audioTracks = player.audioTracks();
-                        if (audioTracks && audioTracks.length > 0) {{
-                            console.log('Audio tracks available:', audioTracks.length);
-                            for (let i = 0; i < audioTracks.length; i++) {{
-                                const track = audioTracks[i];
-                                console.log('Audio track:', track.label, track.enabled);
-                            }}
-                        }} else {{
-                            console.log('No audio tracks detected');
-                        }}
-
-                        const textTracks = player.textTracks();
-                        if (textTracks && textTracks.length > 0) {{
-                            console.log('Subtitle tracks available:', textTracks.length);
-                            for (let i = 0; i < textTracks.length; i++) {{
-                                const track = textTracks[i];
-                                console.log('Subtitle track:', track.label, track.mode);
-                                if (track.mode === 'showing') {{
-                                    track.mode = 'showing';
-                                }}
-                            }}
-                        }} else {{
-                            console.log('No subtitle tracks detected');
-                        }}
-                    }});
-
-                    player.audioTracks().addEventListener('change', function() {{
-                        const tracks = player.audioTracks();
-                        const activeTrack = Array.from(tracks).find(track => track.enabled);
-                        console.log('Switched to audio track:', activeTrack ? activeTrack.label : 'None');
-                    }});
-
-                    player.textTracks().addEventListener('change', function() {{
-                        const tracks = player.textTracks();
-                        const activeTrack = Array.from(tracks).find(track => track.mode === 'showing');
-                        console.log('Switched to subtitle track:', activeTrack ? activeTrack.label : 'None');
-                    }});
-                }});
-
-                let lastTap = 0;
-                player.on('touchend', function(e) {{
-                    const now = Date.now();
-                    const timeSinceLastTap = now - lastTap;
-                    const videoRect = player.el().getBoundingClientRect();
-                    const tapX = e.changedTouches[0].clientX - videoRect.left;
-
-                    if (timeSinceLastTap < 300 && timeSinceLastTap > 0) {{
-                        const seekTime = tapX < videoRect.width / 2 ? -10 : 10;
-                        player.currentTime(player.currentTime() + seekTime);
-                        showSeekInfo(seekTime);
-                    }}
-                    lastTap = now;
-                }});
-
-                let isDragging = false;
-                let startX, startTime;
-                player.on('touchstart', function(e) {{
-                    isDragging = true;
-                    startX = e.touches[0].clientX;
-                    startTime = player.currentTime();
-                }});
-
-                player.on('touchmove', function(e) {{
-                    if (!isDragging) return;
-                    const videoRect = player.el().getBoundingClientRect();
-                    const currentX = e.touches[0].clientX;
-                    const deltaX = currentX - startX;
-                    const duration = player.duration() || 0;
-                    const seekRange = duration * (deltaX / videoRect.width);
-                    const newTime = Math.max(0, Math.min(duration, startTime + seekRange));
-                    player.currentTime(newTime);
-                }});
-
-                player.on('touchend', function() {{
-                    if (isDragging) {{
-                        const seekTime = player.currentTime() - startTime;
-                        if (Math.abs(seekTime) > 1) {{
-                            showSeekInfo(seekTime);
-                        }}
-                    }}
-                    isDragging = false;
-                }});
-
-                function showSeekInfo(seekTime) {{
-                    const seekInfo = document.getElementById('seek-info');
-                    seekInfo.textContent = (seekTime > 0 ? '+' : '') + Math.round(seekTime) + 's';
-                    seekInfo.classList.add('show');
-                    setTimeout(() => {{
-                        seekInfo.classList.remove('show');
-                    }}, 1000);
-                }}
-
-                player.on('loadedmetadata', function() {{
-                    document.querySelector('.logo').style.zIndex = '1000';
-                    document.querySelector('.video-title').style.zIndex = '1000';
-                }});
-            </script>
-        </body>
-        </html>
-        """
-        response = web.Response(text=html_content, content_type='text/html')
-        response.headers['X-Frame-Options'] = 'ALLOWALL'
-        return response
+        ready = await asyncio.get_running_loop().run_in_executor(None, hls_ready, video_id)
+        record_cache("hls_tier", ready)
+        if not ready:
+            # HLS output was evicted to cold storage, bring it back from the original
+            if await request_rebuild(video_id, video_details.get('title', video_id)):
+                return web.Response(
+                    text="<html><head><meta http-equiv=\"refresh\" content=\"30\"></head>"
+                         "<body style=\"background:#000;color:#fff;font-family:Arial,sans-serif\">"
+                         "Preparing video, this page will refresh automatically...</body></html>",
+                    content_type='text/html',
+                    status=503,
+                    headers={'Retry-After': '30'}
+                )
+            logger.warning(f"HLS output missing and no original to rebuild from: {video_id}")
+            return web.Response(text="Video files not found", status=404)
+
+        page = render_player_page(token, video_details, should_autoplay)
+        return page.response(request)
     except Exception as e:
         logger.error(f"Error serving video player: {str(e)}")
         return web.Response(text=f"Error serving video player: {str(e)}", status=500)
\ No newline at end of file
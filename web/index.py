@@ -1,30 +1,36 @@
+import asyncio
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from aiohttp import web
 from database.spbase import supabase
 from datetime import datetime
 import pytz
 from web.home import logger
+from web.accounting import video_totals
+from web.storage import hls_dirs, originals, originals_dir, ranked_roots, mp4_paths
+from web.templates import index_template, player_cache
+from database.bans import add_ban
+from database.video import delete_videos, delete_user_videos, fetch_all_videos
 
 
 async def video_index(request):
     try:
-        # Fetch videos from Supabase
-        response = supabase.table("stream").select("*").execute()
-        videos = response.data if hasattr(response, 'data') else []
+        # Served from the local replica, Supabase only until it has synced
+        videos = await asyncio.get_running_loop().run_in_executor(None, fetch_all_videos)
         logger.info(f"Number of videos fetched: {len(videos)}")
         if videos:
             logger.info(f"First video data: {videos[0]}")
 
-        # Check template existence
-        file_path = os.path.join(os.path.dirname(__file__), "index.html")
-        if not os.path.exists(file_path):
-            logger.error(f"Template not found at: {file_path}")
-            return web.Response(text="Video HTML template not found", status=404)
+        # Views and bandwidth per video, a stats failure should not take the page down
+        try:
+            totals = await video_totals()
+        except Exception as e:
+            logger.warning(f"Could not load video stats: {e}")
+            totals = {}
 
-        # Read template
-        with open(file_path, "r", encoding="utf-8") as f:
-            html_content = f.read()
+        # Template is loaded once at startup
+        html_content = index_template.source()
 
         # Define IST timezone
         ist = pytz.timezone('Asia/Kolkata')
@@ -37,6 +43,9 @@ async def video_index(request):
             video_title = video.get('title', 'Untitled')
             created_at = video.get('created_at', 'Unknown')
             user = video.get('user', 'Unknown')
+            video_stats = totals.get(video_id, {"views": 0, "bytes": 0})
+            views = video_stats["views"]
+            bandwidth_gb = round(video_stats["bytes"] / (1024 * 1024 * 1024), 2)
 
             # Format created_at and calculate hours ago in IST
             if created_at != 'Unknown':
@@ -92,6 +101,8 @@ async def video_index(request):
                                 <span class="label">Time:</span> <span>{time_str}</span>
                                 <span class="label">Uploaded:</span> <span>{hours_ago_str}</span>
                                 <span class="label">User:</span> <span>{user}</span>
+                                <span class="label">Views:</span> <span>{views}</span>
+                                <span class="label">Bandwidth:</span> <span>{bandwidth_gb} GB</span>
                             </div>
                             <button class="delete-btn" onclick="deleteVideo('{video_id}')">Delete</button>
                             <button class="ban-btn" onclick="banUser('{user}')">Ban User</button>
@@ -115,16 +126,89 @@ async def video_index(request):
         return web.Response(text=f"Error loading page: {str(e)}", status=500)
 
 
+# Removing a long video's HLS tree means thousands of unlinks, keep them off the event loop and
+# off the default executor that the DB calls use
+_delete_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="delete")
+
+
+def remove_video_files(rows):
+    """Blocking removal of the HLS folders and originals of deleted stream rows, from every storage root"""
+    for row in rows:
+        file_id = row.get("video")
+        if not file_id:
+            continue
+
+        hls_folders = hls_dirs(file_id)
+        if not hls_folders:
+            logger.warning(f"HLS folder not found for file_id: {file_id}")
+        for hls_folder in hls_folders:
+            try:
+                shutil.rmtree(hls_folder)
+                logger.info(f"Successfully deleted HLS folder: {hls_folder}")
+            except Exception as file_error:
+                logger.error(f"Failed to delete HLS folder {hls_folder}: {str(file_error)}")
+
+        for copy in mp4_paths(file_id):
+            try:
+                os.remove(copy)
+            except FileNotFoundError:
+                pass
+
+        # Rows from before original_ext was recorded fall back to a directory lookup
+        ext = row.get("original_ext")
+        if ext:
+            original_paths = [path for path in (os.path.join(originals_dir(root), f"{file_id}{ext}")
+                                                for root in ranked_roots(file_id)) if os.path.exists(path)]
+        else:
+            original_paths = originals(file_id)
+        if not original_paths:
+            logger.warning(f"Original file not found for file_id: {file_id} on any storage root")
+        for original_file_path in original_paths:
+            try:
+                os.remove(original_file_path)
+                logger.info(f"Successfully deleted original file: {original_file_path}")
+            except Exception as file_error:
+                logger.error(f"Failed to delete original file {original_file_path}: {str(file_error)}")
+
+
+def _log_removal(future):
+    if future.exception():
+        logger.error(f"Background file removal failed: {future.exception()}")
+
+
+async def purge_videos(column=None, values=None, user=None):
+    """Delete stream rows in one DB round trip and remove their files in the background. Returns the deleted rows."""
+    loop = asyncio.get_running_loop()
+    if user is not None:
+        rows = await loop.run_in_executor(None, delete_user_videos, user)
+    else:
+        rows = await loop.run_in_executor(None, delete_videos, column, values)
+    for row in rows:
+        player_cache.invalidate(row.get("token"))
+    if rows:
+        loop.run_in_executor(_delete_executor, remove_video_files, rows).add_done_callback(_log_removal)
+    return rows
+
+
 async def ban_user(request):
     try:
         user = request.match_info.get('user')
         if not user:
             return web.Response(text="User is required", status=400)
 
-        # Example: Add user to a banned_users table (adjust based on your schema)
-        response = supabase.table("banned_users").insert({"username": user}).execute()
+        response = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: supabase.table("banned_users").insert({"username": user}).execute())
         if response.data:
             logger.info(f"Successfully banned user: {user}")
+            add_ban(user)
+            from plugins.video import cancel_banned_jobs
+
+            cancelled = await cancel_banned_jobs()
+            if cancelled:
+                logger.info(f"Cancelled {cancelled} queued jobs of banned user: {user}")
+            if request.query.get('purge', '').lower() == 'true':
+                rows = await purge_videos(user=user)
+                logger.info(f"Deleted {len(rows)} videos of banned user: {user}")
             return web.Response(text="User banned successfully", status=200)
         else:
             logger.warning(f"Failed to ban user: {user}")
@@ -139,54 +223,40 @@ async def delete_video(request):
         if not file_id:
             return web.Response(text="Video ID is required", status=400)
 
-        # Check if the video exists in Supabase
-        video_response = supabase.table("stream").select("*").eq("video", file_id).execute()
-        if not video_response.data or len(video_response.data) == 0:
+        rows = await purge_videos("video", [file_id])
+        if not rows:
             logger.warning(f"Video not found in database for deletion: {file_id}")
             return web.Response(text="Video not found", status=404)
 
-        # Delete from Supabase
-        response = supabase.table("stream").delete().eq("video", file_id).execute()
-        if not response.data:
-            logger.warning(f"Video not found in database for deletion: {file_id}")
-            return web.Response(text="Video not found", status=404)
+        logger.info(f"Successfully deleted video with file_id: {file_id} from database")
+        return web.Response(text="Video deleted successfully", status=200)
 
-        # Define paths
-        downloads_dir = os.path.join(os.getcwd(), "downloads")
-        originals_dir = os.path.join(os.getcwd(), "originals")
-        hls_folder = os.path.join(downloads_dir, file_id)
+    except Exception as e:
+        logger.error(f"Error deleting video: {str(e)}")
+        return web.Response(text=f"Error deleting video: {str(e)}", status=500)
 
-        # Delete HLS folder if it exists
-        if os.path.exists(hls_folder):
-            try:
-                shutil.rmtree(hls_folder)
-                logger.info(f"Successfully deleted HLS folder: {hls_folder}")
-            except Exception as file_error:
-                logger.error(f"Failed to delete HLS folder {hls_folder}: {str(file_error)}")
-        else:
-            logger.warning(f"HLS folder not found for file_id: {file_id}")
 
-        # Delete original file (try common extensions)
-        possible_extensions = ['.mp4', '.mkv', '.avi', '.mov']
-        original_file_path = None
-        for ext in possible_extensions:
-            candidate_path = os.path.join(originals_dir, f"{file_id}{ext}")
-            if os.path.exists(candidate_path):
-                original_file_path = candidate_path
-                break
+async def delete_videos_batch(request):
+    """POST /videos/delete with {"videos": [file_id, ...]}, {"tokens": [token, ...]} or {"user": user_id}"""
+    try:
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.Response(text="Invalid JSON body", status=400)
+        if not isinstance(body, dict):
+            return web.Response(text="Invalid JSON body", status=400)
 
-        if original_file_path:
-            try:
-                os.remove(original_file_path)
-                logger.info(f"Successfully deleted original file: {original_file_path}")
-            except Exception as file_error:
-                logger.error(f"Failed to delete original file {original_file_path}: {str(file_error)}")
+        if body.get("user") is not None:
+            rows = await purge_videos(user=body["user"])
+        elif body.get("videos"):
+            rows = await purge_videos("video", [str(v) for v in body["videos"]])
+        elif body.get("tokens"):
+            rows = await purge_videos("token", [str(t) for t in body["tokens"]])
         else:
-            logger.warning(f"Original file not found for file_id: {file_id} in {originals_dir}")
-
-        logger.info(f"Successfully deleted video with file_id: {file_id} from database")
-        return web.Response(text="Video deleted successfully", status=200)
+            return web.Response(text="videos, tokens or user is required", status=400)
 
+        logger.info(f"Batch deleted {len(rows)} videos from database")
+        return web.json_response({"deleted": [row.get("video") for row in rows]})
     except Exception as e:
-        logger.error(f"Error deleting video: {str(e)}")
-        return web.Response(text=f"Error deleting video: {str(e)}", status=500)
\ No newline at end of file
+        logger.error(f"Error deleting videos: {str(e)}")
+        return web.Response(text=f"Error deleting videos: {str(e)}", status=500)
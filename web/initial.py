@@ -1,22 +1,68 @@
+import os
+
 from aiohttp import web
-from web.home import  serve_hls, serve_video_player
+from web.home import  serve_hls, serve_signed_hls, serve_video_player
 import logging
 
-from web.index import video_index, delete_video
+from web.index import video_index, delete_video, delete_videos_batch, ban_user
 from web.protected_page import auth_middleware
-from web.server import websocket_handler, index_handler
+from web.metrics import metrics_middleware, metrics_handler
+from web.jobs import jobs_handler
+from web.admission import run_limits_watcher, stop_limits_watcher, admission_middleware
+from web.accounting import start_accounting, stop_accounting
+from web.reconcile import start_warmup, stop_warmup
+from web.download import serve_download
+from web.loopmon import start_loop_monitor, stop_loop_monitor
+from web.server import websocket_handler, index_handler, history_handler, start_stats_sampler, stop_stats_sampler
 
 logger = logging.getLogger(__name__)
-async def start_web_server():
-    app = web.Application(middlewares=[auth_middleware])
-    app.router.add_get('/hls/{file:.+}', serve_hls)
-    app.router.add_get('/video/{token}', serve_video_player)
-    app.router.add_get('/videos', video_index)
-    app.router.add_delete('/videos/{token}', delete_video)
-    app.router.add_get('/server-stats', websocket_handler)
-    app.router.add_get('/server', index_handler)
+
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+# When playback runs in serve.py workers the bot process keeps only the control routes, on their own port
+PLAYBACK_WORKERS = int(os.getenv("PLAYBACK_WORKERS", "0"))
+CONTROL_PORT = int(os.getenv("CONTROL_PORT", "8081"))
+
+
+def create_app(routes="all"):
+    """Build the aiohttp app. routes is "all", "playback" (HLS and player) or "control" (admin and stats)."""
+    app = web.Application(middlewares=[admission_middleware, metrics_middleware, auth_middleware])
+    app.router.add_get('/metrics', metrics_handler)
+    app.on_startup.append(start_loop_monitor)
+    app.on_cleanup.append(stop_loop_monitor)
+    if routes in ("all", "playback"):
+        app.router.add_get('/hls/{file:.+}', serve_hls)
+        app.router.add_get('/s/{expires}/{signature}/{file:.+}', serve_signed_hls)
+        app.router.add_get('/video/{token}', serve_video_player)
+        app.router.add_get('/download/{token}', serve_download)
+        app.on_startup.append(run_limits_watcher)
+        app.on_cleanup.append(stop_limits_watcher)
+        app.on_startup.append(start_accounting)
+        app.on_cleanup.append(stop_accounting)
+        app.on_startup.append(start_warmup)
+        app.on_cleanup.append(stop_warmup)
+    if routes in ("all", "control"):
+        app.router.add_get('/videos', video_index)
+        app.router.add_delete('/videos/{token}', delete_video)
+        app.router.add_post('/videos/delete', delete_videos_batch)
+        app.router.add_post('/ban/{user}', ban_user)
+        app.router.add_get('/server-stats', websocket_handler)
+        app.router.add_get('/server', index_handler)
+        app.router.add_get('/server-history', history_handler)
+        app.router.add_get('/jobs', jobs_handler)
+        app.on_startup.append(start_stats_sampler)
+        app.on_cleanup.append(stop_stats_sampler)
+    return app
+
+
+async def start_web_server(routes=None, port=None, reuse_port=False):
+    if routes is None:
+        routes = "control" if PLAYBACK_WORKERS > 0 else "all"
+    if port is None:
+        port = CONTROL_PORT if routes == "control" else WEB_PORT
+    app = create_app(routes)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", 8080)
+    site = web.TCPSite(runner, "0.0.0.0", port, reuse_port=reuse_port or None)
     await site.start()
-    logger.info("AioHTTP server started on port 8080")
\ No newline at end of file
+    logger.info(f"AioHTTP server started on port {port} ({routes} routes)")
+    return runner
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import resource
+import time
+import uuid
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# How many finished jobs to keep in memory for /jobs
+JOBS_HISTORY = int(os.getenv("JOBS_HISTORY", "200"))
+PERSIST_JOBS = os.getenv("PERSIST_JOBS", "true").lower() == "true"
+
+active_jobs = {}
+recent_jobs = deque(maxlen=JOBS_HISTORY)
+
+
+def children_cpu_seconds():
+    """CPU of reaped children only. A delta around a blocking subprocess.run is that child's CPU,
+    as long as nothing else reaps a child meanwhile."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def wait_child(process):
+    """Blocking: reap a Popen child and return (returncode, CPU seconds of it and its reaped descendants).
+    wait4 reports the child's own rusage, so concurrent encodes and serving are not charged to it."""
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+
+class Job:
+    """Span timeline of one upload or rebuild, from Telegram download to the move into originals/"""
+
+    def __init__(self, file_id, file_name, user_id=None, kind="upload"):
+        self.job_id = str(uuid.uuid4())
+        self.file_id = file_id
+        self.file_name = file_name
+        self.user_id = user_id
+        self.kind = kind
+        self.status = "running"
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.spans = []
+        # Free-form results such as measured segment sizes
+        self.details = {}
+
+    def add_span(self, stage, start, end, bytes=None, cpu=None):
+        span = {"stage": stage, "start": start, "end": end, "duration": round(end - start, 3)}
+        if bytes is not None:
+            span["bytes"] = bytes
+        if cpu is not None:
+            span["cpu"] = round(cpu, 3)
+        self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, stage):
+        """Time a stage. The yielded dict can carry extra attributes such as bytes."""
+        attrs = {}
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            # In-process work such as downloads shares the process with serving, so no CPU is attributed
+            span = self.add_span(stage, start, time.time(), attrs.pop("bytes", None), attrs.pop("cpu", None))
+            span.update(attrs)
+
+    def slowest(self, n=3):
+        return sorted(self.spans, key=lambda s: s["duration"], reverse=True)[:n]
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.job_id,
+            "file_id": self.file_id,
+            "file_name": self.file_name,
+            "user_id": self.user_id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "duration": round(end - self.started_at, 3),
+            "spans": self.spans,
+            "slowest": [s["stage"] for s in self.slowest()],
+            "details": self.details,
+        }
+
+    def finish(self, status="success", error=None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        active_jobs.pop(self.job_id, None)
+        recent_jobs.appendleft(self)
+        if PERSIST_JOBS:
+            asyncio.get_running_loop().run_in_executor(None, _persist, self.to_dict())
+
+
+def _persist(record):
+    from database.jobs import insert_job
+
+    try:
+        insert_job(record)
+    except Exception as e:
+        logger.warning(f"Failed to persist job {record['job_id']}: {str(e)}")
+
+
+def start_job(file_id, file_name, user_id=None, kind="upload"):
+    job = Job(file_id, file_name, user_id, kind)
+    active_jobs[job.job_id] = job
+    return job
+
+
+async def jobs_handler(request):
+    """Active and recent jobs with their span timelines: ?limit=<n>&file_id=<id>"""
+    try:
+        limit = int(request.query.get("limit", 50))
+    except ValueError:
+        return web.Response(text="Invalid limit", status=400)
+    file_id = request.query.get("file_id")
+
+    def wanted(job):
+        return file_id is None or job.file_id == file_id
+
+    return web.json_response({
+        "active": [job.to_dict() for job in active_jobs.values() if wanted(job)],
+        "recent": [job.to_dict() for job in list(recent_jobs) if wanted(job)][:limit],
+    })
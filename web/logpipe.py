@@ -0,0 +1,107 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# One JSON object per line instead of the plain text format, job fields included
+LOG_JSON = os.getenv("LOG_JSON", "false").lower() == "true"
+# Keep the complete stderr of every ffmpeg run in FFMPEG_LOG_DIR, for debugging encodes
+FFMPEG_DEBUG_LOGS = os.getenv("FFMPEG_DEBUG_LOGS", "false").lower() == "true"
+FFMPEG_LOG_DIR = os.getenv("FFMPEG_LOG_DIR", os.path.join(os.getcwd(), "logs", "ffmpeg"))
+FFMPEG_LOG_MAX_BYTES = int(os.getenv("FFMPEG_LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+
+JOB_FIELDS = ("job_id", "file_id", "kind")
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in JOB_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def install_queue_logging():
+    """Move the root handlers behind a queue, so a log call on the event loop is an enqueue and the
+    console or file write happens on the listener thread"""
+    global _listener
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    if LOG_JSON:
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_queue_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class JobLogAdapter(logging.LoggerAdapter):
+    """Tags records with the job they belong to, and prefixes the text so plain logs stay greppable"""
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return f"[{self.extra['kind']} {self.extra['file_id']}] {msg}", kwargs
+
+
+def job_log(logger, job):
+    return JobLogAdapter(logger, {"job_id": job.job_id, "file_id": job.file_id, "kind": job.kind})
+
+
+class FfmpegLog:
+    """Complete stderr of one ffmpeg run in a rotating file. Lines are queued and written on a listener
+    thread. Without FFMPEG_DEBUG_LOGS this does nothing."""
+
+    def __init__(self, job, stream_type):
+        self._listener = None
+        self._handler = None
+        if not FFMPEG_DEBUG_LOGS:
+            return
+        os.makedirs(FFMPEG_LOG_DIR, exist_ok=True)
+        path = os.path.join(FFMPEG_LOG_DIR, f"{job.file_id}-{job.job_id[:8]}-{stream_type}.log")
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=FFMPEG_LOG_MAX_BYTES, backupCount=1,
+                                                            encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        log_queue = queue.SimpleQueue()
+        self._handler = logging.handlers.QueueHandler(log_queue)
+        self._listener = logging.handlers.QueueListener(log_queue, file_handler)
+        self._listener.start()
+
+    def write(self, line):
+        if self._handler is not None:
+            self._handler.emit(logging.makeLogRecord({"msg": line, "levelno": logging.DEBUG}))
+
+    def close(self):
+        """Blocks until queued lines are written, call it from an executor"""
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+            self._handler = None
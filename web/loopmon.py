@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from web.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+LOOP_SAMPLE_INTERVAL = float(os.getenv("LOOP_SAMPLE_INTERVAL", "0.1"))
+# A loop that has not run the sampler for this long on top of its interval counts as blocked
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+# Log the blocking stack, task and owning request or job of every stall. Costs a frame walk per stall only.
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "false").lower() == "true"
+LOOP_REPORTS = int(os.getenv("LOOP_REPORTS", "20"))
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+loop_lag = registry.histogram(
+    "stream_event_loop_lag_seconds", "How late the event loop woke a sleeping sampler task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+loop_stalls = registry.counter("stream_event_loop_stalls_total", "Event loop stalls longer than LOOP_STALL_THRESHOLD",
+                               ["subsystem"])
+loop_blocked_seconds = registry.counter("stream_event_loop_blocked_seconds_total",
+                                        "Time the event loop spent in stalls", ["subsystem"])
+
+
+def subsystem_of(frames):
+    """bot, web or encoder, from the innermost repo frame that is not a shared database helper"""
+    for filename in reversed([frame.f_code.co_filename for frame in frames]):
+        if filename.startswith(REPO_ROOT) and "site-packages" not in filename:
+            relative = os.path.relpath(filename, REPO_ROOT)
+            if relative.startswith("database"):
+                continue
+            if relative.startswith(os.path.join("plugins", "encoder")):
+                return "encoder"
+            if relative.startswith("plugins") or relative == "main.py":
+                return "bot"
+            if relative.startswith("web"):
+                return "web"
+    for filename in (frame.f_code.co_filename for frame in frames):
+        if "pyrogram" in filename:
+            return "bot"
+        if "aiohttp" in filename:
+            return "web"
+    return "other"
+
+
+def owner_of(frames):
+    """The request or encode job a stack belongs to, found through handler and encoder locals"""
+    for frame in reversed(frames):
+        local_vars = frame.f_locals
+        request = local_vars.get("request")
+        if request is not None and hasattr(request, "path") and hasattr(request, "method"):
+            return f"{request.method} {request.path}"
+        job = local_vars.get("job")
+        if job is not None and hasattr(job, "file_id"):
+            return f"job {job.kind} {job.file_id}"
+    return None
+
+
+class LoopMonitor:
+    """Lag sampler on the loop plus a watchdog thread that notices when the sampler stops running"""
+
+    def __init__(self):
+        self.heartbeat = time.monotonic()
+        self.max_lag = 0.0
+        self.reports = deque(maxlen=LOOP_REPORTS)
+        self.stalls = {}
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._sample())
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _sample(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_SAMPLE_INTERVAL)
+            now = time.monotonic()
+            lag = max(0.0, now - started - LOOP_SAMPLE_INTERVAL)
+            loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.heartbeat = now
+
+    def _watch(self):
+        stall_started = None
+        subsystem = None
+        while not self._stop.wait(LOOP_STALL_THRESHOLD / 2):
+            silent = time.monotonic() - self.heartbeat - LOOP_SAMPLE_INTERVAL
+            if silent > LOOP_STALL_THRESHOLD and stall_started is None:
+                stall_started = self.heartbeat + LOOP_SAMPLE_INTERVAL
+                subsystem = self._capture()
+            elif silent <= LOOP_STALL_THRESHOLD and stall_started is not None:
+                blocked = self.heartbeat - stall_started
+                loop_stalls.inc(subsystem=subsystem)
+                loop_blocked_seconds.inc(max(0.0, blocked), subsystem=subsystem)
+                self.stalls[subsystem] = self.stalls.get(subsystem, 0) + 1
+                if self.reports and self.reports[-1].get("duration") is None:
+                    self.reports[-1]["duration"] = round(blocked, 3)
+                stall_started = None
+
+    def _capture(self):
+        """Snapshot the loop thread while it is still blocked. Returns the subsystem to charge."""
+        frame = sys._current_frames().get(self._loop_thread_id)
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        subsystem = subsystem_of(frames)
+        if not LOOP_DEBUG:
+            return subsystem
+
+        task = getattr(asyncio.tasks, "_current_tasks", {}).get(self._loop)
+        report = {
+            "at": time.time(),
+            "subsystem": subsystem,
+            "task": task.get_name() if task is not None else None,
+            "owner": owner_of(frames),
+            "duration": None,
+            "stack": "".join(traceback.format_list(traceback.StackSummary.extract(
+                ((f, f.f_lineno) for f in frames), lookup_lines=True)[-12:])),
+        }
+        self.reports.append(report)
+        logger.warning(f"Event loop blocked for over {LOOP_STALL_THRESHOLD}s in {subsystem} "
+                       f"(task {report['task']}, {report['owner'] or 'no owner found'}):\n{report['stack']}")
+        return subsystem
+
+    def snapshot(self):
+        """Dashboard fields. Resets the max lag, so each stats sample reports the worst lag since the last one."""
+        max_lag, self.max_lag = self.max_lag, 0.0
+        return {
+            "loop_lag_max_ms": round(max_lag * 1000, 2),
+            "loop_stalls": dict(self.stalls),
+            "loop_reports": [{k: v for k, v in report.items()} for report in list(self.reports)[-5:]],
+        }
+
+
+monitor = LoopMonitor()
+
+
+async def start_loop_monitor(app):
+    monitor.start()
+
+
+async def stop_loop_monitor(app):
+    monitor.stop()
@@ -0,0 +1,187 @@
+import bisect
+import time
+import logging
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        # Gauges backed by a callback are read at scrape time, e.g. the encode queue depth
+        self.callback = callback
+
+    def set(self, value, **labels):
+        self.values[_label_key(self.labelnames, labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                self.values[()] = self.callback()
+            except Exception as e:
+                logger.warning(f"Metric callback for {self.name} failed: {str(e)}")
+        return super().samples()
+
+
+# Latency-style buckets in seconds, the same ones Prometheus client libraries default to
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for key, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, key, ("le", bound)), cumulative
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Prometheus text exposition format 0.0.4"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in list(metric.samples()):
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+queue_wait_seconds = registry.histogram(
+    "stream_encode_queue_wait_seconds", "Time a job waited in the encode queue before encoding started",
+    buckets=(1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200))
+stage_seconds = registry.histogram(
+    "stream_job_stage_seconds", "Duration of each ingest stage (download, probe, encode, subtitle, db_insert)",
+    ["stage"], buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 1800, 3600))
+ffmpeg_speed = registry.histogram(
+    "stream_ffmpeg_speed_ratio", "FFmpeg processing speed relative to realtime, from its speed= progress output",
+    ["stream"], buckets=(0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250))
+jobs_total = registry.counter("stream_encode_jobs_total", "Finished encode jobs", ["result"])
+http_requests = registry.counter("stream_http_requests_total", "HTTP requests", ["route", "method", "status"])
+http_latency = registry.histogram(
+    "stream_http_request_duration_seconds", "Time until the handler returned a response", ["route"])
+http_bytes = registry.counter("stream_http_response_bytes_total", "Response bytes served", ["route"])
+cache_requests = registry.counter("stream_cache_requests_total", "Cache lookups", ["cache", "result"])
+
+
+def record_cache(cache, hit):
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def _route_name(request):
+    route = request.match_info.route
+    resource = route.resource if route is not None else None
+    return resource.canonical if resource is not None else "unmatched"
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = time.perf_counter()
+    route = _route_name(request)
+    status = 500
+    response = None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        http_latency.observe(time.perf_counter() - start, route=route)
+        http_requests.inc(route=route, method=request.method, status=status)
+        # FileResponse only learns its length when it is sent, so file handlers report it themselves
+        size = request.get("response_bytes")
+        if size is None and response is not None:
+            size = response.content_length
+        if size:
+            http_bytes.inc(size, route=route)
+
+
+async def metrics_handler(request):
+    # Set as a header, content_type= does not accept parameters other than charset
+    return web.Response(text=registry.render(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+                                 "X-Content-Type-Options": "nosniff"})
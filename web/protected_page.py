@@ -1,28 +1,80 @@
 from aiohttp import web
 import base64
+import hashlib
+import hmac
+import logging
+import os
+import time
 
-USERNAME = "admin"
-PASSWORD = "password"
+from dotenv import load_dotenv
 
-async def check_auth(request):
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+USERNAME = os.getenv("ADMIN_USERNAME", "admin")
+PASSWORD = os.getenv("ADMIN_PASSWORD", "password")
+# Precomputed so checking a request is a single constant-time compare
+EXPECTED_AUTH = ("Basic " + base64.b64encode(f"{USERNAME}:{PASSWORD}".encode("utf-8")).decode("ascii")).encode("ascii")
+
+# Key for stateless playback URLs. Must be the same in every serve.py worker, so it is never random.
+HLS_SIGNING_KEY = hashlib.sha256(
+    ("hls-signing:" + (os.getenv("HLS_SIGNING_KEY") or os.getenv("BOT_TOKEN") or PASSWORD)).encode("utf-8")
+).digest()
+# Signed URLs stay valid for at least this long. Expiry is rounded up to HLS_URL_BUCKET so the
+# player page for a token stays the same (and cacheable) within a bucket.
+HLS_URL_TTL = int(os.getenv("HLS_URL_TTL", str(6 * 3600)))
+HLS_URL_BUCKET = int(os.getenv("HLS_URL_BUCKET", "3600"))
+
+
+def public(handler):
+    """Mark a route handler as reachable without Basic auth"""
+    handler.auth_public = True
+    return handler
+
+
+def check_auth(request):
     auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Basic "):
-        print("No or invalid Authorization header")
+    if not auth_header:
         return False
+    return hmac.compare_digest(auth_header.encode("utf-8", "ignore"), EXPECTED_AUTH)
+
+
+def _hls_signature(file_id: str, expires: int) -> str:
+    return hmac.new(HLS_SIGNING_KEY, f"{file_id}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+
+def sign_hls_path(file_id: str, file_name: str = "master.m3u8") -> str:
+    """Playback URL for a video's HLS tree. Relative playlist URIs resolve under the same signed prefix."""
+    expires = (int(time.time() + HLS_URL_TTL) // HLS_URL_BUCKET + 1) * HLS_URL_BUCKET
+    return f"/s/{expires}/{_hls_signature(file_id, expires)}/{file_id}/{file_name}"
+
+
+def verify_hls_signature(file_id: str, expires: str, signature: str) -> bool:
+    """Constant-time check of a signed playback URL, no DB lookup and no logging"""
     try:
-        encoded = auth_header.split(" ")[1]
-        decoded = base64.b64decode(encoded).decode("utf-8")
-        username, password = decoded.split(":", 1)
-        is_valid = username == USERNAME and password == PASSWORD
-        print(f"Auth check: {username} - Valid? {is_valid}")
-        return is_valid
-    except Exception as e:
-        print(f"Auth error: {str(e)}")
+        expires_at = int(expires)
+    except ValueError:
         return False
+    if expires_at < time.time():
+        return False
+    return hmac.compare_digest(_hls_signature(file_id, expires_at), signature)
+
+
+def sign_download_path(token: str) -> str:
+    """Shareable /download link for a video token, valid for HLS_URL_TTL"""
+    expires = int(time.time() + HLS_URL_TTL)
+    return f"/download/{token}?expires={expires}&sig={_hls_signature(f'download:{token}', expires)}"
+
+
+def verify_download_signature(token: str, expires: str, signature: str) -> bool:
+    return verify_hls_signature(f"download:{token}", expires, signature)
+
 
 @web.middleware
 async def auth_middleware(request, handler):
-    if not await check_auth(request):
+    if getattr(request.match_info.handler, "auth_public", False):
+        return await handler(request)
+    if not check_auth(request):
         return web.Response(
             status=401,
             text="Unauthorized",
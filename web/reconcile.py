@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+
+from dotenv import load_dotenv
+
+from database.spbase import supabase
+from database.video import fetch_videos_by_id
+from web.jobs import active_jobs
+from web.metrics import registry
+from web.storage import STORAGE_ROOTS, downloads_dir, originals_dir, scratch_dir, hls_dir
+from web.tiering import BASE_DIR, last_access, rebuilding, request_rebuild, _load_access
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Leave anything younger than this alone, it may belong to a download or encode that is still running
+RECONCILE_GRACE_SECONDS = float(os.getenv("RECONCILE_GRACE_SECONDS", "3600"))
+# Most deletions plus rebuilds one pass may perform, so a bad DB read cannot wipe the disk
+RECONCILE_MAX_ACTIONS = int(os.getenv("RECONCILE_MAX_ACTIONS", "100"))
+# Log what would be done without deleting or queueing anything
+RECONCILE_DRY_RUN = os.getenv("RECONCILE_DRY_RUN", "false").lower() == "true"
+# Player pages to pre-render at startup, most recently watched first
+WARMUP_VIDEOS = int(os.getenv("WARMUP_VIDEOS", "200"))
+STREAM_PAGE_SIZE = 1000
+# Row count of the previous pass, a read that comes back smaller is not trusted for deletions
+STATE_FILE = os.path.join(BASE_DIR, ".reconcile.json")
+
+startup_seconds = registry.gauge("stream_startup_seconds", "Seconds from process start until each startup phase finished",
+                                 ["phase"])
+reconcile_actions = registry.counter("stream_reconcile_actions_total", "Startup reconciliation findings", ["kind"])
+
+
+def fetch_stream_rows():
+    """Every stream row, a page at a time so the default row limit cannot truncate the diff. Ordered on the
+    primary key, without an order PostgREST may skip or repeat rows between pages."""
+    rows = []
+    offset = 0
+    while True:
+        response = supabase.table("stream").select("video,token,title").order("token") \
+            .range(offset, offset + STREAM_PAGE_SIZE - 1).execute()
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < STREAM_PAGE_SIZE:
+            return rows
+        offset += STREAM_PAGE_SIZE
+
+
+def _old_enough(path, now):
+    try:
+        return now - os.path.getmtime(path) > RECONCILE_GRACE_SECONDS
+    except OSError:
+        return False
+
+
+def _load_state():
+    try:
+        with open(STATE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(state):
+    tmp_path = f"{STATE_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, STATE_FILE)
+
+
+def _hls_tree_count():
+    count = 0
+    for root in STORAGE_ROOTS:
+        for entry in os.scandir(downloads_dir(root)):
+            if entry.is_dir() and not entry.name.startswith(".") \
+                    and os.path.exists(os.path.join(entry.path, "master.m3u8")):
+                count += 1
+    return count
+
+
+def rows_trusted(rows):
+    """Blocking: False when the table read looks truncated. Fewer rows than last time or than finished HLS
+    trees on disk would turn the missing rows' files into orphans."""
+    previous = _load_state().get("rows", 0)
+    trees = _hls_tree_count()
+    _save_state({"rows": len(rows), "at": time.time()})
+    if len(rows) < previous or len(rows) < trees:
+        logger.warning(f"Startup reconciliation will not delete anything: read {len(rows)} stream rows, "
+                       f"previous pass read {previous} and {trees} HLS trees are on disk")
+        return False
+    return True
+
+
+def _remove(path, dry_run):
+    if dry_run:
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def diff_disk(rows, dry_run=RECONCILE_DRY_RUN):
+    """Blocking filesystem pass: clean up orphans and return the rows whose HLS output needs a rebuild"""
+    now = time.time()
+    known = {row["video"]: row for row in rows if row.get("video")}
+    busy = rebuilding | {job.file_id for job in list(active_jobs.values())}
+    report = {"orphan_hls": 0, "orphan_originals": 0, "stale_downloads": 0, "stale_scratch": 0, "partial_hls": 0,
+              "missing": 0}
+    actions = 0
+    rebuild = []
+
+    for root in STORAGE_ROOTS:
+        entries = list(os.scandir(downloads_dir(root)))
+        if os.path.isdir(scratch_dir(root)):
+            # Encodes and rebalance copies the previous process never got to rename into place
+            entries += list(os.scandir(scratch_dir(root)))
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name in busy or not _old_enough(entry.path, now):
+                continue
+            if actions >= RECONCILE_MAX_ACTIONS:
+                break
+            if os.path.dirname(entry.path) == scratch_dir(root):
+                report["stale_scratch"] += 1
+                logger.info(f"Removing unfinished encode {entry.path}")
+            elif entry.is_file():
+                # Pyrogram downloads land at the top of downloads/, as <name>.temp while in flight. After a
+                # restart nothing will ever queue them.
+                report["stale_downloads"] += 1
+                logger.info(f"Removing stale download {entry.path}")
+            elif entry.name not in known:
+                report["orphan_hls"] += 1
+                logger.info(f"Removing HLS tree without a stream row: {entry.path}")
+            elif not os.path.exists(os.path.join(entry.path, "master.m3u8")):
+                # An encode that died half way. Start it again from the original.
+                report["partial_hls"] += 1
+                logger.info(f"Removing partial HLS tree {entry.path}")
+                rebuild.append(known[entry.name])
+            else:
+                continue
+            _remove(entry.path, dry_run)
+            actions += 1
+
+    originals = {}
+    for root in STORAGE_ROOTS:
+        for entry in os.scandir(originals_dir(root)):
+            file_id = os.path.splitext(entry.name)[0]
+            originals[file_id] = entry.path
+            if file_id in known or file_id in busy or not _old_enough(entry.path, now):
+                continue
+            if actions >= RECONCILE_MAX_ACTIONS:
+                continue
+            report["orphan_originals"] += 1
+            logger.info(f"Removing original without a stream row: {entry.path}")
+            _remove(entry.path, dry_run)
+            actions += 1
+
+    for file_id in known:
+        # Evicted videos legitimately have no HLS tree, only rows with neither side are broken
+        if file_id not in originals and not os.path.exists(os.path.join(hls_dir(file_id), "master.m3u8")):
+            report["missing"] += 1
+            logger.warning(f"Stream row {file_id} has neither HLS output nor an original")
+    rebuild = [row for row in rebuild if row["video"] in originals]
+    return report, rebuild
+
+
+async def reconcile(process_started):
+    """Diff downloads/ and originals/ of every storage root against the stream table once, after the bot and web server are up"""
+    loop = asyncio.get_running_loop()
+    started = time.time()
+    try:
+        rows = await loop.run_in_executor(None, fetch_stream_rows)
+    except Exception as e:
+        # Without the full table every file would look orphaned, so do nothing
+        logger.error(f"Startup reconciliation skipped, could not read the stream table: {str(e)}")
+        return
+    dry_run = RECONCILE_DRY_RUN or not await loop.run_in_executor(None, rows_trusted, rows)
+    report, rebuild = await loop.run_in_executor(None, diff_disk, rows, dry_run)
+    if not dry_run:
+        for row in rebuild:
+            await request_rebuild(row["video"], row.get("title") or row["video"])
+    for kind, count in report.items():
+        reconcile_actions.inc(count, kind=kind)
+    startup_seconds.set(time.time() - process_started, phase="reconciled")
+    logger.info(f"Startup reconciliation of {len(rows)} rows took {time.time() - started:.2f}s"
+                f"{' (dry run)' if dry_run else ''}: {report}, {len(rebuild)} rebuilds queued")
+
+
+def _recent_rows():
+    _load_access()
+    recent = sorted(last_access, key=last_access.get, reverse=True)[:WARMUP_VIDEOS]
+    if not recent:
+        return []
+    return fetch_videos_by_id(recent)
+
+
+async def warm_caches(app):
+    """Pre-render player pages for the most recently watched videos and pull their manifests into the page cache"""
+    from web.home import render_player_page
+
+    loop = asyncio.get_running_loop()
+    started = time.time()
+    try:
+        rows = await loop.run_in_executor(None, _recent_rows)
+    except Exception as e:
+        logger.warning(f"Cache warm-up skipped: {str(e)}")
+        return
+    warmed = 0
+    for row in rows:
+        master = os.path.join(hls_dir(row["video"]), "master.m3u8")
+        if not row.get("token") or not os.path.exists(master):
+            continue
+        render_player_page(row["token"], row)
+        await loop.run_in_executor(None, _read_manifests, os.path.dirname(master))
+        warmed += 1
+    logger.info(f"Warmed {warmed} player pages and manifests in {time.time() - started:.2f}s")
+
+
+def _read_manifests(hls_dir):
+    for root, _, files in os.walk(hls_dir):
+        for name in files:
+            if name.endswith(".m3u8"):
+                with open(os.path.join(root, name), "rb") as f:
+                    f.read()
+
+
+async def start_warmup(app):
+    # In the background, so the server accepts requests while pages are being rendered
+    app['warmup'] = asyncio.create_task(warm_caches(app))
+
+
+async def stop_warmup(app):
+    app['warmup'].cancel()
@@ -4,18 +4,46 @@ import asyncio
 import os
 import json
 import time
+import logging
 import platform
 from datetime import datetime
 
+from web.history import StatsHistory
+from web.loopmon import monitor
+from web.templates import server_template
 
-async def get_server_stats():
-    # CPU
-    cpu_percent = psutil.cpu_percent(interval=1)
+logger = logging.getLogger(__name__)
+
+STATS_INTERVAL = float(os.getenv("STATS_INTERVAL", "2"))
+# psutil.net_connections() walks every socket on the box, so only refresh it every N samples
+CONNECTIONS_EVERY = int(os.getenv("STATS_CONNECTIONS_EVERY", "15"))
+
+
+def collect_encoder_stats():
+    """Encode queue depth and running ffmpeg processes, for the history charts"""
+    from plugins.video import que
+
+    ffmpeg_jobs = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            if child.name() == 'ffmpeg':
+                ffmpeg_jobs += 1
+        except psutil.Error:
+            pass
+    return {'queue_depth': que.qsize(), 'ffmpeg_jobs': ffmpeg_jobs}
+
+
+def collect_server_stats(previous=None, connections=None):
+    """Blocking psutil sampling, run in an executor. Rates are computed against the previous snapshot."""
+    now = time.time()
+
+    # CPU (interval=None compares against the previous call instead of sleeping for a second)
+    cpu_percent = psutil.cpu_percent(interval=None)
     cpu_count = psutil.cpu_count(logical=True)
     cpu_freq = psutil.cpu_freq() or psutil._common.scpufreq(0, 0, 0)
     cpu_speed = cpu_freq.current / 1000 if cpu_freq.current else 0  # GHz
-    cpu_temp = psutil.sensors_temperatures().get('coretemp', [None])[0].current if psutil.sensors_temperatures().get(
-        'coretemp') else 0
+    temperatures = psutil.sensors_temperatures() if hasattr(psutil, 'sensors_temperatures') else {}
+    cpu_temp = temperatures['coretemp'][0].current if temperatures.get('coretemp') else 0
     load_avg = os.getloadavg() if hasattr(os, 'getloadavg') else (0, 0, 0)
 
     # RAM
@@ -45,6 +73,15 @@ async def get_server_stats():
     bandwidth_sent_total_tb = net.bytes_sent / 1024 / 1024 / 1024 / 1024
     bandwidth_recv_total_tb = net.bytes_recv / 1024 / 1024 / 1024 / 1024
 
+    # Throughput since the previous sample (MB/s)
+    bandwidth_sent_rate_mb = 0
+    bandwidth_recv_rate_mb = 0
+    if previous:
+        elapsed = now - previous['sampled_at']
+        if elapsed > 0:
+            bandwidth_sent_rate_mb = max(0, bandwidth_sent_total_mb - previous['bandwidth_sent_total_mb']) / elapsed
+            bandwidth_recv_rate_mb = max(0, bandwidth_recv_total_mb - previous['bandwidth_recv_total_mb']) / elapsed
+
     # Network Speed (Fixed)
     net_stats = psutil.net_if_stats()
     net_speed = 0
@@ -54,11 +91,13 @@ async def get_server_stats():
             break
 
     # Other Stats
-    connections = len(psutil.net_connections())
-    uptime_seconds = time.time() - psutil.boot_time()
+    if connections is None:
+        connections = len(psutil.net_connections())
+    boot = psutil.boot_time()
+    uptime_seconds = now - boot
     server_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     timezone = time.tzname[0] if time.tzname else "Unknown"
-    boot_time = datetime.fromtimestamp(psutil.boot_time()).strftime('%Y-%m-%d %H:%M:%S')
+    boot_time = datetime.fromtimestamp(boot).strftime('%Y-%m-%d %H:%M:%S')
 
     return {
         'cpu': cpu_percent, 'cpu_count': cpu_count, 'cpu_speed': cpu_speed, 'cpu_temp': cpu_temp,
@@ -71,22 +110,116 @@ async def get_server_stats():
         'bandwidth_sent_total_mb': bandwidth_sent_total_mb, 'bandwidth_recv_total_mb': bandwidth_recv_total_mb,
         'bandwidth_sent_total_gb': bandwidth_sent_total_gb, 'bandwidth_recv_total_gb': bandwidth_recv_total_gb,
         'bandwidth_sent_total_tb': bandwidth_sent_total_tb, 'bandwidth_recv_total_tb': bandwidth_recv_total_tb,
+        'bandwidth_sent_rate_mb': bandwidth_sent_rate_mb, 'bandwidth_recv_rate_mb': bandwidth_recv_rate_mb,
         'net_speed': net_speed, 'uptime': uptime_seconds, 'connections': connections,
-        'server_time': server_time, 'timezone': timezone, 'boot_time': boot_time
+        'server_time': server_time, 'timezone': timezone, 'boot_time': boot_time,
+        'sampled_at': now, **collect_encoder_stats(), **monitor.snapshot()
     }
 
 
+class StatsSampler:
+    """Samples server stats once per interval off the event loop and fans the snapshot out to every websocket"""
+
+    def __init__(self, interval=STATS_INTERVAL):
+        self.interval = interval
+        self.subscribers = set()
+        self.latest = None
+        self.history = StatsHistory()
+        self._payload = None
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        samples = 0
+        connections = None
+        while True:
+            started = loop.time()
+            try:
+                if samples % CONNECTIONS_EVERY == 0:
+                    connections = None
+                stats = await loop.run_in_executor(None, collect_server_stats, self.latest, connections)
+                connections = stats['connections']
+                samples += 1
+                self.latest = stats
+                self.history.add(stats['sampled_at'], stats)
+                self._payload = json.dumps(stats)
+                await self._broadcast()
+            except Exception as e:
+                logger.error(f"Stats sampling failed: {str(e)}")
+            await asyncio.sleep(max(0, self.interval - (loop.time() - started)))
+
+    async def _broadcast(self):
+        if not self.subscribers:
+            return
+        subscribers = list(self.subscribers)
+        results = await asyncio.gather(*(ws.send_str(self._payload) for ws in subscribers), return_exceptions=True)
+        for ws, result in zip(subscribers, results):
+            if isinstance(result, Exception) or ws.closed:
+                self.subscribers.discard(ws)
+
+
+sampler = StatsSampler()
+
+
+async def start_stats_sampler(app):
+    sampler.start()
+
+
+async def stop_stats_sampler(app):
+    await sampler.stop()
+
+
+async def get_server_stats():
+    if sampler.latest is None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, collect_server_stats)
+    return sampler.latest
+
+
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
-    while not ws.closed:
-        stats = await get_server_stats()
-        await ws.send_json(stats)
-        await asyncio.sleep(2)
+    sampler.start()
+    if sampler._payload is not None:
+        await ws.send_str(sampler._payload)
+    sampler.subscribers.add(ws)
+    try:
+        # The sampler pushes snapshots, we only need to notice when the client goes away
+        async for _ in ws:
+            pass
+    finally:
+        sampler.subscribers.discard(ws)
     return ws
 
 
+async def history_handler(request):
+    """Stats history for the dashboard charts: ?range=<seconds> or ?from=<unix>&to=<unix>"""
+    try:
+        now = time.time()
+        end = float(request.query.get('to', now))
+        if 'from' in request.query:
+            start = float(request.query['from'])
+        else:
+            start = end - float(request.query.get('range', 3600))
+    except ValueError:
+        return web.Response(text="Invalid time range", status=400)
+    if start >= end:
+        return web.Response(text="Invalid time range", status=400)
+    return web.json_response(sampler.history.query(start, end))
+
+
 async def index_handler(request):
-    file_path = os.path.join(os.path.dirname(__file__), 'server.html')
-    with open(file_path, 'r') as f:
-        return web.Response(text=f.read(), content_type='text/html')
+    return web.Response(text=server_template.source(), content_type='text/html')
@@ -0,0 +1,238 @@
+"""Storage pool: the disks that hold HLS trees and originals.
+
+Every root has the layout a single disk always had, <root>/downloads/<file_id>/ and
+<root>/originals/<file_id>.<ext>, plus <root>/mp4/<file_id>.mp4 for remuxed download copies. An asset's
+roots are ranked by weighted rendezvous hashing of its file_id, so placement is deterministic and adding
+a disk only moves the assets that now rank it first. MP4 copies are derived and are not rebalanced.
+Encodes are written to <root>/downloads/.encode/ on the same disk and published with a rename.
+
+    python -m web.storage --rebalance --dry-run
+    python -m web.storage --rebalance
+"""
+import argparse
+import glob
+import hashlib
+import logging
+import math
+import os
+import shutil
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Comma separated mount points. The first one also keeps the access files and the rebuild spool.
+STORAGE_ROOTS = [os.path.abspath(root.strip())
+                 for root in os.getenv("STORAGE_ROOTS", os.getcwd()).split(",") if root.strip()]
+PRIMARY_ROOT = STORAGE_ROOTS[0]
+# Free space a root keeps; a new asset goes to its next ranked root once this would be crossed
+STORAGE_MIN_FREE_GB = float(os.getenv("STORAGE_MIN_FREE_GB", "5"))
+SCRATCH_NAME = ".encode"
+
+_weights = {}
+
+
+def downloads_dir(root: str) -> str:
+    return os.path.join(root, "downloads")
+
+
+def originals_dir(root: str) -> str:
+    return os.path.join(root, "originals")
+
+
+def mp4_dir(root: str) -> str:
+    return os.path.join(root, "mp4")
+
+
+def scratch_dir(root: str) -> str:
+    """Encodes in progress, on the same filesystem as the downloads/ they are renamed into"""
+    return os.path.join(downloads_dir(root), SCRATCH_NAME)
+
+
+for _root in STORAGE_ROOTS:
+    os.makedirs(downloads_dir(_root), exist_ok=True)
+    os.makedirs(originals_dir(_root), exist_ok=True)
+
+
+def _weight(root: str) -> float:
+    """Disk size, so a bigger disk ranks first for proportionally more assets"""
+    if root not in _weights:
+        try:
+            _weights[root] = float(shutil.disk_usage(root).total) or 1.0
+        except OSError:
+            _weights[root] = 1.0
+    return _weights[root]
+
+
+def ranked_roots(file_id: str):
+    """Roots in the order this asset prefers them. Depends only on the file_id and the set of roots."""
+    def score(root):
+        digest = hashlib.blake2b(f"{root}\0{file_id}".encode(), digest_size=8).digest()
+        unit = (int.from_bytes(digest, "big") + 1) / (2 ** 64 + 2)
+        return _weight(root) / -math.log(unit)
+
+    return sorted(STORAGE_ROOTS, key=score, reverse=True)
+
+
+def _has_room(root: str, size: int) -> bool:
+    try:
+        free = shutil.disk_usage(root).free
+    except OSError:
+        return False
+    return free - size >= STORAGE_MIN_FREE_GB * 1024 ** 3
+
+
+def place(file_id: str, size: int = 0) -> str:
+    """Root a new asset of about size bytes goes to: its first ranked root with room, else the emptiest"""
+    ranked = ranked_roots(file_id)
+    for root in ranked:
+        if _has_room(root, size):
+            return root
+    logger.warning(f"No storage root has {STORAGE_MIN_FREE_GB} GB to spare for {file_id}, using the emptiest")
+    return max(ranked, key=lambda root: shutil.disk_usage(root).free)
+
+
+def ingest_dir(file_id: str, size: int = 0) -> str:
+    """Directory a Telegram download goes to, with a trailing separator so pyrogram keeps the file name"""
+    return os.path.join(downloads_dir(place(file_id, size)), "")
+
+
+def root_of(path: str):
+    """The root a path lies under, or None"""
+    path = os.path.abspath(path)
+    matches = [root for root in STORAGE_ROOTS if path == root or path.startswith(os.path.join(root, ""))]
+    return max(matches, key=len) if matches else None
+
+
+def hls_dirs(file_id: str):
+    """Every HLS tree of an asset. More than one only after an interrupted rebalance."""
+    return [os.path.join(downloads_dir(root), file_id) for root in ranked_roots(file_id)
+            if os.path.isdir(os.path.join(downloads_dir(root), file_id))]
+
+
+def hls_dir(file_id: str) -> str:
+    """Where the asset's HLS tree is, or where it would be placed when there is none"""
+    dirs = hls_dirs(file_id)
+    return dirs[0] if dirs else os.path.join(downloads_dir(ranked_roots(file_id)[0]), file_id)
+
+
+def originals(file_id: str):
+    """Every stored original of an asset, in ranked root order"""
+    matches = []
+    for root in ranked_roots(file_id):
+        matches.extend(glob.glob(os.path.join(originals_dir(root), glob.escape(file_id) + ".*")))
+    return matches
+
+
+def find_original(file_id: str):
+    matches = originals(file_id)
+    return matches[0] if matches else None
+
+
+def mp4_paths(file_id: str):
+    """Every remuxed MP4 copy of an asset"""
+    return [os.path.join(mp4_dir(root), f"{file_id}.mp4") for root in ranked_roots(file_id)
+            if os.path.exists(os.path.join(mp4_dir(root), f"{file_id}.mp4"))]
+
+
+def mp4_path(file_id: str) -> str:
+    """Where the asset's MP4 copy is, or where to write one: next to its original, so the remux stays on one disk"""
+    paths = mp4_paths(file_id)
+    if paths:
+        return paths[0]
+    original = find_original(file_id)
+    root = root_of(original) if original else None
+    return os.path.join(mp4_dir(root or ranked_roots(file_id)[0]), f"{file_id}.mp4")
+
+
+def _tree_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _move(source: str, target_root: str, kind: str):
+    """Copy into the target's scratch area and rename into place, then drop the source"""
+    name = os.path.basename(source)
+    final = os.path.join(downloads_dir(target_root) if kind == "hls" else originals_dir(target_root), name)
+    staging = os.path.join(scratch_dir(target_root), f"rebalance-{kind}-{name}")
+    os.makedirs(scratch_dir(target_root), exist_ok=True)
+    shutil.rmtree(staging, ignore_errors=True)
+    if os.path.isdir(source):
+        shutil.copytree(source, staging)
+        shutil.rmtree(final, ignore_errors=True)
+    else:
+        shutil.copy2(source, staging)
+    os.replace(staging, final)
+    if os.path.isdir(source):
+        shutil.rmtree(source, ignore_errors=True)
+    else:
+        os.remove(source)
+
+
+def _encoding(file_id: str) -> bool:
+    return any(os.path.exists(os.path.join(scratch_dir(root), file_id)) for root in STORAGE_ROOTS)
+
+
+def rebalance(dry_run=False, limit=None):
+    """Move every asset to its best ranked root that has room, e.g. after a disk was added.
+    An asset only moves to a root it ranks above the one it is on. Returns the number of moves."""
+    current = {}
+    for root in STORAGE_ROOTS:
+        for entry in os.scandir(downloads_dir(root)):
+            if entry.is_dir() and not entry.name.startswith(".") \
+                    and os.path.exists(os.path.join(entry.path, "master.m3u8")):
+                current.setdefault(entry.name, []).append(("hls", entry.path))
+        for entry in os.scandir(originals_dir(root)):
+            if entry.is_file():
+                current.setdefault(os.path.splitext(entry.name)[0], []).append(("original", entry.path))
+
+    moved = 0
+    for file_id, assets in current.items():
+        if limit is not None and moved >= limit:
+            break
+        if _encoding(file_id):
+            continue
+        for kind, path in assets:
+            here = root_of(path)
+            size = _tree_size(path)
+            for root in ranked_roots(file_id):
+                if root == here:
+                    break
+                if not _has_room(root, size):
+                    continue
+                logger.info(f"{'Would move' if dry_run else 'Moving'} {kind} of {file_id} "
+                            f"({round(size / (1024 * 1024), 2)} MB) from {here} to {root}")
+                if not dry_run:
+                    _move(path, root, kind)
+                moved += 1
+                break
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebalance", action="store_true", help="move assets to their ranked roots")
+    parser.add_argument("--dry-run", action="store_true", help="only log what would be moved")
+    parser.add_argument("--limit", type=int, help="stop after this many moves")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    for root in STORAGE_ROOTS:
+        usage = shutil.disk_usage(root)
+        print(f"{root}: {round(usage.free / 1024 ** 3, 1)} GB free of {round(usage.total / 1024 ** 3, 1)} GB")
+    if args.rebalance:
+        moved = rebalance(dry_run=args.dry_run, limit=args.limit)
+        print(f"{'Would move' if args.dry_run else 'Moved'} {moved} assets")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import logging
+import math
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from web.storage import hls_dir, find_original
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+SUBTITLE_SEGMENT_SECONDS = int(os.getenv("SUBTITLE_SEGMENT_SECONDS", "30"))
+# Convert a track the first time a player asks for it instead of during the encode
+SUBTITLES_LAZY = os.getenv("SUBTITLES_LAZY", "false").lower() == "true"
+# Where cue time 0 sits on the MPEG-TS clock. ffmpeg's mpegts muxer starts at 1.4s (90 kHz ticks).
+SUBTITLE_MPEGTS_OFFSET = int(os.getenv("SUBTITLE_MPEGTS_OFFSET", "126000"))
+# Codecs ffmpeg can turn into WebVTT. Bitmap formats such as PGS and DVD subtitles cannot be.
+TEXT_SUBTITLE_CODECS = {"subrip", "srt", "ass", "ssa", "webvtt", "mov_text", "text"}
+# How long a track that failed to convert is not retried, each retry runs ffmpeg over the whole original
+SUBTITLE_RETRY_SECONDS = float(os.getenv("SUBTITLE_RETRY_SECONDS", "3600"))
+
+_TIMING = re.compile(r"^((?:\d+:)?\d{2}:\d{2}\.\d{3})\s+-->\s+((?:\d+:)?\d{2}:\d{2}\.\d{3})")
+_SEGMENT_PATH = re.compile(r"^([^/]+)/subtitles/(\d+)/segment\d+\.vtt$")
+# One lock per track, so concurrent first requests convert it once
+_track_locks = {}
+_locks_guard = threading.Lock()
+# (file_id, index) -> time its conversion failed
+_failed_tracks = {}
+
+
+def _seconds(timestamp: str) -> float:
+    total = 0.0
+    for part in timestamp.split(":"):
+        total = total * 60 + float(part)
+    return total
+
+
+def parse_vtt(text: str):
+    """(start, end, block) for every cue, block being the cue text from its timing line on"""
+    cues = []
+    for block in re.split(r"\n\s*\n", text.replace("\r\n", "\n")):
+        lines = block.strip("\n").split("\n")
+        for i, line in enumerate(lines):
+            match = _TIMING.match(line.strip())
+            if match:
+                cues.append((_seconds(match.group(1)), _seconds(match.group(2)), "\n".join(lines[i:])))
+                break
+    return cues
+
+
+def track_dir(file_id: str, index: int) -> str:
+    return os.path.join(hls_dir(file_id), "subtitles", str(index))
+
+
+def segment_count(duration: float) -> int:
+    return max(1, math.ceil(duration / SUBTITLE_SEGMENT_SECONDS))
+
+
+def write_playlist(directory: str, duration: float):
+    """Media playlist for a subtitle track. It only depends on the duration, so it can exist before the segments."""
+    os.makedirs(directory, exist_ok=True)
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{SUBTITLE_SEGMENT_SECONDS}",
+             "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    for n in range(segment_count(duration)):
+        length = min(SUBTITLE_SEGMENT_SECONDS, duration - n * SUBTITLE_SEGMENT_SECONDS) or SUBTITLE_SEGMENT_SECONDS
+        lines += [f"#EXTINF:{length:.3f},", f"segment{n}.vtt"]
+    lines.append("#EXT-X-ENDLIST")
+    with open(os.path.join(directory, "playlist.m3u8"), "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def playlist_duration(directory: str) -> float:
+    with open(os.path.join(directory, "playlist.m3u8"), "r", encoding="utf-8") as f:
+        return sum(float(line[8:].split(",", 1)[0]) for line in f if line.startswith("#EXTINF:"))
+
+
+def write_segments(vtt_text: str, directory: str, duration: float) -> int:
+    """Split a whole-file WebVTT into time-aligned segments. A cue that crosses a boundary goes into
+    every segment it overlaps, as HLS expects. Returns the bytes written."""
+    header = f"WEBVTT\nX-TIMESTAMP-MAP=MPEGTS:{SUBTITLE_MPEGTS_OFFSET},LOCAL:00:00:00.000\n\n"
+    cues = parse_vtt(vtt_text)
+    written = 0
+    for n in range(segment_count(duration)):
+        start = n * SUBTITLE_SEGMENT_SECONDS
+        end = start + SUBTITLE_SEGMENT_SECONDS
+        body = header + "\n\n".join(block for cue_start, cue_end, block in cues if cue_start < end and cue_end > start)
+        body += "\n"
+        data = body.encode("utf-8")
+        path = os.path.join(directory, f"segment{n}.vtt")
+        # Write then rename, so a concurrent reader never sees half a segment
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        written += len(data)
+    return written
+
+
+def convert_track(source: str, index: int, directory: str, duration: float) -> int:
+    """Extract subtitle track index of source with ffmpeg and write its segments. Returns bytes written."""
+    cmd = f'ffmpeg -hide_banner -loglevel error -y -i {shlex.quote(source)} -map 0:s:{index} -c:s webvtt -f webvtt -'
+    logger.info(f"Extracting subtitle {index}: {cmd}")
+    process = subprocess.run(cmd, shell=True, capture_output=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Subtitle {index} extraction failed: {process.stderr.decode('utf-8', 'replace')[-500:]}")
+    os.makedirs(directory, exist_ok=True)
+    return write_segments(process.stdout.decode("utf-8", "replace"), directory, duration)
+
+
+def lazy_segment_track(file_name: str):
+    """(file_id, index) when file_name is a subtitle segment that can still be converted on demand"""
+    match = _SEGMENT_PATH.match(file_name)
+    if not match:
+        return None
+    file_id, index = match.group(1), int(match.group(2))
+    if not os.path.exists(os.path.join(track_dir(file_id, index), "playlist.m3u8")):
+        return None
+    return file_id, index
+
+
+def ensure_track(file_id: str, index: int) -> bool:
+    """Convert a lazily deferred track from the original, once. Runs in an executor thread."""
+    directory = track_dir(file_id, index)
+    with _locks_guard:
+        lock = _track_locks.setdefault((file_id, index), threading.Lock())
+    with lock:
+        if os.path.exists(os.path.join(directory, "segment0.vtt")):
+            return True
+        if time.time() - _failed_tracks.get((file_id, index), 0) < SUBTITLE_RETRY_SECONDS:
+            return False
+        original = find_original(file_id)
+        if not original:
+            logger.warning(f"Cannot convert subtitle {index} of {file_id}: original not found")
+            _failed_tracks[(file_id, index)] = time.time()
+            return False
+        try:
+            convert_track(original, index, directory, playlist_duration(directory))
+            _failed_tracks.pop((file_id, index), None)
+            return True
+        except Exception as e:
+            logger.error(f"Lazy subtitle conversion of {file_id} track {index} failed: {str(e)}")
+            _failed_tracks[(file_id, index)] = time.time()
+            return False
@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.dirname(__file__)
+# Dev mode: re-read a template whenever its file changes
+TEMPLATE_RELOAD = os.getenv("TEMPLATE_RELOAD", "false").lower() == "true"
+PLAYER_CACHE_SIZE = int(os.getenv("PLAYER_CACHE_SIZE", "2000"))
+# Longest a cached player page lives. Invalidation only reaches the process that deleted the video, playback
+# workers rely on this, and so does a page whose HLS tree was evicted: serve_hls 404s until it expires.
+PLAYER_CACHE_TTL = int(os.getenv("PLAYER_CACHE_TTL", "60"))
+
+_PLACEHOLDER = re.compile(r"\{\{(\w+)\}\}")
+
+
+class Template:
+    """HTML file loaded once and split around its {{name}} placeholders, so rendering is a join"""
+
+    def __init__(self, name):
+        self.path = os.path.join(TEMPLATE_DIR, name)
+        self.mtime = None
+        self.text = ""
+        self.parts = []
+        self.load()
+
+    def load(self):
+        self.mtime = os.path.getmtime(self.path)
+        with open(self.path, "r", encoding="utf-8") as f:
+            self.text = f.read()
+        pieces = _PLACEHOLDER.split(self.text)
+        # Even indexes are literal text, odd indexes are placeholder names
+        self.parts = [(i % 2 == 1, piece) for i, piece in enumerate(pieces) if piece]
+
+    def _check_reload(self):
+        if TEMPLATE_RELOAD and os.path.getmtime(self.path) != self.mtime:
+            logger.info(f"Reloading template {self.path}")
+            self.load()
+
+    def source(self):
+        self._check_reload()
+        return self.text
+
+    def render(self, **values):
+        self._check_reload()
+        return "".join(str(values[piece]) if is_name else piece for is_name, piece in self.parts)
+
+
+class CachedPage:
+    __slots__ = ("body", "gzip_body", "etag", "expires_at", "headers")
+
+    def __init__(self, text, expires_at, headers=None):
+        self.body = text.encode("utf-8")
+        self.gzip_body = gzip.compress(self.body, 6)
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest()[:20] + '"'
+        self.expires_at = expires_at
+        self.headers = headers or {}
+
+    def response(self, request, content_type="text/html"):
+        """200 with the pre-compressed body when the client accepts gzip, or 304 when its ETag still matches"""
+        headers = {"ETag": self.etag, "Vary": "Accept-Encoding", **self.headers}
+        if self.etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            body = self.gzip_body
+        else:
+            body = self.body
+        return web.Response(body=body, content_type=content_type, charset="utf-8", headers=headers)
+
+
+class PageCache:
+    """Bounded LRU of rendered pages with a per-entry expiry"""
+
+    def __init__(self, max_size=PLAYER_CACHE_SIZE):
+        self.max_size = max_size
+        self.pages = OrderedDict()
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is None:
+            return None
+        if page.expires_at <= time.time():
+            del self.pages[key]
+            return None
+        self.pages.move_to_end(key)
+        return page
+
+    def put(self, key, page):
+        self.pages[key] = page
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_size:
+            self.pages.popitem(last=False)
+
+    def invalidate(self, token):
+        for key in [key for key in self.pages if key[0] == token]:
+            del self.pages[key]
+
+
+player_template = Template("player.html")
+video_template = Template("video.html")
+server_template = Template("server.html")
+index_template = Template("index.html")
+player_cache = PageCache()
@@ -0,0 +1,328 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import shutil
+import time
+
+from dotenv import load_dotenv
+
+from web.storage import STORAGE_ROOTS, PRIMARY_ROOT, downloads_dir, mp4_dir, find_original, hls_dir
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Bookkeeping lives on the first storage root, assets are spread over all of them
+BASE_DIR = downloads_dir(PRIMARY_ROOT)
+ACCESS_FILE = os.path.join(BASE_DIR, ".access.json")
+# Playback workers cannot reach the encoder queue, they drop rebuild requests here for the bot process
+REBUILD_SPOOL_DIR = os.path.join(BASE_DIR, ".rebuild")
+
+# Evict HLS trees that nobody opened within this many days
+TIER_IDLE_DAYS = float(os.getenv("TIER_IDLE_DAYS", "30"))
+# Remuxed download copies are cheap to make again, they go sooner and first under disk pressure
+TIER_MP4_IDLE_DAYS = float(os.getenv("TIER_MP4_IDLE_DAYS", "7"))
+# Start evicting least recently watched videos above the high watermark, stop below the low one
+TIER_HIGH_WATERMARK = float(os.getenv("TIER_HIGH_WATERMARK", "0.90"))
+TIER_LOW_WATERMARK = float(os.getenv("TIER_LOW_WATERMARK", "0.80"))
+# Never evict something watched more recently than this, even under disk pressure
+TIER_MIN_IDLE_SECONDS = float(os.getenv("TIER_MIN_IDLE_SECONDS", "3600"))
+TIER_INTERVAL_SECONDS = float(os.getenv("TIER_INTERVAL_SECONDS", "600"))
+TIER_ACCESS_FLUSH_SECONDS = float(os.getenv("TIER_ACCESS_FLUSH_SECONDS", "60"))
+REBUILD_SPOOL_POLL_SECONDS = float(os.getenv("REBUILD_SPOOL_POLL_SECONDS", "5"))
+
+# file_id -> unix time of the last HLS request
+last_access = {}
+# file_ids with a re-encode queued or running
+rebuilding = set()
+# Set by serve.py in playback worker processes
+worker_mode = False
+
+
+class SilentProgress:
+    """Stand-in for the Telegram progress message on jobs nobody is watching"""
+
+    async def edit_text(self, *args, **kwargs):
+        return None
+
+
+def record_access(file_name: str):
+    """Called from serve_hls for every request, so keep it to a dict write"""
+    last_access[file_name.split("/", 1)[0]] = time.time()
+
+
+def hls_ready(file_id: str) -> bool:
+    return os.path.exists(os.path.join(hls_dir(file_id), "master.m3u8"))
+
+
+def _spool_path(file_id: str) -> str:
+    return os.path.join(REBUILD_SPOOL_DIR, file_id)
+
+
+def _spool_rebuild(file_id: str, file_name: str):
+    if os.path.exists(_spool_path(file_id)):
+        return
+    os.makedirs(REBUILD_SPOOL_DIR, exist_ok=True)
+    with open(_spool_path(file_id), "w", encoding="utf-8") as f:
+        f.write(file_name)
+
+
+async def request_rebuild(file_id: str, file_name: str) -> bool:
+    """Queue a re-encode of an evicted video from its original. Returns False if it cannot be rebuilt."""
+    if file_id in rebuilding:
+        return True
+
+    loop = asyncio.get_running_loop()
+    original = await loop.run_in_executor(None, find_original, file_id)
+    if not original:
+        logger.warning(f"Cannot rebuild {file_id}: original not found on any storage root")
+        return False
+
+    if worker_mode:
+        await loop.run_in_executor(None, _spool_rebuild, file_id, file_name)
+        return True
+
+    from plugins.video import que
+
+    rebuilding.add(file_id)
+    await que.put({
+        "file_id": file_id,
+        "file_name": file_name,
+        "file_path": original,
+        "chat_id": None,
+        "user_id": None,
+        "bot": None,
+        "progress": SilentProgress(),
+        "msg": None,
+        "rebuild": True,
+        "queued_at": time.time(),
+    })
+    logger.info(f"Queued HLS rebuild for {file_id} from {original}")
+    return True
+
+
+def rebuild_finished(file_id: str):
+    rebuilding.discard(file_id)
+    last_access[file_id] = time.time()
+    try:
+        os.remove(_spool_path(file_id))
+    except FileNotFoundError:
+        pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load_access():
+    """Merge the bot's own access file and the ones flushed by playback workers.
+    Returns the worker files whose process has exited, to delete once the merge is saved."""
+    stale = []
+    for path in glob.glob(os.path.join(BASE_DIR, ".access*.json")):
+        try:
+            with open(path, "r") as f:
+                for file_id, seen in json.load(f).items():
+                    if float(seen) > last_access.get(file_id, 0):
+                        last_access[file_id] = float(seen)
+        except Exception as e:
+            logger.warning(f"Could not load access times from {path}: {e}")
+            continue
+        # .access-<pid>.json of a restarted worker is never rewritten, without this they pile up
+        pid = os.path.basename(path)[len(".access-"):-len(".json")]
+        if path != ACCESS_FILE and pid.isdigit() and int(pid) != os.getpid() and not _pid_alive(int(pid)):
+            stale.append(path)
+    return stale
+
+
+def _save_access(path=ACCESS_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(dict(last_access), f)
+    os.replace(tmp_path, path)
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _scan_assets(root):
+    """Return [(last_access, file_id, path)] for every evictable HLS tree on a root, oldest first"""
+    assets = []
+    for entry in os.scandir(downloads_dir(root)):
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        file_id = entry.name
+        if file_id in rebuilding or not find_original(file_id):
+            # Without an original we could never bring it back
+            continue
+        master = os.path.join(entry.path, "master.m3u8")
+        if not os.path.exists(master):
+            continue
+        seen = last_access.get(file_id)
+        if seen is None:
+            seen = os.path.getmtime(master)
+            last_access[file_id] = seen
+        assets.append((seen, file_id, entry.path))
+    assets.sort()
+    return assets
+
+
+def _scan_mp4s(root):
+    """Return [(mtime, path, size)] for the MP4 download copies on a root, oldest first.
+    Serving a copy touches it, so mtime is its last use."""
+    copies = []
+    try:
+        entries = list(os.scandir(mp4_dir(root)))
+    except FileNotFoundError:
+        return copies
+    for entry in entries:
+        if entry.is_file() and entry.name.endswith(".mp4"):
+            stat = entry.stat()
+            copies.append((stat.st_mtime, entry.path, stat.st_size))
+    copies.sort()
+    return copies
+
+
+def _evict_mp4(path: str, size: int) -> int:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    logger.info(f"Evicted MP4 copy {path} ({round(size / (1024 * 1024), 2)} MB)")
+    return size
+
+
+def _evict(file_id: str, hls_folder: str) -> int:
+    freed = _dir_size(hls_folder)
+    shutil.rmtree(hls_folder, ignore_errors=True)
+    last_access.pop(file_id, None)
+    logger.info(f"Evicted HLS tree {hls_folder} ({round(freed / (1024 * 1024), 2)} MB)")
+    return freed
+
+
+def run_tier_pass():
+    """One blocking pass of the tier manager, run in an executor"""
+    stale = _load_access()
+    now = time.time()
+    idle_cutoff = now - TIER_IDLE_DAYS * 86400
+    pressure_cutoff = now - TIER_MIN_IDLE_SECONDS
+
+    evicted = 0
+    # Watermarks apply per disk, a full disk only sheds the videos stored on it
+    mp4_cutoff = now - TIER_MP4_IDLE_DAYS * 86400
+    for root in STORAGE_ROOTS:
+        copies = []
+        for mtime, path, size in _scan_mp4s(root):
+            if mtime < mp4_cutoff:
+                _evict_mp4(path, size)
+                evicted += 1
+            else:
+                copies.append((mtime, path, size))
+
+        remaining = []
+        for seen, file_id, path in _scan_assets(root):
+            if seen < idle_cutoff:
+                _evict(file_id, path)
+                evicted += 1
+            else:
+                remaining.append((seen, file_id, path))
+
+        disk = shutil.disk_usage(root)
+        used = disk.used
+        if used / disk.total > TIER_HIGH_WATERMARK:
+            target = disk.total * TIER_LOW_WATERMARK
+            for mtime, path, size in copies:
+                if used <= target or mtime >= pressure_cutoff:
+                    break
+                used -= _evict_mp4(path, size)
+                evicted += 1
+            for seen, file_id, path in remaining:
+                if used <= target or seen >= pressure_cutoff:
+                    break
+                used -= _evict(file_id, path)
+                evicted += 1
+
+    _save_access()
+    # Their times are in ACCESS_FILE now
+    for path in stale:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return evicted
+
+
+def _pending_spool():
+    try:
+        names = os.listdir(REBUILD_SPOOL_DIR)
+    except FileNotFoundError:
+        return []
+    pending = []
+    for file_id in names:
+        if file_id in rebuilding:
+            continue
+        try:
+            with open(_spool_path(file_id), "r", encoding="utf-8") as f:
+                pending.append((file_id, f.read() or file_id))
+        except OSError:
+            pass
+    return pending
+
+
+async def run_rebuild_spool():
+    """Queue the rebuilds requested by playback workers"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            for file_id, file_name in await loop.run_in_executor(None, _pending_spool):
+                if not await request_rebuild(file_id, file_name):
+                    rebuild_finished(file_id)
+        except Exception as e:
+            logger.error(f"Rebuild spool poll failed: {str(e)}")
+        await asyncio.sleep(REBUILD_SPOOL_POLL_SECONDS)
+
+
+async def run_access_flusher():
+    """Playback workers persist their access times for the tier manager in the bot process"""
+    loop = asyncio.get_running_loop()
+    path = os.path.join(BASE_DIR, f".access-{os.getpid()}.json")
+    while True:
+        await asyncio.sleep(TIER_ACCESS_FLUSH_SECONDS)
+        try:
+            await loop.run_in_executor(None, _save_access, path)
+        except Exception as e:
+            logger.error(f"Access flush failed: {str(e)}")
+
+
+async def run_tier_manager():
+    loop = asyncio.get_running_loop()
+    spool_task = asyncio.create_task(run_rebuild_spool())
+    try:
+        await _tier_loop(loop)
+    finally:
+        spool_task.cancel()
+
+
+async def _tier_loop(loop):
+    while True:
+        try:
+            evicted = await loop.run_in_executor(None, run_tier_pass)
+            if evicted:
+                logger.info(f"Tier manager evicted {evicted} HLS trees and MP4 copies")
+        except Exception as e:
+            logger.error(f"Tier manager pass failed: {str(e)}")
+        await asyncio.sleep(TIER_INTERVAL_SECONDS)